@@ -16,6 +16,10 @@ data = dict(
     sequence_name='',             # to support co3d
 #    load2gpu_on_the_fly=False,    # do not load all images into gpu (to save gpu memory)
     load2gpu_on_the_fly=True,    # do not load all images into gpu (to save gpu memory)
+    uint8_images=True,            # keep 8-bit images in uint8 and normalize them only when used (other images stay in float32)
+    cache_dir=None,               # cache the loaded data as memory-mapped .npy files in this folder (keyed by this data config)
+    streaming_views=0,            # keep only a rotating working set of this number of training views in memory (0: all)
+    streaming_refresh_every=100,  # replace the oldest view of the working set every given number of iterations
     testskip=5,                   # subsample testset to preview results
     white_bkgd=True,             # use white background (note that some dataset don't provide alpha and with blended bg color)
     rand_bkgd=False,              # use random background during training
@@ -49,7 +53,12 @@ coarse_train = dict(
     lrate_decay=20,               # lr decay by 0.1 after every lrate_decay*1000 steps
     pervoxel_lr=True,             # view-count-based lr
     pervoxel_lr_downrate=1,       # downsampled image for computing view-count-based lr
+    count_views_device=None,      # device for counting the views per voxel (None: the model device; e.g. "cpu")
     ray_sampler='random',         # ray sampling strategies
+    compact_rays=False,           # store uint8 rgb and pixel indices only and regenerate the rays per batch
+    stratified_sampling=False,    # draw the rays of a batch evenly from all the training views (flatten and in_maskcache)
+    mixed_precision=False,        # autocast the color path (k0 and rgbnet) with loss scaling
+    prefetch_batches=0,           # number of batches gathered ahead in background (only for load2gpu_on_the_fly)
     weight_main=1.0,              # weight of photometric loss
     weight_entropy_last=0.01,     # weight of background entropy loss
     weight_nearclip=0,
@@ -59,11 +68,16 @@ coarse_train = dict(
     tv_after=0,                   # count total variation loss from tv_from step
     tv_before=0,                  # count total variation before the given number of iterations
     tv_dense_before=0,            # count total variation densely before the given number of iterations
+    tv_in_mask_cache=False,       # count total variation only on the voxels inside mask_cache
+    ckpt_keep_last_n=0,           # only keep the newest n step checkpoints (0: keep all)
+    ckpt_save_optimizer=True,     # save the optimizer state in the checkpoints
     weight_tv_density=0.0,        # weight of total variation loss of density voxel grid
     weight_tv_k0=0.0,             # weight of total variation loss of color/feature voxel grid
     pg_scale=[],                  # checkpoints for progressive scaling
     decay_after_scale=1.0,        # decay act_shift after scaling
     skip_zero_grad_fields=[],     # the variable name to skip optimizing parameters w/ zero grad in each iteration
+    fused_adam=True,              # update the small tensors (e.g., rgbnet) in a single multi-tensor kernel launch
+    sparse_adam_fields=[],        # the DenseGrid names to update only at the voxels sampled in each iteration (lazy moment decay)
     maskout_lt_nviews=0,
 )
 
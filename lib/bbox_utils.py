@@ -1,43 +1,99 @@
 import torch
 import numpy as np
 from . import seg_dvgo as dvgo
+from . import grid
 import time
 from .utils import load_model
 
-__ALL__ = ['_compute_bbox_by_cam_frustrm_bounded',
+__ALL__ = ['get_corner_rays',
+            '_compute_bbox_by_cam_frustrm_bounded',
             '_compute_bbox_by_cam_frustrm_unbounded',
             'compute_bbox_by_cam_frustrm',
             'compute_bbox_by_coarse_geo']
 
+def get_corner_rays(HW, Ks, poses, ndc, inverse_y, flip_x, flip_y):
+    '''Rays of the top-left, top-right, bottom-left and bottom-right pixels of all the views in a batch.
+    It follows get_rays_of_a_view with mode='center'; rays_o, rays_d and viewdirs are [N, 4, 3].
+    '''
+    poses = torch.as_tensor(poses)[:, :3, :4].float()
+    device = poses.device
+    HW = torch.as_tensor(np.array(HW), dtype=torch.float32, device=device)
+    Ks = torch.as_tensor(np.array(Ks), dtype=torch.float32, device=device)
+    H, W = HW[:, :1], HW[:, 1:]
+    half = torch.full_like(H, 0.5)
+    i = torch.cat([half, W-0.5, half, W-0.5], 1)
+    j = torch.cat([half, half, H-0.5, H-0.5], 1)
+    if flip_x:
+        i = W - i
+    if flip_y:
+        j = H - j
+    fx, fy, cx, cy = Ks[:, :1, 0], Ks[:, 1:2, 1], Ks[:, :1, 2], Ks[:, 1:2, 2]
+    if inverse_y:
+        dirs = torch.stack([(i-cx)/fx, (j-cy)/fy, torch.ones_like(i)], -1)
+    else:
+        dirs = torch.stack([(i-cx)/fx, -(j-cy)/fy, -torch.ones_like(i)], -1)
+    rays_d = torch.sum(dirs[..., None, :] * poses[:, None, :3, :3], -1)
+    rays_o = poses[:, None, :3, 3].expand(rays_d.shape)
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    if ndc:
+        rays_o, rays_d = dvgo.ndc_rays(H, W, fx, 1., rays_o, rays_d)
+    return rays_o, rays_d, viewdirs
+
+
+def _cone_extremes(viewdirs):
+    '''Per-axis min and max ([N, 3] each) of the unit vectors inside the cones spanned by the corner viewdirs ([N, 4, 3]).
+    The maximum of a coordinate over the spherical cap is reached at a corner, inside an edge arc
+    (the normalized projection of the axis on the plane of the arc) or at the axis itself if it is inside the cone.
+    '''
+    v = viewdirs[:, [0, 1, 3, 2]]  # in cyclic order
+    v_next = v.roll(-1, dims=1)
+    n = torch.cross(v, v_next, dim=-1)  # [N, 4, 3] normals of the edge arcs
+    axes = torch.cat([torch.eye(3), -torch.eye(3)]).to(v)  # +x, +y, +z, -x, -y, -z
+    # corners
+    best = (v @ axes.T).amax(1)  # [N, 6]
+    # edge arcs
+    n_unit = n / n.norm(dim=-1, keepdim=True).clamp_min(1e-12)
+    p = axes - (n_unit @ axes.T)[..., None] * n_unit[..., None, :]  # [N, 4, 6, 3]
+    p_norm = p.norm(dim=-1)
+    u = p / p_norm[..., None].clamp_min(1e-12)
+    in_arc = ((torch.cross(v[:, :, None].expand_as(u), u, dim=-1) * n[:, :, None]).sum(-1) >= 0) \
+           & ((torch.cross(u, v_next[:, :, None].expand_as(u), dim=-1) * n[:, :, None]).sum(-1) >= 0)
+    best = torch.maximum(best, torch.where(in_arc, p_norm, torch.full_like(p_norm, -1)).amax(1))
+    # the axis inside the cone (the edge normals oriented toward the cone)
+    n_in = n * torch.sign((n * v.mean(1, keepdim=True)).sum(-1, keepdim=True))
+    inside = ((n_in @ axes.T) >= 0).all(1)
+    best = torch.where(inside, torch.ones_like(best), best)
+    return -best[:, 3:], best[:, :3]
+
+
 def _compute_bbox_by_cam_frustrm_bounded(cfg, HW, Ks, poses, i_train, near, far):
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        if cfg.data.ndc:
-            pts_nf = torch.stack([rays_o+rays_d*near, rays_o+rays_d*far])
-        else:
-            pts_nf = torch.stack([rays_o+viewdirs*near, rays_o+viewdirs*far])
-        xyz_min = torch.minimum(xyz_min, pts_nf.amin((0,1,2)))
-        xyz_max = torch.maximum(xyz_max, pts_nf.amax((0,1,2)))
+    rays_o, rays_d, viewdirs = get_corner_rays(
+            HW=HW[i_train], Ks=Ks[i_train], poses=poses[i_train],
+            ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    if cfg.data.ndc:
+        # the points at a given ray step form a quadrilateral whose extremes are the corners
+        pts_nf = torch.stack([rays_o+rays_d*near, rays_o+rays_d*far])
+    else:
+        # the points at a given distance form a spherical cap
+        dir_min, dir_max = _cone_extremes(viewdirs)
+        cam_o = rays_o[:, 0]
+        pts_nf = torch.stack([cam_o+dir_min*near, cam_o+dir_max*near, cam_o+dir_min*far, cam_o+dir_max*far])
+    xyz_min = pts_nf.flatten(0, -2).amin(0)
+    xyz_max = pts_nf.flatten(0, -2).amax(0)
     return xyz_min, xyz_max
 
 
 def _compute_bbox_by_cam_frustrm_unbounded(cfg, HW, Ks, poses, i_train, near_clip):
     # Find a tightest cube that cover all camera centers
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        pts = rays_o + rays_d * near_clip
-        xyz_min = torch.minimum(xyz_min, pts.amin((0,1)))
-        xyz_max = torch.maximum(xyz_max, pts.amax((0,1)))
+    rays_o, rays_d, viewdirs = get_corner_rays(
+            HW=HW[i_train], Ks=Ks[i_train], poses=poses[i_train],
+            ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+            flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+    # the points on the plane at near_clip form a rectangle whose extremes are the corners
+    pts = (rays_o + rays_d * near_clip).flatten(0, -2)
+    xyz_min = pts.amin(0)
+    xyz_max = pts.amax(0)
     center = (xyz_min + xyz_max) * 0.5
     radius = (center - xyz_min).max() * cfg.data.unbounded_inner_r
     xyz_min = center - radius
@@ -65,18 +121,10 @@ def compute_bbox_by_coarse_geo(model_class, model_path, thres):
     print('compute_bbox_by_coarse_geo: start')
     eps_time = time.time()
     model = load_model(model_class, model_path)
-    interp = torch.stack(torch.meshgrid(
-        torch.linspace(0, 1, model.world_size[0]),
-        torch.linspace(0, 1, model.world_size[1]),
-        torch.linspace(0, 1, model.world_size[2]),
-    ), -1)
-    dense_xyz = model.xyz_min * (1-interp) + model.xyz_max * interp
-    density = model.density(dense_xyz)
+    density = grid.sample_on_lattice(model.density, model.xyz_min, model.xyz_max, model.world_size)
     alpha = model.activate_density(density)
     mask = (alpha > thres)
-    active_xyz = dense_xyz[mask]
-    xyz_min = active_xyz.amin(0)
-    xyz_max = active_xyz.amax(0)
+    xyz_min, xyz_max = grid.lattice_bbox(mask, model.xyz_min, model.xyz_max)
     print('compute_bbox_by_coarse_geo: xyz_min', xyz_min)
     print('compute_bbox_by_coarse_geo: xyz_max', xyz_max)
     eps_time = time.time() - eps_time
@@ -0,0 +1,109 @@
+import os
+import queue
+import atexit
+import shutil
+import threading
+
+import torch
+
+
+def snapshot_to_cpu(obj):
+    '''Recursively copy all the tensors in a (nested) checkpoint dict / list to CPU
+    so that the training can keep updating the originals in-place.
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    '''torch.save to a temporary file then rename it, so path is never half written'''
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_link(src, dst):
+    '''Make dst refer to the content of src (hard link if possible, otherwise copy) atomically'''
+    tmp_path = dst + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointWriter:
+    '''Save checkpoints on a background thread.
+    The tensors are snapshotted to CPU on the calling thread while the serialization and IO happen in background.
+    A checkpoint is written once; the optional last_path is linked to it.
+    @keep_last_n:     only keep the newest n checkpoints saved with a last_path (0 for keeping all).
+    @save_optimizer:  drop 'optimizer_state_dict' from the checkpoints if False.
+    @background:      write on the calling thread if False.
+    '''
+    def __init__(self, keep_last_n=0, save_optimizer=True, background=True, max_pending=2):
+        self.keep_last_n = keep_last_n
+        self.save_optimizer = save_optimizer
+        self.background = background
+        self.history = []
+        self.error = None
+        if background:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def save(self, ckpt, path, last_path=None):
+        self._raise_error()
+        if not self.save_optimizer:
+            ckpt = {k: v for k, v in ckpt.items() if k != 'optimizer_state_dict'}
+        if self.background:
+            self.queue.put((snapshot_to_cpu(ckpt), path, last_path))
+        else:
+            self._write(ckpt, path, last_path)
+
+    def _write(self, ckpt, path, last_path):
+        atomic_save(ckpt, path)
+        if last_path is not None:
+            atomic_link(path, last_path)
+            self.history.append(path)
+            while self.keep_last_n > 0 and len(self.history) > self.keep_last_n:
+                old_path = self.history.pop(0)
+                if os.path.exists(old_path) and old_path != path:
+                    os.remove(old_path)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None:
+                    self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait(self):
+        '''Block until all the pending checkpoints are written'''
+        if self.background:
+            self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.background and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
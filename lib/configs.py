@@ -31,6 +31,8 @@ def config_parser():
     parser.add_argument("--render_video_factor", type=float, default=0,
                         help='downsampling factor to speed up rendering, set 4 or 8 for fast preview')
     parser.add_argument("--dump_images", action='store_true')
+    parser.add_argument("--profile", action='store_true',
+                        help='time the hot-path phases and export chrome traces and summaries')
     parser.add_argument("--eval_ssim", action='store_true')
     parser.add_argument("--eval_lpips_alex", action='store_true')
     parser.add_argument("--eval_lpips_vgg", action='store_true')
@@ -26,6 +26,15 @@ void adam_upd_with_perlr_cuda(
     torch::Tensor perlr,
     int step, float beta1, float beta2, float lr, float eps);
 
+void multi_adam_upd_cuda(
+    std::vector<torch::Tensor> params,
+    std::vector<torch::Tensor> grads,
+    std::vector<torch::Tensor> exp_avgs,
+    std::vector<torch::Tensor> exp_avg_sqs,
+    std::vector<double> step_sizes,
+    std::vector<bool> skip_zero_grads,
+    float beta1, float beta2, float eps);
+
 
 // C++ interface
 
@@ -76,6 +85,29 @@ void adam_upd_with_perlr(
           step, beta1, beta2, lr, eps);
 }
 
+void multi_adam_upd(
+    std::vector<torch::Tensor> params,
+    std::vector<torch::Tensor> grads,
+    std::vector<torch::Tensor> exp_avgs,
+    std::vector<torch::Tensor> exp_avg_sqs,
+    std::vector<double> step_sizes,
+    std::vector<bool> skip_zero_grads,
+    float beta1, float beta2, float eps) {
+  const size_t n_tensors = params.size();
+  TORCH_CHECK(grads.size()==n_tensors && exp_avgs.size()==n_tensors && exp_avg_sqs.size()==n_tensors &&
+              step_sizes.size()==n_tensors && skip_zero_grads.size()==n_tensors,
+              "multi_adam_upd: all the lists must have the same length");
+  for(size_t i=0; i<n_tensors; ++i) {
+    CHECK_INPUT(params[i]);
+    CHECK_INPUT(grads[i]);
+    CHECK_INPUT(exp_avgs[i]);
+    CHECK_INPUT(exp_avg_sqs[i]);
+    TORCH_CHECK(params[i].scalar_type()==params[0].scalar_type(), "multi_adam_upd: all the params must have the same dtype");
+  }
+  multi_adam_upd_cuda(params, grads, exp_avgs, exp_avg_sqs, step_sizes, skip_zero_grads,
+          beta1, beta2, eps);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("adam_upd", &adam_upd,
           "Adam update");
@@ -83,5 +115,7 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
           "Adam update ignoring zero grad");
   m.def("adam_upd_with_perlr", &adam_upd_with_perlr,
           "Adam update ignoring zero grad with per-voxel lr");
+  m.def("multi_adam_upd", &multi_adam_upd,
+          "Adam update of a list of tensors in a single kernel launch");
 }
 
@@ -57,6 +57,44 @@ __global__ void adam_upd_with_perlr_cuda_kernel(
   }
 }
 
+/*
+   Multi-tensor version.
+   The tensors are viewed as a single flattened array; each thread locates its tensor by
+   binary searching the start offsets in the table.
+   table: [n_tensors, 6] of (param ptr, grad ptr, exp_avg ptr, exp_avg_sq ptr, start offset, skip_zero_grad)
+*/
+template <typename scalar_t>
+__global__ void multi_adam_upd_cuda_kernel(
+    const int64_t* __restrict__ table,
+    const float* __restrict__ step_sizes,
+    const int n_tensors, const size_t N,
+    const float beta1, const float beta2, const float eps) {
+
+  const size_t index = blockIdx.x * blockDim.x + threadIdx.x;
+  if(index>=N) {
+    return;
+  }
+  int lo = 0, hi = n_tensors - 1;
+  while(lo < hi) {
+    const int mid = (lo + hi + 1) >> 1;
+    if(table[mid*6+4] <= (int64_t)index) lo = mid;
+    else hi = mid - 1;
+  }
+  const int64_t* row = table + lo*6;
+  const size_t i_el = index - row[4];
+  scalar_t* param = reinterpret_cast<scalar_t*>(row[0]);
+  const scalar_t* grad = reinterpret_cast<const scalar_t*>(row[1]);
+  scalar_t* exp_avg = reinterpret_cast<scalar_t*>(row[2]);
+  scalar_t* exp_avg_sq = reinterpret_cast<scalar_t*>(row[3]);
+  const scalar_t g = grad[i_el];
+  if(row[5] && g==0) {
+    return;
+  }
+  exp_avg[i_el] = beta1 * exp_avg[i_el] + (1-beta1) * g;
+  exp_avg_sq[i_el] = beta2 * exp_avg_sq[i_el] + (1-beta2) * g * g;
+  param[i_el] -= step_sizes[lo] * exp_avg[i_el] / (sqrt(exp_avg_sq[i_el]) + eps);
+}
+
 void adam_upd_cuda(
     torch::Tensor param,
     torch::Tensor grad,
@@ -131,3 +169,47 @@ void adam_upd_with_perlr_cuda(
   }));
 }
 
+
+void multi_adam_upd_cuda(
+    std::vector<torch::Tensor> params,
+    std::vector<torch::Tensor> grads,
+    std::vector<torch::Tensor> exp_avgs,
+    std::vector<torch::Tensor> exp_avg_sqs,
+    std::vector<double> step_sizes,
+    std::vector<bool> skip_zero_grads,
+    const float beta1, const float beta2, const float eps) {
+
+  const int n_tensors = params.size();
+  if(n_tensors == 0) {
+    return;
+  }
+
+  // Build the lookup table on host then upload it with a single copy
+  auto table = torch::empty({n_tensors, 6}, torch::dtype(torch::kInt64));
+  auto step_size_t = torch::empty({n_tensors}, torch::dtype(torch::kFloat32));
+  int64_t* table_ptr = table.data_ptr<int64_t>();
+  float* step_size_ptr = step_size_t.data_ptr<float>();
+  size_t N = 0;
+  for(int i=0; i<n_tensors; ++i) {
+    table_ptr[i*6+0] = reinterpret_cast<int64_t>(params[i].data_ptr());
+    table_ptr[i*6+1] = reinterpret_cast<int64_t>(grads[i].data_ptr());
+    table_ptr[i*6+2] = reinterpret_cast<int64_t>(exp_avgs[i].data_ptr());
+    table_ptr[i*6+3] = reinterpret_cast<int64_t>(exp_avg_sqs[i].data_ptr());
+    table_ptr[i*6+4] = N;
+    table_ptr[i*6+5] = skip_zero_grads[i];
+    step_size_ptr[i] = step_sizes[i];
+    N += params[i].numel();
+  }
+  table = table.to(params[0].device());
+  step_size_t = step_size_t.to(params[0].device());
+
+  const int threads = 256;
+  const int blocks = (N + threads - 1) / threads;
+
+  AT_DISPATCH_FLOATING_TYPES(params[0].type(), "multi_adam_upd_cuda", ([&] {
+    multi_adam_upd_cuda_kernel<scalar_t><<<blocks, threads>>>(
+        table.data_ptr<int64_t>(),
+        step_size_t.data_ptr<float>(),
+        n_tensors, N, beta1, beta2, eps);
+  }));
+}
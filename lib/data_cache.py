@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
+
+from .load_data import load_data
+from .image_io import is_minify_output
+
+
+CACHED_KEYS = (
+    'hwf', 'HW', 'Ks', 'near', 'far', 'near_clip',
+    'i_train', 'i_val', 'i_test', 'irregular_shape',
+    'poses', 'render_poses', 'images')
+# bumped when the stored content changes (e.g., only the lossless images are stored in uint8 since 2)
+CACHE_VERSION = 2
+_ARRAY_KEYS = ('HW', 'Ks', 'poses', 'render_poses', 'i_train', 'i_val', 'i_test')
+
+
+def _is_derived_dir(path):
+    '''Directories written by the loaders themselves (minified images, sequence indices, temporary outputs)'''
+    name = os.path.basename(path)
+    return name.endswith('.index') or '.tmp' in name or is_minify_output(path)
+
+
+def _source_signature(cfg_data, max_depth=2):
+    '''Names, sizes and mtimes of the files referred by the data config (directories up to max_depth).
+    The outputs of the loaders are skipped, so the signature does not change when load_data writes them.
+    '''
+    signature = []
+    for key in sorted(cfg_data.keys()):
+        path = cfg_data[key]
+        if not isinstance(path, str) or not os.path.exists(path):
+            continue
+        if os.path.isfile(path):
+            signature.append([path, os.path.getsize(path), os.stat(path).st_mtime_ns])
+            continue
+        root_depth = path.rstrip(os.sep).count(os.sep)
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames
+                                 if not d.startswith('.') and not _is_derived_dir(os.path.join(dirpath, d)))
+            if dirpath.count(os.sep) - root_depth >= max_depth - 1:
+                dirnames[:] = []
+            for f in sorted(filenames):
+                st = os.stat(os.path.join(dirpath, f))
+                signature.append([os.path.join(dirpath, f), st.st_size, st.st_mtime_ns])
+    return signature
+
+
+def _hash(content):
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def config_key(cfg_data):
+    '''Hash of the data config section'''
+    return _hash([CACHE_VERSION, {k: v for k, v in cfg_data.items() if k != 'cache_dir'}])
+
+
+def cache_key(cfg_data):
+    '''Hash of the data config section and of its source files'''
+    return _hash([config_key(cfg_data), _source_signature(cfg_data)])
+
+
+def _evict(cache_dir, name, keep, cfg_key):
+    '''Remove the other {name}_{key} entries of the same data config (built from outdated sources)
+    and the incomplete or unreadable ones. The entries of the other configs of the scene are kept.
+    '''
+    pattern = re.compile(re.escape(name) + r'_[0-9a-f]{16}')
+    for entry in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        if entry == keep or not pattern.fullmatch(entry) or not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                stale = json.load(f).get('config') in (None, cfg_key)
+        except (OSError, ValueError):
+            stale = True
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+            print(f'load_data_cached: evicted {path}')
+
+
+def _save(data_dict, path, uint8_images, cfg_key):
+    from .utils import to_uint8_image_if_exact
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    convert = to_uint8_image_if_exact if uint8_images else (lambda im: np.asarray(im, dtype=np.float32))
+    images = data_dict['images']
+    if data_dict['irregular_shape']:
+        for i, im in enumerate(images):
+            np.save(os.path.join(tmp_path, f'images_{i:05d}.npy'), convert(im))
+    else:
+        np.save(os.path.join(tmp_path, 'images.npy'), convert(images))
+    for k in _ARRAY_KEYS:
+        np.save(os.path.join(tmp_path, f'{k}.npy'), np.asarray(data_dict[k]))
+    meta = {
+        'hwf': [float(v) for v in data_dict['hwf']],
+        'near': float(data_dict['near']),
+        'far': float(data_dict['far']),
+        'near_clip': None if data_dict['near_clip'] is None else float(data_dict['near_clip']),
+        'irregular_shape': bool(data_dict['irregular_shape']),
+        'n_images': len(images),
+        'config': cfg_key,
+    }
+    # the meta is written last and marks a complete cache
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def _load(path):
+    '''Memory-map the cached images (copy-on-write, so the pages are shared across processes until written)'''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    load = lambda name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c')
+    data_dict = {k: np.load(os.path.join(path, f'{k}.npy')) for k in _ARRAY_KEYS}
+    H, W, focal = meta['hwf']
+    data_dict.update(
+        hwf=[int(H), int(W), focal],
+        near=meta['near'], far=meta['far'], near_clip=meta['near_clip'],
+        irregular_shape=meta['irregular_shape'])
+    if meta['irregular_shape']:
+        images = np.empty([meta['n_images']], dtype=object)
+        images[:] = [load(f'images_{i:05d}') for i in range(meta['n_images'])]
+        data_dict['images'] = images
+    else:
+        data_dict['images'] = load('images')
+    return data_dict
+
+
+def load_data_cached(cfg_data, lazy_images=False):
+    '''load_data with a cache of the resolved data_dict as memory-mapped .npy files in cfg_data.cache_dir.
+    The cache is keyed by the data config and the mtimes of its source files; only CACHED_KEYS are kept.
+    Writing an entry evicts the entries of the same config built from outdated sources.
+    Fall back to load_data if cache_dir is not set.
+    With lazy_images, a missing cache is not built (it would decode all the images).
+    '''
+    cache_dir = cfg_data.get('cache_dir')
+    if not cache_dir:
+        return load_data(cfg_data, lazy_images=lazy_images)
+    eps_time = time.time()
+    name = os.path.basename(os.path.normpath(str(cfg_data['datadir']))) if cfg_data.get('datadir') else 'data'
+    path = os.path.join(cache_dir, f'{name}_{cache_key(cfg_data)}')
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        try:
+            data_dict = _load(path)
+            print(f'load_data_cached: loaded {path} in {time.time()-eps_time:.2f} sec')
+            return data_dict
+        except (OSError, ValueError, KeyError) as e:
+            print(f'load_data_cached: failed to load {path} ({e}), rebuild it')
+    if lazy_images:
+        return load_data(cfg_data, lazy_images=True)
+    data_dict = load_data(cfg_data)
+    data_dict = {k: data_dict[k] for k in CACHED_KEYS}
+    # keyed again after loading in case load_data wrote into the source tree
+    path = os.path.join(cache_dir, f'{name}_{cache_key(cfg_data)}')
+    _save(data_dict, path, uint8_images=cfg_data.get('uint8_images', True), cfg_key=config_key(cfg_data))
+    print(f'load_data_cached: saved {path}')
+    _evict(cache_dir, name, os.path.basename(path), config_key(cfg_data))
+    return _load(path)
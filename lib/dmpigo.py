@@ -11,6 +11,7 @@ from einops import rearrange
 from torch_scatter import scatter_add, segment_coo
 
 from . import grid
+from .profiler import profiler
 from .dvgo import Raw2Alpha, Alphas2Weights, render_utils_cuda
 
 
@@ -105,12 +106,7 @@ class DirectMPIGO(torch.nn.Module):
             mask_cache = grid.MaskGrid(
                     path=mask_cache_path,
                     mask_cache_thres=mask_cache_thres).to(self.xyz_min.device)
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], mask_cache_world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], mask_cache_world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], mask_cache_world_size[2]),
-            ), -1)
-            mask = mask_cache(self_grid_xyz)
+            mask = grid.sample_on_lattice(mask_cache, self.xyz_min, self.xyz_max, mask_cache_world_size)
         else:
             mask = torch.ones(list(mask_cache_world_size), dtype=torch.bool)
         self.mask_cache = grid.MaskGrid(
@@ -158,15 +154,11 @@ class DirectMPIGO(torch.nn.Module):
         self.k0.scale_volume_grid(self.world_size)
 
         if np.prod(self.world_size.tolist()) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-            ), -1)
+            self_mask = grid.sample_on_lattice(self.mask_cache, self.xyz_min, self.xyz_max, self.world_size)
             dens = self.density.get_dense_grid() + self.act_shift.grid
             self_alpha = F.max_pool3d(self.activate_density(dens), kernel_size=3, padding=1, stride=1)[0,0]
             self.mask_cache = grid.MaskGrid(
-                    path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
+                    path=None, mask=self_mask & (self_alpha>self.fast_color_thres),
                     xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
         print('dmpigo: scale_volume_grid finish')
@@ -174,30 +166,31 @@ class DirectMPIGO(torch.nn.Module):
     @torch.no_grad()
     def update_occupancy_cache(self):
         ori_p = self.mask_cache.mask.float().mean().item()
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
-        ), -1)
-        cache_grid_density = self.density(cache_grid_xyz)[None,None]
+        cache_grid_density = grid.sample_on_lattice(
+                self.density, self.xyz_min, self.xyz_max, self.mask_cache.mask.shape)[None,None]
         cache_grid_alpha = self.activate_density(cache_grid_density)
         cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
         self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
         new_p = self.mask_cache.mask.float().mean().item()
         print(f'dmpigo: update mask_cache {ori_p:.4f} => {new_p:.4f}')
 
-    def update_occupancy_cache_lt_nviews(self, rays_o_tr, rays_d_tr, imsz, render_kwargs, maskout_lt_nviews):
+    @torch.no_grad()
+    def update_occupancy_cache_lt_nviews(self, rays_o_tr, rays_d_tr, imsz, render_kwargs, maskout_lt_nviews, count_device=None):
+        '''Mask out the voxels seen by less than maskout_lt_nviews views.
+        The per-view hits are scatter-added on count_device (default: the device of the model).
+        '''
         print('dmpigo: update mask_cache lt_nviews start')
         eps_time = time.time()
         count = torch.zeros_like(self.density.get_dense_grid()).long()
         device = count.device
+        count_device = device if count_device is None else torch.device(count_device)
         for rays_o_, rays_d_ in zip(rays_o_tr.split(imsz), rays_d_tr.split(imsz)):
-            ones = grid.DenseGrid(1, self.world_size, self.xyz_min, self.xyz_max)
+            hits = torch.zeros([count.numel()], device=count_device)
             for rays_o, rays_d in zip(rays_o_.split(8192), rays_d_.split(8192)):
                 ray_pts, ray_id, step_id, N_samples = self.sample_ray(
                         rays_o=rays_o.to(device), rays_d=rays_d.to(device), **render_kwargs)
-                ones(ray_pts).sum().backward()
-            count.data += (ones.grid.grad > 1)
+                grid.trilinear_splat(ray_pts.reshape(-1,3), self.xyz_min, self.xyz_max, self.world_size, hits)
+            count += (hits > 1).view(count.shape).to(device)
         ori_p = self.mask_cache.mask.float().mean().item()
         self.mask_cache.mask &= (count >= maskout_lt_nviews)[0,0]
         new_p = self.mask_cache.mask.float().mean().item()
@@ -206,15 +199,15 @@ class DirectMPIGO(torch.nn.Module):
         eps_time = time.time() - eps_time
         print(f'dmpigo: update mask_cache lt_nviews finish (eps time:', eps_time, 'sec)')
 
-    def density_total_variation_add_grad(self, weight, dense_mode):
+    def density_total_variation_add_grad(self, weight, dense_mode, mask=None):
         wxy = weight * self.world_size[:2].max() / 128
         wz = weight * self.mpi_depth / 128
-        self.density.total_variation_add_grad(wxy, wxy, wz, dense_mode)
+        self.density.total_variation_add_grad(wxy, wxy, wz, dense_mode, mask)
 
-    def k0_total_variation_add_grad(self, weight, dense_mode):
+    def k0_total_variation_add_grad(self, weight, dense_mode, mask=None):
         wxy = weight * self.world_size[:2].max() / 128
         wz = weight * self.mpi_depth / 128
-        self.k0.total_variation_add_grad(wxy, wxy, wz, dense_mode)
+        self.k0.total_variation_add_grad(wxy, wxy, wz, dense_mode, mask)
 
     def activate_density(self, density, interval=None):
         interval = interval if interval is not None else self.voxel_size_ratio
@@ -259,11 +252,14 @@ class DirectMPIGO(torch.nn.Module):
         ret_dict = {}
         N = len(rays_o)
 
+        t_prof = profiler.tic()
         # sample points on rays
         ray_pts, ray_id, step_id, N_samples = self.sample_ray(
                 rays_o=rays_o, rays_d=rays_d, **render_kwargs)
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
+        t_prof = profiler.toc('sample_ray', t_prof)
+
         # skip known free space
         if self.mask_cache is not None:
             mask = self.mask_cache(ray_pts)
@@ -271,6 +267,8 @@ class DirectMPIGO(torch.nn.Module):
             ray_id = ray_id[mask]
             step_id = step_id[mask]
 
+        t_prof = profiler.toc('mask_cache', t_prof)
+
         # query for alpha w/ post-activation
         density = self.density(ray_pts) + self.act_shift(ray_pts)
         alpha = self.activate_density(density, interval)
@@ -281,6 +279,8 @@ class DirectMPIGO(torch.nn.Module):
             step_id = step_id[mask]
             alpha = alpha[mask]
 
+        t_prof = profiler.toc('density_alpha', t_prof)
+
         # compute accumulated transmittance
         weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
         if self.fast_color_thres > 0:
@@ -291,20 +291,26 @@ class DirectMPIGO(torch.nn.Module):
             alpha = alpha[mask]
             weights = weights[mask]
 
-        # query for color
-        vox_emb = self.k0(ray_pts)
+        t_prof = profiler.toc('alphas2weights', t_prof)
 
-        if self.rgbnet is None:
-            # no view-depend effect
-            rgb = torch.sigmoid(vox_emb)
-        else:
-            # view-dependent color emission
-            viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
-            viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
-            viewdirs_emb = viewdirs_emb[ray_id]
-            rgb_feat = torch.cat([vox_emb, viewdirs_emb], -1)
-            rgb_logit = self.rgbnet(rgb_feat)
-            rgb = torch.sigmoid(rgb_logit)
+        # query for color (autocast in the mixed precision mode; density and alpha stay in float32)
+        with torch.cuda.amp.autocast(enabled=render_kwargs.get('mixed_precision', False)):
+            vox_emb = self.k0(ray_pts)
+
+            if self.rgbnet is None:
+                # no view-depend effect
+                rgb = torch.sigmoid(vox_emb)
+            else:
+                # view-dependent color emission
+                viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
+                viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
+                viewdirs_emb = viewdirs_emb[ray_id]
+                rgb_feat = torch.cat([vox_emb, viewdirs_emb], -1)
+                rgb_logit = self.rgbnet(rgb_feat)
+                rgb = torch.sigmoid(rgb_logit)
+        rgb = rgb.float()
+
+        t_prof = profiler.toc('k0_rgbnet', t_prof)
 
         # Ray marching
         rgb_marched = segment_coo(
@@ -337,6 +343,8 @@ class DirectMPIGO(torch.nn.Module):
                         reduce='sum')
             ret_dict.update({'depth': depth})
 
+        profiler.toc('composite', t_prof)
+        profiler.record_samples_per_ray(ray_id, N)
         return ret_dict
 
 
@@ -10,6 +10,8 @@ import torch.nn.functional as F
 from torch_scatter import segment_coo
 
 from . import grid
+from .profiler import profiler
+from .ray_utils import get_rays, ndc_rays, get_rays_of_a_view, get_rays_of_views
 from torch.utils.cpp_extension import load
 parent_dir = os.path.dirname(os.path.abspath(__file__))
 render_utils_cuda = load(
@@ -118,12 +120,7 @@ class DirectVoxGO(torch.nn.Module):
             mask_cache = grid.MaskGrid(
                     path=mask_cache_path,
                     mask_cache_thres=mask_cache_thres).to(self.xyz_min.device)
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], mask_cache_world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], mask_cache_world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], mask_cache_world_size[2]),
-            ), -1)
-            mask = mask_cache(self_grid_xyz)
+            mask = grid.sample_on_lattice(mask_cache, self.xyz_min, self.xyz_max, mask_cache_world_size)
         else:
             mask = torch.ones(list(mask_cache_world_size), dtype=torch.bool)
         self.mask_cache = grid.MaskGrid(
@@ -164,16 +161,10 @@ class DirectVoxGO(torch.nn.Module):
     @torch.no_grad()
     def maskout_near_cam_vox(self, cam_o, near_clip):
         # maskout grid points that between cameras and their near planes
-        self_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-        ), -1)
-        nearest_dist = torch.stack([
-            (self_grid_xyz.unsqueeze(-2) - co).pow(2).sum(-1).sqrt().amin(-1)
-            for co in cam_o.split(100)  # for memory saving
-        ]).amin(0)
-        self.density.grid[nearest_dist[None,None] <= near_clip] = -100
+        # only the voxels within near_clip of some camera are visited
+        near_ind = grid.lattice_within_radius(
+                cam_o.to(self.xyz_min), near_clip, self.xyz_min, self.xyz_max, self.world_size)
+        self.density.grid.view(-1)[near_ind] = -100
 
     @torch.no_grad()
     def scale_volume_grid(self, num_voxels):
@@ -186,31 +177,28 @@ class DirectVoxGO(torch.nn.Module):
         self.k0.scale_volume_grid(self.world_size)
 
         if np.prod(self.world_size.tolist()) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-            ), -1)
+            self_mask = grid.sample_on_lattice(self.mask_cache, self.xyz_min, self.xyz_max, self.world_size)
             self_alpha = F.max_pool3d(self.activate_density(self.density.get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0]
             self.mask_cache = grid.MaskGrid(
-                    path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
+                    path=None, mask=self_mask & (self_alpha>self.fast_color_thres),
                     xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
         print('dvgo: scale_volume_grid finish')
 
     @torch.no_grad()
     def update_occupancy_cache(self):
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
-        ), -1)
-        cache_grid_density = self.density(cache_grid_xyz)[None,None]
+        cache_grid_density = grid.sample_on_lattice(
+                self.density, self.xyz_min, self.xyz_max, self.mask_cache.mask.shape)[None,None]
         cache_grid_alpha = self.activate_density(cache_grid_density)
         cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
         self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
 
-    def voxel_count_views(self, rays_o_tr, rays_d_tr, imsz, near, far, stepsize, downrate=1, irregular_shape=False):
+    @torch.no_grad()
+    def voxel_count_views(self, rays_o_tr, rays_d_tr, imsz, near, far, stepsize, downrate=1, irregular_shape=False, count_device=None):
+        '''Count the number of views seeing each voxel.
+        The trilinear weights of the samples are scatter-added per image (see grid.trilinear_splat),
+        which runs on any device (e.g. count_device='cpu').
+        '''
         print('dvgo: voxel_count_views start')
         far = 1e9  # the given far can be too small while rays stop when hitting scene bbox
         eps_time = time.time()
@@ -218,40 +206,50 @@ class DirectVoxGO(torch.nn.Module):
         rng = torch.arange(N_samples)[None].float()
         count = torch.zeros_like(self.density.get_dense_grid())
 
-        device = rng.device
+        device = rng.device if count_device is None else torch.device(count_device)
+        rng = rng.to(device)
+        xyz_min = self.xyz_min.to(device)
+        xyz_max = self.xyz_max.to(device)
+        voxel_size = self.voxel_size.item()
         for rays_o_, rays_d_ in zip(rays_o_tr.split(imsz), rays_d_tr.split(imsz)):
-            ones = grid.DenseGrid(1, self.world_size, self.xyz_min, self.xyz_max)
+            hits = torch.zeros([count.numel()], device=device)
             if irregular_shape:
                 rays_o_ = rays_o_.split(10000)
                 rays_d_ = rays_d_.split(10000)
+            elif rays_o_.dim() == 2:
+                # the rays kept of a view (e.g., in_maskcache): subsample them at the same rate
+                rays_o_ = rays_o_[::downrate**2].split(10000)
+                rays_d_ = rays_d_[::downrate**2].split(10000)
             else:
                 rays_o_ = rays_o_[::downrate, ::downrate].to(device).flatten(0,-2).split(10000)
                 rays_d_ = rays_d_[::downrate, ::downrate].to(device).flatten(0,-2).split(10000)
 
             for rays_o, rays_d in zip(rays_o_, rays_d_):
+                rays_o = rays_o.to(device)
+                rays_d = rays_d.to(device)
                 vec = torch.where(rays_d==0, torch.full_like(rays_d, 1e-6), rays_d)
-                rate_a = (self.xyz_max - rays_o) / vec
-                rate_b = (self.xyz_min - rays_o) / vec
+                rate_a = (xyz_max - rays_o) / vec
+                rate_b = (xyz_min - rays_o) / vec
                 t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(min=near, max=far)
-                t_max = torch.maximum(rate_a, rate_b).amin(-1).clamp(min=near, max=far)
-                step = stepsize * self.voxel_size * rng
-                interpx = (t_min[...,None] + step/rays_d.norm(dim=-1,keepdim=True))
-                rays_pts = rays_o[...,None,:] + rays_d[...,None,:] * interpx[...,None]
-                ones(rays_pts).sum().backward()
-            with torch.no_grad():
-                count += (ones.grid.grad > 1)
+                # only a chunk of the samples on the rays is materialized at a time
+                for rng_ in rng.split(128, dim=-1):
+                    step = stepsize * voxel_size * rng_
+                    interpx = (t_min[...,None] + step/rays_d.norm(dim=-1,keepdim=True))
+                    rays_pts = rays_o[...,None,:] + rays_d[...,None,:] * interpx[...,None]
+                    grid.trilinear_splat(rays_pts.reshape(-1,3), xyz_min, xyz_max, self.world_size, hits)
+            count += (hits > 1).view(count.shape).to(count.device)
         eps_time = time.time() - eps_time
         print('dvgo: voxel_count_views finish (eps time:', eps_time, 'sec)')
 
         return count
 
-    def density_total_variation_add_grad(self, weight, dense_mode):
+    def density_total_variation_add_grad(self, weight, dense_mode, mask=None):
         w = weight * self.world_size.max() / 128
-        self.density.total_variation_add_grad(w, w, w, dense_mode)
+        self.density.total_variation_add_grad(w, w, w, dense_mode, mask)
 
-    def k0_total_variation_add_grad(self, weight, dense_mode):
+    def k0_total_variation_add_grad(self, weight, dense_mode, mask=None):
         w = weight * self.world_size.max() / 128
-        self.k0.total_variation_add_grad(w, w, w, dense_mode)
+        self.k0.total_variation_add_grad(w, w, w, dense_mode, mask)
 
     def activate_density(self, density, interval=None):
         interval = interval if interval is not None else self.voxel_size_ratio
@@ -307,11 +305,14 @@ class DirectVoxGO(torch.nn.Module):
         ret_dict = {}
         N = len(rays_o)
 
+        t_prof = profiler.tic()
         # sample points on rays
         ray_pts, ray_id, step_id = self.sample_ray(
                 rays_o=rays_o, rays_d=rays_d, **render_kwargs)
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
+        t_prof = profiler.toc('sample_ray', t_prof)
+
         # skip known free space
         if self.mask_cache is not None:
             mask = self.mask_cache(ray_pts)
@@ -322,6 +323,8 @@ class DirectVoxGO(torch.nn.Module):
         # self.fast_color_thres = 0.1
         render_fct = max(render_fct, self.fast_color_thres)
 
+        t_prof = profiler.toc('mask_cache', t_prof)
+
         # query for alpha w/ post-activation
         density = self.density(ray_pts)
         alpha = self.activate_density(density, interval)
@@ -333,6 +336,8 @@ class DirectVoxGO(torch.nn.Module):
             density = density[mask]
             alpha = alpha[mask]
 
+        t_prof = profiler.toc('density_alpha', t_prof)
+
         # compute accumulated transmittance
         weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
         if render_fct > 0:
@@ -345,31 +350,37 @@ class DirectVoxGO(torch.nn.Module):
             
             density = density[mask]
 
-        # query for color
-        if self.rgbnet_full_implicit:
-            pass
-        else:
-            k0 = self.k0(ray_pts)
+        t_prof = profiler.toc('alphas2weights', t_prof)
 
-        if self.rgbnet is None:
-            # no view-depend effect
-            rgb = torch.sigmoid(k0)
-        else:
-            # view-dependent color emission
-            if self.rgbnet_direct:
-                k0_view = k0
+        # query for color (autocast in the mixed precision mode; density and alpha stay in float32)
+        with torch.cuda.amp.autocast(enabled=render_kwargs.get('mixed_precision', False)):
+            if self.rgbnet_full_implicit:
+                pass
             else:
-                k0_view = k0[:, 3:]
-                k0_diffuse = k0[:, :3]
-            viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
-            viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
-            viewdirs_emb = viewdirs_emb.flatten(0,-2)[ray_id]
-            rgb_feat = torch.cat([k0_view, viewdirs_emb], -1)
-            rgb_logit = self.rgbnet(rgb_feat)
-            if self.rgbnet_direct:
-                rgb = torch.sigmoid(rgb_logit)
+                k0 = self.k0(ray_pts)
+
+            if self.rgbnet is None:
+                # no view-depend effect
+                rgb = torch.sigmoid(k0)
             else:
-                rgb = torch.sigmoid(rgb_logit + k0_diffuse)
+                # view-dependent color emission
+                if self.rgbnet_direct:
+                    k0_view = k0
+                else:
+                    k0_view = k0[:, 3:]
+                    k0_diffuse = k0[:, :3]
+                viewdirs_emb = (viewdirs.unsqueeze(-1) * self.viewfreq).flatten(-2)
+                viewdirs_emb = torch.cat([viewdirs, viewdirs_emb.sin(), viewdirs_emb.cos()], -1)
+                viewdirs_emb = viewdirs_emb.flatten(0,-2)[ray_id]
+                rgb_feat = torch.cat([k0_view, viewdirs_emb], -1)
+                rgb_logit = self.rgbnet(rgb_feat)
+                if self.rgbnet_direct:
+                    rgb = torch.sigmoid(rgb_logit)
+                else:
+                    rgb = torch.sigmoid(rgb_logit + k0_diffuse)
+        rgb = rgb.float()
+
+        t_prof = profiler.toc('k0_rgbnet', t_prof)
 
         # Ray marching
         rgb_marched = segment_coo(
@@ -399,6 +410,8 @@ class DirectVoxGO(torch.nn.Module):
                         reduce='sum')
             ret_dict.update({'depth': depth})
 
+        profiler.toc('composite', t_prof)
+        profiler.record_samples_per_ray(ray_id, N)
         return ret_dict
 
 
@@ -467,37 +480,6 @@ class Alphas2Weights(torch.autograd.Function):
 
 ''' Ray and batch
 '''
-def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
-    i, j = torch.meshgrid(
-        torch.linspace(0, W-1, W, device=c2w.device),
-        torch.linspace(0, H-1, H, device=c2w.device))  # pytorch's meshgrid has indexing='ij'
-    i = i.t().float()
-    j = j.t().float()
-    if mode == 'lefttop':
-        pass
-    elif mode == 'center':
-        i, j = i+0.5, j+0.5
-    elif mode == 'random':
-        i = i+torch.rand_like(i)
-        j = j+torch.rand_like(j)
-    else:
-        raise NotImplementedError
-
-    if flip_x:
-        i = i.flip((1,))
-    if flip_y:
-        j = j.flip((0,))
-    if inverse_y:
-        dirs = torch.stack([(i-K[0][2])/K[0][0], (j-K[1][2])/K[1][1], torch.ones_like(i)], -1)
-    else:
-        dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
-    # Rotate ray directions from camera frame to the world frame
-    rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
-    # Translate camera frame's origin to the world frame. It is the origin of all rays.
-    rays_o = c2w[:3,3].expand(rays_d.shape)
-    return rays_o, rays_d
-
-
 def get_rays_np(H, W, K, c2w):
     i, j = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32), indexing='xy')
     dirs = np.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -np.ones_like(i)], -1)
@@ -508,34 +490,6 @@ def get_rays_np(H, W, K, c2w):
     return rays_o, rays_d
 
 
-def ndc_rays(H, W, focal, near, rays_o, rays_d):
-    # Shift ray origins to near plane
-    t = -(near + rays_o[...,2]) / rays_d[...,2]
-    rays_o = rays_o + t[...,None] * rays_d
-
-    # Projection
-    o0 = -1./(W/(2.*focal)) * rays_o[...,0] / rays_o[...,2]
-    o1 = -1./(H/(2.*focal)) * rays_o[...,1] / rays_o[...,2]
-    o2 = 1. + 2. * near / rays_o[...,2]
-
-    d0 = -1./(W/(2.*focal)) * (rays_d[...,0]/rays_d[...,2] - rays_o[...,0]/rays_o[...,2])
-    d1 = -1./(H/(2.*focal)) * (rays_d[...,1]/rays_d[...,2] - rays_o[...,1]/rays_o[...,2])
-    d2 = -2. * near / rays_o[...,2]
-
-    rays_o = torch.stack([o0,o1,o2], -1)
-    rays_d = torch.stack([d0,d1,d2], -1)
-
-    return rays_o, rays_d
-
-
-def get_rays_of_a_view(H, W, K, c2w, ndc, inverse_y, flip_x, flip_y, mode='center'):
-    rays_o, rays_d = get_rays(H, W, K, c2w, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y, mode=mode)
-    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
-    if ndc:
-        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
-    return rays_o, rays_d, viewdirs
-
-
 @torch.no_grad()
 def get_training_rays(rgb_tr, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y):
     print('get_training_rays: start')
@@ -549,12 +503,14 @@ def get_training_rays(rgb_tr, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_
     rays_d_tr = torch.zeros([len(rgb_tr), H, W, 3], device=rgb_tr.device)
     viewdirs_tr = torch.zeros([len(rgb_tr), H, W, 3], device=rgb_tr.device)
     imsz = [1] * len(rgb_tr)
-    for i, c2w in enumerate(train_poses):
-        rays_o, rays_d, viewdirs = get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w, ndc=ndc, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
-        rays_o_tr[i].copy_(rays_o.to(rgb_tr.device))
-        rays_d_tr[i].copy_(rays_d.to(rgb_tr.device))
-        viewdirs_tr[i].copy_(viewdirs.to(rgb_tr.device))
+    # the views share the camera model: rotate the cached directions of a group of views at once
+    CHUNK = 16
+    for i in range(0, len(train_poses), CHUNK):
+        rays_o, rays_d, viewdirs = get_rays_of_views(
+                H=H, W=W, K=K, c2ws=train_poses[i:i+CHUNK], ndc=ndc, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+        rays_o_tr[i:i+CHUNK].copy_(rays_o)
+        rays_d_tr[i:i+CHUNK].copy_(rays_d)
+        viewdirs_tr[i:i+CHUNK].copy_(viewdirs)
         del rays_o, rays_d, viewdirs
     eps_time = time.time() - eps_time
     print('get_training_rays: finish (eps time:', eps_time, 'sec)')
@@ -568,11 +524,11 @@ def get_training_rays_flatten(rgb_tr_ori, train_poses, HW, Ks, ndc, inverse_y, f
     eps_time = time.time()
     DEVICE = rgb_tr_ori[0].device
     N = sum(im.shape[0] * im.shape[1] for im in rgb_tr_ori)
-    rgb_tr = torch.zeros([N,3], device=DEVICE)
+    rgb_tr = torch.zeros([N,3], dtype=rgb_tr_ori[0].dtype, device=DEVICE)
 
-    rays_o_tr = torch.zeros_like(rgb_tr)
-    rays_d_tr = torch.zeros_like(rgb_tr)
-    viewdirs_tr = torch.zeros_like(rgb_tr)
+    rays_o_tr = torch.zeros([N,3], device=DEVICE)
+    rays_d_tr = torch.zeros_like(rays_o_tr)
+    viewdirs_tr = torch.zeros_like(rays_o_tr)
     imsz = []
     top = 0
 
@@ -605,11 +561,11 @@ def get_training_rays_in_maskcache_sampling(rgb_tr_ori, train_poses, HW, Ks, ndc
     eps_time = time.time()
     N = sum(im.shape[0] * im.shape[1] for im in rgb_tr_ori)
 
-    rgb_tr = torch.zeros([N,3], device=DEVICE)
+    rgb_tr = torch.zeros([N,3], dtype=rgb_tr_ori[0].dtype, device=DEVICE)
 
-    rays_o_tr = torch.zeros_like(rgb_tr)
-    rays_d_tr = torch.zeros_like(rgb_tr)
-    viewdirs_tr = torch.zeros_like(rgb_tr)
+    rays_o_tr = torch.zeros([N,3], device=DEVICE)
+    rays_d_tr = torch.zeros_like(rays_o_tr)
+    viewdirs_tr = torch.zeros_like(rays_o_tr)
     imsz = []
     top = 0
 
@@ -641,11 +597,228 @@ def get_training_rays_in_maskcache_sampling(rgb_tr_ori, train_poses, HW, Ks, ndc
     return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz
 
 
-def batch_indices_generator(N, BS):
-    # torch.randperm on cuda produce incorrect results in my machine
-    idx, top = torch.LongTensor(np.random.permutation(N)), 0
+class CompactTrainingRays:
+    '''Training rays stored as uint8 rgb and pixel indices only (3 or 7 bytes per ray).
+    The origins and directions are regenerated from the per-view pose and intrinsics when gathered.
+    '''
+    def __init__(self, rgb_tr, pix_id, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y):
+        device = rgb_tr.device
+        self.rgb_tr = rgb_tr
+        self.pix_id = pix_id  # None if all the pixels are kept
+        self.HW = torch.LongTensor(np.array(HW)).to(device)
+        self.Ks = torch.Tensor(np.array(Ks)).to(device)
+        self.poses = torch.as_tensor(train_poses)[:,:3,:4].float().to(device)
+        self.pix_offsets = torch.cat([torch.zeros(1, device=device), self.HW.prod(-1).cumsum(0)]).long()
+        self.ndc = ndc
+        self.inverse_y = inverse_y
+        self.flip_x = flip_x
+        self.flip_y = flip_y
+        if pix_id is None:
+            self.imsz = self.HW.prod(-1).tolist()
+        else:
+            view = torch.searchsorted(self.pix_offsets, pix_id.long(), right=True) - 1
+            self.imsz = torch.bincount(view, minlength=len(self.HW)).tolist()
+
+    def __len__(self):
+        return len(self.rgb_tr)
+
+    def get_rays(self, sel_i):
+        '''Regenerate rays_o, rays_d, viewdirs of the selected rays.
+        It follows get_rays_of_a_view with mode='center'.
+        '''
+        pix = sel_i if self.pix_id is None else self.pix_id[sel_i].long()
+        view = torch.searchsorted(self.pix_offsets, pix, right=True) - 1
+        pix = pix - self.pix_offsets[view]
+        H, W = self.HW[view,0], self.HW[view,1]
+        K = self.Ks[view]
+        c2w = self.poses[view]
+        i = (pix % W).float() + 0.5
+        j = (pix // W).float() + 0.5
+        if self.flip_x:
+            i = W - i
+        if self.flip_y:
+            j = H - j
+        if self.inverse_y:
+            dirs = torch.stack([(i-K[:,0,2])/K[:,0,0], (j-K[:,1,2])/K[:,1,1], torch.ones_like(i)], -1)
+        else:
+            dirs = torch.stack([(i-K[:,0,2])/K[:,0,0], -(j-K[:,1,2])/K[:,1,1], -torch.ones_like(i)], -1)
+        rays_d = torch.sum(dirs[..., None, :] * c2w[:,:3,:3], -1)
+        rays_o = c2w[:,:3,3]
+        viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+        if self.ndc:
+            rays_o, rays_d = ndc_rays(H, W, K[:,0,0], 1., rays_o, rays_d)
+        return rays_o, rays_d, viewdirs
+
+    def gather(self, sel_i):
+        '''Return the normalized rgb, rays_o, rays_d, viewdirs of the selected rays'''
+        sel_i = sel_i.to(self.rgb_tr.device)
+        target = self.rgb_tr[sel_i].float() / 255
+        rays_o, rays_d, viewdirs = self.get_rays(sel_i)
+        return target, rays_o, rays_d, viewdirs
+
+    def view_rays(self, key):
+        '''A stand-in of the rays_o_tr (key='rays_o') or rays_d_tr (key='rays_d') tensor
+        whose split(imsz) yields the rays view by view: [H, W, 3] if all the pixels are kept, [n, 3] otherwise.
+        '''
+        return _CompactViewRays(self, 0 if key == 'rays_o' else 1)
+
+
+class _CompactViewRays:
+    def __init__(self, rays, i_out):
+        self.rays = rays
+        self.i_out = i_out
+
+    def split(self, imsz):
+        top = 0
+        for v, n in enumerate(imsz):
+            sel_i = torch.arange(top, top+n, device=self.rays.rgb_tr.device)
+            rays = self.rays.get_rays(sel_i)[self.i_out]
+            if self.rays.pix_id is None:
+                rays = rays.view(int(self.rays.HW[v,0]), int(self.rays.HW[v,1]), 3)
+            yield rays
+            top += n
+
+
+@torch.no_grad()
+def get_training_rays_compact(rgb_tr_ori, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y, model=None, render_kwargs=None):
+    '''Build CompactTrainingRays. If model is given, only the rays hitting its coarse geometry are kept
+    (as get_training_rays_in_maskcache_sampling).
+    '''
+    print('get_training_rays_compact: start')
+    assert len(rgb_tr_ori) == len(train_poses) and len(rgb_tr_ori) == len(Ks) and len(rgb_tr_ori) == len(HW)
+    CHUNK = 64
+    DEVICE = rgb_tr_ori[0].device
+    eps_time = time.time()
+    N = sum(im.shape[0] * im.shape[1] for im in rgb_tr_ori)
+
+    rgb_tr = torch.zeros([N,3], dtype=torch.uint8, device=DEVICE)
+    pix_id = None if model is None else torch.zeros([N], dtype=torch.int32 if N < 2**31 else torch.long, device=DEVICE)
+    top = 0
+    offset = 0
+    for c2w, img, (H, W), K in zip(train_poses, rgb_tr_ori, HW, Ks):
+        assert img.shape[:2] == (H, W)
+        if img.dtype != torch.uint8:
+            img = (img * 255).round().clamp(0, 255).to(torch.uint8)
+        img = img.flatten(0,1)
+        if model is None:
+            n = H * W
+            rgb_tr[top:top+n].copy_(img)
+        else:
+            rays_o, rays_d, viewdirs = get_rays_of_a_view(
+                    H=H, W=W, K=K, c2w=c2w, ndc=ndc,
+                    inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+            mask = torch.empty([H, W], device=DEVICE, dtype=torch.bool)
+            for i in range(0, H, CHUNK):
+                mask[i:i+CHUNK] = model.hit_coarse_geo(
+                        rays_o=rays_o[i:i+CHUNK], rays_d=rays_d[i:i+CHUNK], **render_kwargs).to(DEVICE)
+            idx = mask.flatten().nonzero()[:,0]
+            n = len(idx)
+            rgb_tr[top:top+n].copy_(img[idx])
+            pix_id[top:top+n].copy_(idx + offset)
+        top += n
+        offset += H * W
+
+    print('get_training_rays_compact: ratio', top / N)
+    rays = CompactTrainingRays(
+            rgb_tr[:top].clone() if top < N else rgb_tr, None if pix_id is None else pix_id[:top].clone(),
+            train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y)
+    eps_time = time.time() - eps_time
+    print('get_training_rays_compact: finish (eps time:', eps_time, 'sec)')
+    return rays
+
+
+def _random_round_keys(n_rounds=4, rng=None):
+    rng = np.random if rng is None else rng
+    return [int(k) for k in rng.randint(0, 2**31, size=n_rounds)]
+
+
+def keyed_permutation(x, N, keys):
+    '''Map the positions x (LongTensor in [0, N)) to their entries in a pseudo-random permutation of [0, N).
+    The permutation is a balanced Feistel network keyed by the round keys (ints or LongTensors broadcastable to x)
+    on the smallest even number of bits covering N, restricted to [0, N) by cycle walking.
+    Nothing of size N is materialized.
+    '''
+    half = max(1, (int(N-1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    def encrypt(x, keys):
+        l, r = x >> half, x & mask
+        for key in keys:
+            f = ((r ^ key) * 0x45d9f3b) & 0x7fffffff
+            f = ((f ^ (f >> 16)) * 0x45d9f3b) & 0x7fffffff
+            l, r = r, l ^ (f & mask)
+        return (l << half) | r
+    x = encrypt(x, keys)
+    out = x >= N
+    while out.any():
+        x[out] = encrypt(x[out], [k[out] if torch.is_tensor(k) else k for k in keys])
+        out = x >= N
+    return x
+
+
+def batch_indices_generator(N, BS, imsz=None, rng=None):
+    '''Yield batches of BS indices in [0, N) where each index is drawn once per epoch.
+    The keys of the permutations are drawn from rng (a np.random.RandomState; the global numpy RNG if None).
+    The permutation of each epoch is generated lazily by keyed_permutation (O(BS) memory).
+    If imsz (the number of rays of each view) is given, the rays are stratified over the views:
+    every round takes one ray from each view in a random order.
+    The indices are CPU tensors (whatever the default tensor type); move them to the device of the rays.
+    '''
+    if imsz is None:
+        keys, top = _random_round_keys(rng=rng), 0
+        while True:
+            if top + BS > N:
+                keys, top = _random_round_keys(rng=rng), 0
+            yield keyed_permutation(torch.arange(top, top+BS, device='cpu'), N, keys)
+            top += BS
+
+    imsz = torch.LongTensor([int(n) for n in imsz])
+    assert imsz.sum() == N
+    offsets = torch.cat([torch.zeros(1, dtype=torch.long, device='cpu'), imsz.cumsum(0)[:-1]])
+    V, n_max = len(imsz), int(imsz.max())
     while True:
-        if top + BS > N:
-            idx, top = torch.LongTensor(np.random.permutation(N)), 0
-        yield idx[top:top+BS]
-        top += BS
\ No newline at end of file
+        keys, view_keys = _random_round_keys(rng=rng), _random_round_keys(rng=rng)
+        buf, n_buf = [], 0
+        for top in range(0, V * n_max, 2 * BS):
+            p = torch.arange(top, min(top + 2*BS, V * n_max), device='cpu')
+            v = keyed_permutation(p % V, V, view_keys)
+            # a permutation of [0, n_max) per view; the entries beyond the view size are skipped
+            local = keyed_permutation(p // V, n_max, [(k + v * 0x9e3779b1) & 0x7fffffff for k in keys])
+            valid = local < imsz[v]
+            buf.append(offsets[v[valid]] + local[valid])
+            n_buf += int(valid.sum())
+            while n_buf >= BS:
+                idx = torch.cat(buf)
+                yield idx[:BS]
+                buf, n_buf = [idx[BS:]], n_buf - BS
+
+
+if __name__ == '__main__':
+    print("Testing the keyed permutation.")
+    for N in [1, 7, 1000, 12345]:
+        perm = keyed_permutation(torch.arange(N), N, _random_round_keys())
+        assert (perm.sort()[0] == torch.arange(N)).all()
+    imsz = [5, 300, 17, 1000]
+    gen = batch_indices_generator(sum(imsz), 8, imsz)
+    idx = torch.cat([next(gen) for _ in range(sum(imsz) // 8)])
+    assert len(idx.unique()) == len(idx)
+    if torch.cuda.is_available():
+        # run.py sets a cuda default tensor type; the indices must stay on cpu
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+        for imsz_ in [None, imsz]:
+            gen = batch_indices_generator(sum(imsz), 8, imsz_)
+            assert all(next(gen).device.type == 'cpu' for _ in range(10))
+        torch.set_default_tensor_type('torch.FloatTensor')
+
+    print("Testing the throughput of the batch index samplers.")
+    BS = 8192
+    for N in [10**6, 10**7, 10**8, 10**9]:
+        if N <= 10**8:
+            start_time = time.time()
+            idx = torch.LongTensor(np.random.permutation(N))
+            print(f"Time taken by np.random.permutation for N={N:.0e}", time.time() - start_time)
+            del idx
+        start_time = time.time()
+        gen = batch_indices_generator(N, BS)
+        for _ in range(1000):
+            next(gen)
+        print(f"Time taken by 1000 keyed batches for N={N:.0e}", time.time() - start_time)
@@ -44,6 +44,8 @@ class DenseGrid(nn.Module):
         self.register_buffer('xyz_min', torch.Tensor(xyz_min))
         self.register_buffer('xyz_max', torch.Tensor(xyz_max))
         self.grid = nn.Parameter(torch.zeros([1, channels, *world_size]))
+        self.touched = None
+        self.touched_all = False
         print(self.xyz_min, self.xyz_max, self.world_size)
 
     def forward(self, xyz):
@@ -51,6 +53,8 @@ class DenseGrid(nn.Module):
         xyz: global coordinates to query
         '''
         shape = xyz.shape[:-1]
+        if self.touched is not None and torch.is_grad_enabled() and self.grid.requires_grad:
+            mark_touched_corners(xyz.reshape(-1,3), self.xyz_min, self.xyz_max, self.grid.shape[2:], self.touched)
         xyz = xyz.reshape(1,1,1,-1,3)
         ind_norm = ((xyz - self.xyz_min) / (self.xyz_max - self.xyz_min)).flip((-1,)) * 2 - 1
         out = F.grid_sample(self.grid, ind_norm, mode='bilinear', align_corners=True)
@@ -65,11 +69,42 @@ class DenseGrid(nn.Module):
         else:
             self.grid = nn.Parameter(
                 F.interpolate(self.grid.data, size=tuple(new_world_size), mode='trilinear', align_corners=True))
+        if self.touched is not None:
+            self.enable_touched_recording()
 
-    def total_variation_add_grad(self, wx, wy, wz, dense_mode):
-        '''Add gradients by total variation loss in-place'''
-        total_variation_cuda.total_variation_add_grad(
-            self.grid, self.grid.grad, wx, wy, wz, dense_mode)
+    def enable_touched_recording(self, enable=True):
+        '''Record the voxels interpolated by the forward passes with grad enabled,
+        so that the optimizer can update only them (see MaskedAdam.set_sparse_grid).
+        '''
+        self.touched = torch.zeros([self.grid.shape[2:].numel()], dtype=torch.bool, device=self.grid.device) if enable else None
+        self.touched_all = False
+
+    @torch.no_grad()
+    def pop_touched(self):
+        '''Return the flattened indices of the voxels touched since the last call and clear the record.
+        Return None if gradients may have been added outside the record (e.g., dense total variation).
+        '''
+        if self.touched_all:
+            self.touched.zero_()
+            self.touched_all = False
+            return None
+        idx = self.touched.nonzero()[:,0]
+        self.touched[idx] = False
+        return idx
+
+    def total_variation_add_grad(self, wx, wy, wz, dense_mode, mask=None):
+        '''Add gradients by total variation loss in-place.
+        If mask ([X, Y, Z] bool) is given or the grid is on CPU, only the active voxels are visited
+        by the PyTorch implementation (see total_variation_add_grad_sparse).
+        '''
+        if dense_mode and self.touched is not None:
+            self.touched_all = True
+        if mask is None and self.grid.is_cuda:
+            total_variation_cuda.total_variation_add_grad(
+                self.grid, self.grid.grad, wx, wy, wz, dense_mode)
+        else:
+            total_variation_add_grad_sparse(
+                self.grid, self.grid.grad, wx, wy, wz, dense_mode, mask)
 
     def get_dense_grid(self):
         return self.grid
@@ -82,6 +117,31 @@ class DenseGrid(nn.Module):
     def extra_repr(self):
         return f'channels={self.channels}, world_size={self.world_size.tolist()}'
 
+@torch.no_grad()
+def total_variation_add_grad_sparse(param, grad, wx, wy, wz, dense_mode, mask=None):
+    '''PyTorch counterpart of total_variation_cuda which only visits the active voxels.
+    A voxel is active if it is inside mask (when given) and, unless dense_mode, has non-zero gradient.
+    @param, grad: [1, C, X, Y, Z] grid and its gradient (updated in-place).
+    '''
+    C, X, Y, Z = param.shape[1:]
+    param = param.view(C, -1)
+    grad = grad.view(C, -1)
+    active = torch.ones([X*Y*Z], dtype=torch.bool, device=param.device) if mask is None else mask.flatten().to(param.device)
+    if not dense_mode:
+        active = active & (grad != 0).any(0)
+    flat = active.nonzero()[:,0]
+    ijk = torch.stack([flat // (Y*Z), flat // Z % Y, flat % Z], -1)
+    center = param[:, flat]
+    grad_to_add = torch.zeros_like(center)
+    for dim, w, stride, size in [(0, wx, Y*Z, X), (1, wy, Z, Y), (2, wz, 1, Z)]:
+        for sign in [-1, 1]:
+            valid = ((ijk[:,dim] + sign >= 0) & (ijk[:,dim] + sign < size)).to(center)
+            neighbor = param[:, (flat + sign * stride).clamp(0, X*Y*Z-1)]
+            grad_to_add += w * valid * (center - neighbor).clamp(-1, 1)
+    if not dense_mode:
+        grad_to_add *= (grad[:, flat] != 0)
+    grad.index_add_(1, flat, grad_to_add / 6)
+
 # ''' Utilize autograd for 3D mask generation
 # '''
 # class ConstrainedGrad(torch.autograd.Function):
@@ -209,8 +269,10 @@ class TensoRFGrid(nn.Module):
         self.y_vec = nn.Parameter(F.interpolate(self.y_vec.data, size=[Y,1], mode='bilinear', align_corners=True))
         self.z_vec = nn.Parameter(F.interpolate(self.z_vec.data, size=[Z,1], mode='bilinear', align_corners=True))
 
-    def total_variation_add_grad(self, wx, wy, wz, dense_mode):
-        '''Add gradients by total variation loss in-place'''
+    def total_variation_add_grad(self, wx, wy, wz, dense_mode, mask=None):
+        '''Add gradients by total variation loss in-place.
+        The factorized components are shared by all the voxels, so mask is not used.
+        '''
         loss = wx * F.smooth_l1_loss(self.xy_plane[:,:,1:], self.xy_plane[:,:,:-1], reduction='sum') +\
                wy * F.smooth_l1_loss(self.xy_plane[:,:,:,1:], self.xy_plane[:,:,:,:-1], reduction='sum') +\
                wx * F.smooth_l1_loss(self.xz_plane[:,:,1:], self.xz_plane[:,:,:-1], reduction='sum') +\
@@ -310,6 +372,159 @@ class MaskGrid(nn.Module):
         return f'mask.shape=list(self.mask.shape)'
 
 
+''' Voxel lattice utils
+Query values at the voxel centers of a [X, Y, Z] lattice without materializing
+the full [X, Y, Z, 3] coordinate tensor.
+'''
+def voxel_lattice(xyz_min, xyz_max, world_size, chunk=16):
+    '''Lazily iterate the voxel centers of the lattice spanning xyz_min..xyz_max.
+    Yields (i_start, i_end, xyz) where xyz is the [i_end-i_start, Y, Z, 3] slab of coordinates.
+    '''
+    X, Y, Z = [int(s) for s in world_size]
+    xs = torch.linspace(xyz_min[0], xyz_max[0], X)
+    ys = torch.linspace(xyz_min[1], xyz_max[1], Y)
+    zs = torch.linspace(xyz_min[2], xyz_max[2], Z)
+    for i in range(0, X, chunk):
+        x = xs[i:i+chunk]
+        yield i, i+len(x), torch.stack(torch.meshgrid(x, ys, zs), -1)
+
+
+def _lattice_coincides(field, xyz_min, xyz_max):
+    '''Check whether the lattice equals the grid points of the given field'''
+    xyz_min = torch.as_tensor(xyz_min, dtype=torch.float32).to(field.xyz_min.device)
+    xyz_max = torch.as_tensor(xyz_max, dtype=torch.float32).to(field.xyz_min.device)
+    return torch.allclose(field.xyz_min, xyz_min) and torch.allclose(field.xyz_max, xyz_max)
+
+
+@torch.no_grad()
+def sample_on_lattice(field, xyz_min, xyz_max, world_size, chunk=16):
+    '''Evaluate field (a DenseGrid, TensoRFGrid, MaskGrid or any callable on [..., 3] points)
+    at every voxel center of the lattice spanning xyz_min..xyz_max.
+    If the lattice coincides with the grid of the field, the values are read directly.
+    Otherwise the points are generated and queried slab by slab.
+    Output is in the same format as field(xyz) for xyz in shape [X, Y, Z, 3].
+    '''
+    world_size = [int(s) for s in world_size]
+    if isinstance(field, DenseGrid):
+        if list(field.grid.shape[2:]) == world_size and _lattice_coincides(field, xyz_min, xyz_max):
+            out = field.grid[0].permute(1,2,3,0)
+            return out.squeeze(-1) if field.channels == 1 else out
+    elif isinstance(field, TensoRFGrid):
+        X, Y = field.xy_plane.shape[2:]
+        Z = field.z_vec.shape[2]
+        if [X, Y, Z] == world_size and _lattice_coincides(field, xyz_min, xyz_max):
+            out = field.get_dense_grid()[0].permute(1,2,3,0)
+            return out.squeeze(-1) if field.channels == 1 else out
+    elif isinstance(field, MaskGrid):
+        if list(field.mask.shape) == world_size:
+            xyz_min = torch.as_tensor(xyz_min, dtype=torch.float32).to(field.mask.device)
+            xyz_max = torch.as_tensor(xyz_max, dtype=torch.float32).to(field.mask.device)
+            scale = (torch.Tensor(world_size).to(field.mask.device) - 1) / (xyz_max - xyz_min)
+            if torch.allclose(field.xyz2ijk_scale, scale) and torch.allclose(field.xyz2ijk_shift, -xyz_min * scale):
+                return field.mask
+
+    out = None
+    for i_start, i_end, xyz in voxel_lattice(xyz_min, xyz_max, world_size, chunk=chunk):
+        val = field(xyz)
+        if out is None:
+            out = torch.empty([*world_size, *val.shape[3:]], dtype=val.dtype, device=val.device)
+        out[i_start:i_end] = val
+    return out
+
+
+def lattice_bbox(mask, xyz_min, xyz_max):
+    '''The tightest bbox covering the True voxel centers of a [X, Y, Z] mask
+    on the lattice spanning xyz_min..xyz_max.
+    '''
+    ijk_min, ijk_max = [], []
+    for dim in range(3):
+        active = mask.any(dim=[d for d in range(3) if d != dim]).nonzero()[:,0]
+        ijk_min.append(active.min())
+        ijk_max.append(active.max())
+    interval = (xyz_max - xyz_min) / (torch.Tensor(list(mask.shape)).to(xyz_min.device) - 1)
+    active_xyz_min = xyz_min + torch.stack(ijk_min).to(interval) * interval
+    active_xyz_max = xyz_min + torch.stack(ijk_max).to(interval) * interval
+    return active_xyz_min, active_xyz_max
+
+
+@torch.no_grad()
+def lattice_within_radius(points, radius, xyz_min, xyz_max, world_size, max_query=2**24):
+    '''Flattened indices of the voxel centers on the lattice spanning xyz_min..xyz_max
+    which are within radius of any of the given [N, 3] points.
+    Only the voxels inside the bounding cube of each ball are visited,
+    unless the cubes of all the balls cover more lattice points than the whole lattice.
+    '''
+    device = points.device
+    size = torch.LongTensor([int(s) for s in world_size]).to(device)
+    xyz_min = torch.as_tensor(xyz_min, dtype=torch.float32).to(device)
+    xyz_max = torch.as_tensor(xyz_max, dtype=torch.float32).to(device)
+    interval = (xyz_max - xyz_min) / (size - 1)
+    # every ball spans the same number of lattice points along each axis (at most the lattice size)
+    n_side = min(int((2 * radius / interval).floor().max().item()) + 2, int(size.max()))
+    if n_side**3 * len(points) > size.prod().item():
+        # large balls: test every voxel center against the points instead
+        indices = [torch.zeros([0], dtype=torch.long, device=device)]
+        for i_start, i_end, xyz in voxel_lattice(xyz_min, xyz_max, world_size):
+            xyz = xyz.to(device).reshape(-1, 3)
+            nearest_dist = torch.stack([
+                (xyz.unsqueeze(-2) - pts).pow(2).sum(-1).sqrt().amin(-1)
+                for pts in points.split(100)  # for memory saving
+            ]).amin(0)
+            indices.append(i_start * size[1] * size[2] + (nearest_dist <= radius).nonzero()[:,0])
+        return torch.cat(indices)
+    offsets = torch.stack(torch.meshgrid(*[torch.arange(n_side, device=device)]*3), -1).reshape(-1, 3)
+    indices = [torch.zeros([0], dtype=torch.long, device=device)]
+    for pts in points.split(max(1, max_query // len(offsets))):
+        ijk = ((pts - radius - xyz_min) / interval).ceil().long()[:,None] + offsets
+        xyz = xyz_min + ijk * interval
+        near = ((xyz - pts[:,None]).pow(2).sum(-1).sqrt() <= radius) & ((ijk >= 0) & (ijk < size)).all(-1)
+        ijk = ijk[near]
+        indices.append((ijk[:,0] * size[1] + ijk[:,1]) * size[2] + ijk[:,2])
+    return torch.cat(indices).unique()
+
+
+def _trilinear_corners(xyz, xyz_min, xyz_max, world_size, device):
+    '''Yield the flattened indices and the trilinear weights of the 8 in-bound corners of the query points'''
+    size = torch.LongTensor([int(s) for s in world_size]).to(device)
+    xyz_min = xyz_min.to(device)
+    xyz_max = xyz_max.to(device)
+    ijk = (xyz.to(device) - xyz_min) / (xyz_max - xyz_min) * (size - 1)
+    ijk0 = ijk.floor()
+    frac = ijk - ijk0
+    ijk0 = ijk0.long()
+    offsets = torch.LongTensor([[dx, dy, dz] for dx in (0, 1) for dy in (0, 1) for dz in (0, 1)]).to(device)
+    for offset in offsets:
+        idx = ijk0 + offset
+        w = torch.where(offset.bool(), frac, 1 - frac).prod(-1)
+        # corners outside the grid are zero-padded in grid_sample
+        valid = ((idx >= 0) & (idx < size)).all(-1)
+        idx = idx[valid]
+        yield (idx[:,0] * size[1] + idx[:,1]) * size[2] + idx[:,2], w[valid]
+
+
+@torch.no_grad()
+def trilinear_splat(xyz, xyz_min, xyz_max, world_size, out):
+    '''Scatter-add the trilinear weights of the query points onto the grid corners.
+    It equals the gradient of DenseGrid(xyz).sum() w.r.t. the grid without building an autograd graph.
+    @xyz: [N, 3] global coordinates.
+    @out: [X*Y*Z] flattened accumulator, updated in-place on its own device.
+    '''
+    for idx, w in _trilinear_corners(xyz, xyz_min, xyz_max, world_size, out.device):
+        out.index_add_(0, idx, w)
+    return out
+
+
+@torch.no_grad()
+def mark_touched_corners(xyz, xyz_min, xyz_max, world_size, touched):
+    '''Flag the grid corners interpolated by the query points.
+    @xyz: [N, 3] global coordinates.
+    @touched: [X*Y*Z] flattened bool flags, updated in-place.
+    '''
+    for idx, _ in _trilinear_corners(xyz.detach(), xyz_min, xyz_max, world_size, touched.device):
+        touched[idx] = True
+    return touched
+
+
 def get_dense_grid_batch_processing(tensorf: TensoRFGrid):
     '''
     Expects the tensorf to be already on device and processes it on device batchwise.
@@ -379,4 +594,55 @@ if __name__ == "__main__":
         start_time = time.time()
         grid = get_dense_grid_batch_processing(tensorf)
         print("Time taken to reconstruct the grid", time.time() - start_time)
+        del grid, tensorf
+
+        torch.cuda.empty_cache()
+
+        print("Testing the peak memory of querying a 256^3 lattice.")
+        dense = DenseGrid(1, torch.tensor([256, 256, 256]), torch.zeros(3), torch.ones(3)).cuda()
+        dense.grid.data.normal_()
+        torch.cuda.reset_peak_memory_stats()
+        xyz = torch.stack(torch.meshgrid(
+            torch.linspace(0, 1, 256, device='cuda'),
+            torch.linspace(0, 1, 256, device='cuda'),
+            torch.linspace(0, 1, 256, device='cuda'),
+        ), -1)
+        val1 = dense(xyz)
+        print("Peak memory of the meshgrid query (MB)", torch.cuda.max_memory_allocated() / 2**20)
+        del xyz
+        torch.cuda.reset_peak_memory_stats()
+        val2 = sample_on_lattice(dense, dense.xyz_min, dense.xyz_max, [256, 256, 256])
+        print("Peak memory of the direct read (MB)", torch.cuda.max_memory_allocated() / 2**20)
+        torch.cuda.reset_peak_memory_stats()
+        val3 = sample_on_lattice(dense.forward, dense.xyz_min, dense.xyz_max, [256, 256, 256])
+        print("Peak memory of the chunked query (MB)", torch.cuda.max_memory_allocated() / 2**20)
+        assert val1.isclose(val2, atol=1e-5).all() and val1.isclose(val3, atol=1e-5).all()
+        del dense, val1, val2, val3
+
+        torch.cuda.empty_cache()
+
+        print("Testing the throughput of dense and sparse total variation.")
+        for res in [160, 320]:
+            dense = DenseGrid(1, torch.tensor([res, res, res]), torch.zeros(3), torch.ones(3)).cuda()
+            dense.grid.data.normal_()
+            dense.grid.grad = torch.zeros_like(dense.grid)
+            mask = torch.zeros([res, res, res], dtype=torch.bool, device='cuda')
+            mask[res//4:-res//4, res//4:-res//4, res//4:-res//4] = True  # typical occupied portion
+            grad1 = dense.grid.grad.clone()
+            total_variation_add_grad_sparse(dense.grid, grad1, 1, 1, 1, True, mask)
+            grad2 = dense.grid.grad.clone()
+            total_variation_cuda.total_variation_add_grad(dense.grid, grad2, 1, 1, 1, True)
+            assert grad1[:,:,mask].isclose(grad2[:,:,mask], atol=1e-5).all()
+            for name, tv_fn in [
+                    ('dense', lambda: dense.total_variation_add_grad(1, 1, 1, True)),
+                    ('sparse', lambda: dense.total_variation_add_grad(1, 1, 1, True, mask))]:
+                tv_fn()
+                torch.cuda.synchronize()
+                start_time = time.time()
+                for _ in range(100):
+                    tv_fn()
+                torch.cuda.synchronize()
+                print(f"Time taken by {name} total variation at {res}^3 (ms/step)", (time.time() - start_time) * 10)
+            del dense, mask, grad1, grad2
+            torch.cuda.empty_cache()
         print("Program over.")
\ No newline at end of file
@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import imageio
+
+
+def default_num_workers():
+    return min(32, os.cpu_count() or 1)
+
+
+def read_images(paths, dtype=np.float32, channels=None, imread=imageio.imread, num_workers=None, verbose=True):
+    '''Decode images with a thread pool straight into a preallocated [N, H, W, C] array.
+    The order follows paths and all the images must have the same shape as the first one.
+    @dtype:       np.uint8 keeps the raw values; a float dtype is scaled to [0, 1].
+    @channels:    keep only the first channels (e.g., 3 to drop alpha); all the channels if None.
+    @imread:      decoder of a single image path.
+    @num_workers: number of decoding threads (1 for decoding sequentially).
+    '''
+    paths = list(paths)
+    if len(paths) == 0:
+        raise ValueError('read_images: no image to read')
+    eps_time = time.time()
+    first = _as_hwc(imread(paths[0]))
+    if channels is not None:
+        first = first[..., :channels]
+    out = np.empty([len(paths), *first.shape], dtype=dtype)
+    scale = 1. / 255. if np.issubdtype(np.dtype(dtype), np.floating) else None
+
+    def decode(i, img=None):
+        if img is None:
+            img = _as_hwc(imread(paths[i]))
+            if channels is not None:
+                img = img[..., :channels]
+        if img.shape != out.shape[1:]:
+            raise ValueError(f'read_images: {paths[i]} has shape {img.shape} but {out.shape[1:]} is expected')
+        if scale is None:
+            out[i] = img
+        else:
+            np.multiply(img, scale, out=out[i], casting='unsafe')
+
+    decode(0, first)
+    num_workers = num_workers or default_num_workers()
+    if num_workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(num_workers) as pool:
+            # consume the results so that the exceptions in workers are raised here
+            list(pool.map(decode, range(1, len(paths))))
+    else:
+        for i in range(1, len(paths)):
+            decode(i)
+    if verbose:
+        print(f'read_images: {len(paths)} images {list(out.shape)} {out.dtype} in {time.time()-eps_time:.2f} sec')
+    return out
+
+
+def read_image_list(paths, dtype=np.float32, channels=None, imread=imageio.imread, num_workers=None):
+    '''Decode images of possibly different shapes with a thread pool into a list (in the order of paths).
+    The arguments are the same as read_images.
+    '''
+    scale = 1. / 255. if np.issubdtype(np.dtype(dtype), np.floating) else None
+
+    def decode(path):
+        img = _as_hwc(imread(path))
+        if channels is not None:
+            img = img[..., :channels]
+        if scale is None:
+            return img.astype(dtype, copy=False)
+        return np.multiply(img, scale, dtype=dtype)
+
+    num_workers = num_workers or default_num_workers()
+    if num_workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(num_workers) as pool:
+            return list(pool.map(decode, paths))
+    return [decode(path) for path in paths]
+
+
+class LazyImages:
+    '''Indexable handle of image files which are decoded (and cached) only when accessed.
+    It stands for the [N, H, W, C] array of read_images:
+        images[i] is a frame; images[list / slice / array] stacks the selected frames.
+    The frame sizes are read from the file headers without decoding.
+    The decoded frames are kept unless cache=False (see uncached).
+    '''
+    def __init__(self, paths, dtype=np.float32, channels=None, imread=imageio.imread,
+                 transform=None, out_channels=None, stack=np.stack, cache=True):
+        self.paths = list(paths)
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.imread = imread
+        self.transform = transform
+        self.out_channels = out_channels
+        self.stack = stack
+        self.cache = cache
+        self._hw = None
+        self._cache = {}
+
+    def with_transform(self, fn, channels=None, stack=None):
+        '''Return a new handle applying fn to each decoded frame (after the current transform)'''
+        transform = fn if self.transform is None else (lambda img, old=self.transform: fn(old(img)))
+        return LazyImages(
+            self.paths, self.dtype, self.channels, self.imread, transform,
+            out_channels=channels or self.out_channels, stack=stack or self.stack, cache=self.cache)
+
+    def uncached(self):
+        '''Return a new handle decoding the frames at each access (bounded memory)'''
+        handle = LazyImages(
+            self.paths, self.dtype, self.channels, self.imread, self.transform,
+            out_channels=self.out_channels, stack=self.stack, cache=False)
+        handle._hw = self._hw
+        return handle
+
+    def hw(self):
+        '''[N, 2] heights and widths read from the file headers'''
+        if self._hw is None:
+            from PIL import Image
+            sizes = []
+            for path in self.paths:
+                with Image.open(path) as img:
+                    sizes.append(img.size[::-1])
+            self._hw = np.array(sizes)
+        return self._hw
+
+    @property
+    def shape(self):
+        from PIL import Image
+        H, W = self.hw()[0]
+        C = self.out_channels
+        if C is None:
+            with Image.open(self.paths[0]) as img:
+                C = len(img.getbands())
+            if self.channels is not None:
+                C = min(C, self.channels)
+        return (len(self.paths), int(H), int(W), C)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idx = np.arange(len(self))[idx]
+        elif isinstance(idx, tuple):
+            raise IndexError('LazyImages only supports indexing the frames')
+        if np.ndim(idx) == 0:
+            return self._frame(int(idx))
+        idx = np.asarray(idx).reshape(-1)
+        if idx.dtype == bool:
+            idx = idx.nonzero()[0]
+        return self.stack([self._frame(int(i)) for i in idx])
+
+    def _frame(self, i):
+        if i < 0:
+            i += len(self)
+        frame = self._cache.get(i)
+        if frame is None:
+            frame = read_image_list([self.paths[i]], dtype=self.dtype, channels=self.channels,
+                                    imread=self.imread, num_workers=1)[0]
+            if self.transform is not None:
+                frame = self.transform(frame)
+            if self.cache:
+                self._cache[i] = frame
+        return frame
+
+
+def _as_hwc(img):
+    img = np.asarray(img)
+    if img.ndim == 2:
+        img = img[..., None]
+    return img
+
+
+IMG_EXTS = ('JPG', 'jpg', 'png', 'jpeg', 'PNG')
+MINIFY_MANIFEST = 'manifest.json'
+
+
+def minified_dirname(r):
+    '''images_{factor} for an int factor or images_{W}x{H} for a [H, W] resolution'''
+    if isinstance(r, int):
+        return 'images_{}'.format(r)
+    return 'images_{}x{}'.format(r[1], r[0])
+
+
+def _minified_size(r, W, H):
+    if isinstance(r, int):
+        # the rounding of mogrify -resize {100/r}%
+        return max(1, int(W / r + 0.5)), max(1, int(H / r + 0.5))
+    return int(r[1]), int(r[0])
+
+
+def _source_signature(paths):
+    return [[os.path.basename(path), os.path.getsize(path), os.stat(path).st_mtime_ns] for path in paths]
+
+
+def is_minify_output(path):
+    '''Whether the directory path was written by minify_images (derived from the images next to it)'''
+    manifest_path = os.path.join(path, MINIFY_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return False
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return 'target' in manifest and not manifest.get('adopted')
+
+
+def _is_valid_minified(outdir, signature):
+    '''A minified directory is valid if it exists and was not written by minify_images for other sources.
+    A directory without our manifest (e.g., shipped with the dataset) is always valid and never modified.
+    '''
+    if not os.path.isdir(outdir):
+        return False
+    manifest_path = os.path.join(outdir, MINIFY_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return True
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except ValueError:
+        return True
+    if 'target' not in manifest or manifest.get('adopted'):
+        return True
+    return manifest['sources'] == signature
+
+
+def _png_bit_depth(path):
+    with open(path, 'rb') as f:
+        header = f.read(25)
+    if header[:8] != b'\x89PNG\r\n\x1a\n' or len(header) < 25:
+        return None
+    return header[24]
+
+
+def minify_images(basedir, factors=[], resolutions=[], num_workers=None):
+    '''Downscale basedir/images to basedir/images_{factor} and basedir/images_{W}x{H} (png, Lanczos).
+    Each original is decoded once for all the missing outputs, with a thread pool.
+    An output directory is written as a temporary directory with a manifest of the source names,
+    sizes and mtimes, then renamed, so a partially written directory is never taken as complete
+    and our outputs are rebuilt when the sources change. Existing directories without our manifest
+    (e.g., the downsampled images shipped with LLFF) are used as they are.
+    Only 8-bit images are supported (the other modes are refused instead of being quantized).
+    '''
+    from PIL import Image
+
+    srcdir = os.path.join(basedir, 'images')
+    if not os.path.isdir(srcdir):
+        return
+    srcs = [os.path.join(srcdir, f) for f in sorted(os.listdir(srcdir)) if f.endswith(IMG_EXTS)]
+    signature = _source_signature(srcs)
+
+    todo = []
+    for r in list(factors) + list(resolutions):
+        outdir = os.path.join(basedir, minified_dirname(r))
+        if not _is_valid_minified(outdir, signature) and all(outdir != v[1] for v in todo):
+            todo.append((r, outdir, outdir + '.tmp'))
+    if len(todo) == 0:
+        return
+
+    for path in srcs:
+        depth = _png_bit_depth(path)
+        if depth is not None and depth > 8:
+            raise ValueError(f'minify_images: {path} is {depth}-bit; provide the downsampled images')
+
+    print('Minifying', [r for r, _, _ in todo], basedir)
+    eps_time = time.time()
+    for _, _, tmpdir in todo:
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+
+    def process(path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        with Image.open(path) as img:
+            if img.mode == 'P':
+                # palette to its (8-bit) colors; lossless
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                raise ValueError(f'minify_images: {path} has mode {img.mode}; provide the downsampled images')
+            for r, _, tmpdir in todo:
+                size = _minified_size(r, *img.size)
+                img.resize(size, Image.LANCZOS).save(os.path.join(tmpdir, stem + '.png'))
+
+    try:
+        with ThreadPoolExecutor(num_workers or default_num_workers()) as pool:
+            list(pool.map(process, srcs))
+    except Exception:
+        for _, _, tmpdir in todo:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+    for r, outdir, tmpdir in todo:
+        with open(os.path.join(tmpdir, MINIFY_MANIFEST), 'w') as f:
+            json.dump({'sources': signature, 'target': r}, f)
+        if os.path.exists(outdir):
+            # only our own outputs of outdated sources reach here (see _is_valid_minified)
+            shutil.rmtree(outdir)
+        os.replace(tmpdir, outdir)
+    print(f'Minifying done: {len(srcs)} images in {time.time()-eps_time:.2f} sec')
+
+
+if __name__ == '__main__':
+    # Benchmark the load time of synthetic scenes: sequential v.s. thread pool decoding
+    import tempfile
+    H, W = 378, 504
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rng = np.random.default_rng(0)
+        base = (rng.random([H, W, 3]) * 255).astype(np.uint8)
+        paths = []
+        for n_imgs in [100, 500, 2000]:
+            while len(paths) < n_imgs:
+                path = os.path.join(tmpdir, f'{len(paths):05d}.png')
+                imageio.imwrite(path, np.roll(base, len(paths), axis=1))
+                paths.append(path)
+            for num_workers in [1, default_num_workers()]:
+                eps_time = time.time()
+                imgs = read_images(paths, num_workers=num_workers, verbose=False)
+                print(f'read_images: {n_imgs:4d} images, {num_workers:2d} workers: {time.time()-eps_time:.2f} sec')
+            del imgs
@@ -6,6 +6,8 @@ import json
 import torch.nn.functional as F
 import cv2
 
+from .image_io import read_images
+
 
 trans_t = lambda t : torch.Tensor([
     [1,0,0,0],
@@ -41,7 +43,7 @@ def load_blender_data(basedir, half_res=False, testskip=5, args=None):
         with open(os.path.join(basedir, 'transforms.json'.format(s)), 'r') as fp:
             metas[s] = json.load(fp)
 
-    all_imgs = []
+    all_fnames = []
     all_poses = []
     if args is not None and args.distill_active:
         all_fts = []
@@ -55,7 +57,7 @@ def load_blender_data(basedir, half_res=False, testskip=5, args=None):
 
     for s in splits:
         meta = metas[s]
-        imgs = []
+        fnames = []
         poses = []
         fts = []
         if s=='train' or testskip==0:
@@ -68,21 +70,20 @@ def load_blender_data(basedir, half_res=False, testskip=5, args=None):
             just_fname = fname.split('/')[-1]
             if args is not None and args.distill_active:
                 fts.append(fts_dict[just_fname].permute(1, 2, 0))
-            imgs.append(imageio.imread(fname))
+            fnames.append(fname)
             poses.append(np.array(frame['transform_matrix']))
-        imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
         if args is not None and args.distill_active:
             fts = torch.stack(fts)
         poses = np.array(poses).astype(np.float32)
-        counts.append(counts[-1] + imgs.shape[0])
-        all_imgs.append(imgs)
+        counts.append(counts[-1] + len(fnames))
+        all_fnames.extend(fnames)
         all_poses.append(poses)
         if args is not None and args.distill_active:
             all_fts.append(fts)
 
     i_split = [np.arange(counts[i], counts[i+1]) for i in range(3)]
 
-    imgs = np.concatenate(all_imgs, 0)
+    imgs = read_images(all_fnames) # keep all 4 channels (RGBA)
     poses = np.concatenate(all_poses, 0)
     if args is not None and args.distill_active:
         fts = torch.cat(all_fts, 0)
@@ -98,7 +99,7 @@ def load_blender_data(basedir, half_res=False, testskip=5, args=None):
         W = W//2
         focal = focal/2.
 
-        imgs_half_res = np.zeros((imgs.shape[0], H, W, 4))
+        imgs_half_res = np.zeros((imgs.shape[0], H, W, 4), dtype=imgs.dtype)
         for i, img in enumerate(imgs):
             imgs_half_res[i] = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
         imgs = imgs_half_res
@@ -2,58 +2,123 @@ import os
 import json
 import gzip
 import glob
+import time
+import shutil
 import torch
 import numpy as np
 import imageio
 import torch.nn.functional as F
 import cv2
 
+from .image_io import read_images, read_image_list
+
+
+SEQUENCE_INDEX_META = '_index_meta.json'
+
+
+def _parse_annotations(annot_path):
+    with gzip.open(annot_path, 'rt', encoding='utf8') as zipfile:
+        annot = json.load(zipfile)
+    index = {}
+    for v in annot:
+        index.setdefault(v['sequence_name'], []).append(v)
+    return index
 
-def load_co3d_data(cfg):
 
-    # load meta
-    with gzip.open(cfg.annot_path, 'rt', encoding='utf8') as zipfile:
-        annot = [v for v in json.load(zipfile) if v['sequence_name'] == cfg.sequence_name]
-    with open(cfg.split_path) as f:
+def _parse_split(split_path):
+    with open(split_path) as f:
         split = json.load(f)
-        train_im_path = set()
-        test_im_path = set()
-        for k, lst in split.items():
-            for v in lst:
-                if v[0] == cfg.sequence_name:
-                    if 'known' in k:
-                        train_im_path.add(v[-1])
-                    else:
-                        test_im_path.add(v[-1])
+    index = {}
+    for k, lst in split.items():
+        for v in lst:
+            seq = index.setdefault(v[0], {'train': [], 'test': []})
+            seq['train' if 'known' in k else 'test'].append(v[-1])
+    return index
+
+
+def _build_sequence_index(src_path, parse):
+    '''Split the category-level file src_path into one json per sequence in src_path.index (built once).
+    The index is rebuilt when the size or mtime of src_path changes.
+    '''
+    index_dir = src_path + '.index'
+    meta_path = os.path.join(index_dir, SEQUENCE_INDEX_META)
+    signature = [os.path.getsize(src_path), os.stat(src_path).st_mtime_ns]
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)['source'] == signature:
+                return index_dir
+    eps_time = time.time()
+    index = parse(src_path)
+    tmp_dir = f'{index_dir}.tmp{os.getpid()}'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for sequence_name, value in index.items():
+        with open(os.path.join(tmp_dir, f'{sequence_name}.json'), 'w') as f:
+            json.dump(value, f)
+    # the meta is written last and marks a complete index
+    with open(os.path.join(tmp_dir, SEQUENCE_INDEX_META), 'w') as f:
+        json.dump({'source': signature}, f)
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir, ignore_errors=True)
+    try:
+        os.replace(tmp_dir, index_dir)
+    except OSError:
+        # built concurrently by another process
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(f'load_co3d_data: indexed {len(index)} sequences of {src_path} in {time.time()-eps_time:.1f} sec')
+    return index_dir
+
+
+def _load_sequence(src_path, parse, sequence_name, default):
+    '''Entry of sequence_name in the per-sequence index of src_path'''
+    try:
+        index_dir = _build_sequence_index(src_path, parse)
+    except OSError as e:
+        print(f'load_co3d_data: cannot write the index of {src_path} ({e}), parse it in memory')
+        return parse(src_path).get(sequence_name, default)
+    path = os.path.join(index_dir, f'{os.path.basename(sequence_name)}.json')
+    if not os.path.isfile(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_co3d_data(cfg):
+
+    # load meta of the sequence only, from the per-sequence indices of the category files
+    annot = _load_sequence(cfg.annot_path, _parse_annotations, cfg.sequence_name, [])
+    split = _load_sequence(cfg.split_path, _parse_split, cfg.sequence_name, {'train': [], 'test': []})
+    train_im_path = set(split['train'])
+    test_im_path = set(split['test'])
     assert len(annot) == len(train_im_path) + len(test_im_path), 'Mismatch: '\
             f'{len(annot)} == {len(train_im_path) + len(test_im_path)}'
 
     # load datas
-    imgs = []
-    masks = []
-    poses = []
-    Ks = []
-    i_split = [[], []]
+    candidates = []
     remove_empty_masks_cnt = [0, 0]
-    for i, meta in enumerate(annot):
+    for meta in annot:
         im_fname = meta['image']['path']
         assert im_fname in train_im_path or im_fname in test_im_path
         sid = 0 if im_fname in train_im_path else 1
         if meta['mask']['mass'] == 0:
             remove_empty_masks_cnt[sid] += 1
             continue
-        im_path = os.path.join(cfg.datadir, im_fname)
-        mask_path = os.path.join(cfg.datadir, meta['mask']['path'])
-        mask = imageio.imread(mask_path) / 255.
+        candidates.append((sid, meta))
+    masks = read_image_list([os.path.join(cfg.datadir, meta['mask']['path']) for _, meta in candidates])
+
+    kept = []
+    poses = []
+    Ks = []
+    i_split = [[], []]
+    for (sid, meta), mask in zip(candidates, masks):
         if mask.max() < 0.5:
             remove_empty_masks_cnt[sid] += 1
             continue
         Rt = np.concatenate([meta['viewpoint']['R'], np.array(meta['viewpoint']['T'])[:,None]], 1)
         pose = np.linalg.inv(np.concatenate([Rt, [[0,0,0,1]]]))
-        imgs.append(imageio.imread(im_path) / 255.)
-        masks.append(mask)
+        kept.append((meta, mask[..., 0]))
         poses.append(pose)
-        assert imgs[-1].shape[:2] == tuple(meta['image']['size'])
         half_image_size_wh = np.float32(meta['image']['size'][::-1]) * 0.5
         principal_point = np.float32(meta['viewpoint']['principal_point'])
         focal_length = np.float32(meta['viewpoint']['focal_length'])
@@ -64,14 +129,22 @@ def load_co3d_data(cfg):
             [0, focal_length_px[1], principal_point_px[1]],
             [0, 0, 1],
         ]))
-        i_split[sid].append(len(imgs)-1)
+        i_split[sid].append(len(kept)-1)
 
     if sum(remove_empty_masks_cnt) > 0:
         print('load_co3d_data: removed %d train / %d test due to empty mask' % tuple(remove_empty_masks_cnt))
     print(f'load_co3d_data: num images {len(i_split[0])} train / {len(i_split[1])} test')
 
-    imgs = np.array(imgs)
-    masks = np.array(masks)
+    im_paths = [os.path.join(cfg.datadir, meta['image']['path']) for meta, _ in kept]
+    sizes = [tuple(meta['image']['size']) for meta, _ in kept]
+    if len(set(sizes)) == 1:
+        imgs = read_images(im_paths)
+        masks = np.stack([mask for _, mask in kept])
+    else:
+        imgs = np.array(read_image_list(im_paths))
+        masks = np.array([mask for _, mask in kept])
+    for img, size in zip(imgs, sizes):
+        assert img.shape[:2] == size
     poses = np.stack(poses, 0)
     Ks = np.stack(Ks, 0)
     render_poses = poses[i_split[-1]]
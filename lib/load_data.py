@@ -10,9 +10,13 @@ from .load_co3d import load_co3d_data
 from .load_nerfpp import load_nerfpp_data
 from .load_replica import load_replica_data
 from .load_lerf import load_lerf_data
+from .image_io import LazyImages
 
 
-def load_data(args):
+def load_data(args, lazy_images=False):
+    '''Load the dataset of the data config args.
+    If lazy_images, the llff / lerf images are returned as a LazyImages handle decoding the frames when accessed.
+    '''
 
     K, depths = None, None
     near_clip = None
@@ -23,7 +27,7 @@ def load_data(args):
                 recenter=True, bd_factor=args.bd_factor,
                 spherify=args.spherify,
                 load_depths=args.load_depths,
-                movie_render_kwargs=args.movie_render_kwargs, args=args)
+                movie_render_kwargs=args.movie_render_kwargs, args=args, lazy_images=lazy_images)
         hwf = poses[0,:3,-1]
         poses = poses[:,:3,:4]
         print('Loaded llff', images.shape, render_poses.shape, hwf, args.datadir)
@@ -53,7 +57,7 @@ def load_data(args):
             print('original far', _far)
         print('NEAR FAR', near, far)
 
-        if depths == 0:
+        if depths == 0 and not lazy_images:
             depths = np.zeros_like(images[..., :1])
 
     elif args.dataset_type == 'blender':
@@ -160,7 +164,8 @@ def load_data(args):
                 images = images[...,:3]*images[...,-1:]
 
     elif args.dataset_type == 'lerf':
-        images, poses, render_poses, hwf, K, i_split = load_lerf_data(args.datadir, args.factor,movie_render_kwargs=args.movie_render_kwargs)
+        images, poses, render_poses, hwf, K, i_split = load_lerf_data(args.datadir, args.factor,movie_render_kwargs=args.movie_render_kwargs,
+                                                                      lazy_images=lazy_images)
         print('Loaded lerf', images.shape, render_poses.shape, hwf[:2], args.datadir)
         i_train, i_val, i_test = i_split
 
@@ -172,9 +177,13 @@ def load_data(args):
 
         if images.shape[-1] == 4:
             if args.white_bkgd:
-                images = images[...,:3]*images[...,-1:] + (1.-images[...,-1:])
+                composite = lambda im: im[...,:3]*im[...,-1:] + (1.-im[...,-1:])
             else:
-                images = images[...,:3]*images[...,-1:]
+                composite = lambda im: im[...,:3]*im[...,-1:]
+            if isinstance(images, LazyImages):
+                images = images.with_transform(composite, channels=3)
+            else:
+                images = composite(images)
 
     else:
         raise NotImplementedError(f'Unknown dataset type {args.dataset_type} exiting')
@@ -183,8 +192,12 @@ def load_data(args):
     H, W, focal = hwf
     H, W = int(H), int(W)
     hwf = [H, W, focal]
-    HW = np.array([im.shape[:2] for im in images])
-    irregular_shape = (images.dtype is np.dtype('object'))
+    if isinstance(images, LazyImages):
+        HW = images.hw()
+        irregular_shape = len(np.unique(HW, axis=0)) > 1
+    else:
+        HW = np.array([im.shape[:2] for im in images])
+        irregular_shape = (images.dtype is np.dtype('object'))
 
     if K is None:
         K = np.array([
@@ -2,6 +2,8 @@ import os
 import numpy as np
 import imageio
 
+from .image_io import read_images
+
 
 def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=1):
 
@@ -80,15 +82,15 @@ def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=1):
     valposes = valposes[::testskip]
 
     imgfiles = [f for f in sorted(os.listdir(os.path.join(deepvoxels_base, 'rgb'))) if f.endswith('png')]
-    imgs = np.stack([imageio.imread(os.path.join(deepvoxels_base, 'rgb', f))/255. for f in imgfiles], 0).astype(np.float32)
+    imgs = read_images([os.path.join(deepvoxels_base, 'rgb', f) for f in imgfiles])
 
     testimgd = '{}/test/{}/rgb'.format(basedir, scene)
     imgfiles = [f for f in sorted(os.listdir(testimgd)) if f.endswith('png')]
-    testimgs = np.stack([imageio.imread(os.path.join(testimgd, f))/255. for f in imgfiles[::testskip]], 0).astype(np.float32)
+    testimgs = read_images([os.path.join(testimgd, f) for f in imgfiles[::testskip]])
 
     valimgd = '{}/validation/{}/rgb'.format(basedir, scene)
     imgfiles = [f for f in sorted(os.listdir(valimgd)) if f.endswith('png')]
-    valimgs = np.stack([imageio.imread(os.path.join(valimgd, f))/255. for f in imgfiles[::testskip]], 0).astype(np.float32)
+    valimgs = read_images([os.path.join(valimgd, f) for f in imgfiles[::testskip]])
 
     all_imgs = [imgs, valimgs, testimgs]
     counts = [0] + [x.shape[0] for x in all_imgs]
@@ -6,6 +6,8 @@ import json
 import torch.nn.functional as F
 import cv2
 
+from .image_io import read_images, LazyImages
+
 def normalize(x):
     return x / np.linalg.norm(x)
 
@@ -53,12 +55,12 @@ def pose_spherical(gamma, phi, t):
     return c2w
 
 
-def load_lerf_data(basedir, factor=2, args=None, movie_render_kwargs={}):
+def load_lerf_data(basedir, factor=2, args=None, movie_render_kwargs={}, lazy_images=False):
     with open(os.path.join(basedir, 'transforms.json'), 'r') as fp:
         metas = json.load(fp)
 
 
-    imgs = []
+    fnames = []
     poses = []
     intrinsics = []
     fts = []
@@ -71,7 +73,7 @@ def load_lerf_data(basedir, factor=2, args=None, movie_render_kwargs={}):
             fname = os.path.join(basedir, 'images_{}'.format(factor), just_fname)
         else:
             fname = os.path.join(basedir, 'images', just_fname)
-        imgs.append(imageio.imread(fname))
+        fnames.append(fname)
         poses.append(np.array(frame['transform_matrix']))
         K = np.array([
                 [frame['fl_x']/factor, 0, frame['cx']/factor],
@@ -79,7 +81,7 @@ def load_lerf_data(basedir, factor=2, args=None, movie_render_kwargs={}):
                 [0, 0, 1]
             ]).astype(np.float32)
         intrinsics.append(K)
-    imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+    imgs = LazyImages(fnames) if lazy_images else read_images(fnames) # keep all 4 channels (RGBA)
     poses = np.array(poses).astype(np.float32)
     intrinsics = np.array(intrinsics).astype(np.float32)
     f_avg = (intrinsics[:, 0, 0] + intrinsics[:, 1, 1]).mean() / 2.
@@ -90,7 +92,7 @@ def load_lerf_data(basedir, factor=2, args=None, movie_render_kwargs={}):
                         (i not in i_test and i not in i_val)])
     i_split = [i_train, i_val, i_test]
 
-    H, W = imgs[0].shape[:2]
+    H, W = imgs.shape[1:3]
 
     poses_ = poses.copy()
     centroid = poses_[:,:3,3].mean(0)
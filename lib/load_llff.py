@@ -4,6 +4,8 @@ import torch
 import scipy
 from tqdm import tqdm
 
+from .image_io import read_images, minify_images, LazyImages
+
 ########## Slightly modified version of LLFF data loading code
 ##########  see https://github.com/Fyusion/LLFF for original
 def imread(f):
@@ -31,58 +33,11 @@ def depthread(path):
 
 
 def _minify(basedir, factors=[], resolutions=[]):
-    needtoload = False
-    for r in factors:
-        imgdir = os.path.join(basedir, 'images_{}'.format(r))
-        if not os.path.exists(imgdir):
-            needtoload = True
-    for r in resolutions:
-        imgdir = os.path.join(basedir, 'images_{}x{}'.format(r[1], r[0]))
-        if not os.path.exists(imgdir):
-            needtoload = True
-    if not needtoload:
-        return
-
-    from shutil import copy
-    from subprocess import check_output
-
-    imgdir = os.path.join(basedir, 'images')
-    imgs = [os.path.join(imgdir, f) for f in sorted(os.listdir(imgdir))]
-    imgs = [f for f in imgs if any([f.endswith(ex) for ex in ['JPG', 'jpg', 'png', 'jpeg', 'PNG']])]
-    imgdir_orig = imgdir
-
-    wd = os.getcwd()
-
-    for r in factors + resolutions:
-        if isinstance(r, int):
-            name = 'images_{}'.format(r)
-            resizearg = '{}%'.format(100./r)
-        else:
-            name = 'images_{}x{}'.format(r[1], r[0])
-            resizearg = '{}x{}'.format(r[1], r[0])
-        imgdir = os.path.join(basedir, name)
-        if os.path.exists(imgdir):
-            continue
-
-        print('Minifying', r, basedir)
+    minify_images(basedir, factors=factors, resolutions=resolutions)
 
-        os.makedirs(imgdir)
-        check_output('cp {}/* {}'.format(imgdir_orig, imgdir), shell=True)
 
-        ext = imgs[0].split('.')[-1]
-        args = ' '.join(['mogrify', '-resize', resizearg, '-format', 'png', '*.{}'.format(ext)])
-        print(args)
-        os.chdir(imgdir)
-        check_output(args, shell=True)
-        os.chdir(wd)
-
-        if ext != 'png':
-            check_output('rm {}/*.{}'.format(imgdir, ext), shell=True)
-            print('Removed duplicates')
-        print('Done')
-
-
-def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, load_depths=False, args=None):
+def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, load_depths=False, args=None,
+               lazy_imgs=False):
 
     poses_arr = np.load(os.path.join(basedir, 'poses_bounds.npy'))
     if poses_arr.shape[1] == 17:
@@ -156,9 +111,11 @@ def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, lo
         return poses, bds
 
 
-    imgs = imgs = [imread(f)[...,:3]/255. for f in tqdm(imgfiles)]
-    imgs = np.stack(imgs, -1)
-    height, width = imgs.shape[:2]
+    if lazy_imgs:
+        # decoded when accessed; [N, H, W, 3] instead of [H, W, 3, N]
+        imgs = LazyImages(imgfiles, channels=3, imread=imread)
+    else:
+        imgs = np.moveaxis(read_images(imgfiles, channels=3, imread=imread), 0, -1)
 
     print('Loaded image data', imgs.shape, poses[:,-1,0])
 
@@ -303,10 +260,11 @@ def spherify_poses(poses, bds, depths):
 def load_llff_data(basedir, factor=8, width=None, height=None,
                    recenter=True, rerotate=True,
                    bd_factor=.75, spherify=False, path_zflat=False, load_depths=False,
-                   movie_render_kwargs={}, args=None):
+                   movie_render_kwargs={}, args=None, lazy_images=False):
 
     poses, bds, imgs = _load_data(basedir, factor=factor, width=width, height=height,
-                                           load_depths=load_depths, args=args) # factor=8 downsamples original imgs by 8x
+                                           load_depths=load_depths, args=args,
+                                           lazy_imgs=lazy_images) # factor=8 downsamples original imgs by 8x
     print('Loaded', basedir, bds.min(), bds.max())
     if load_depths:
         depths = depths[0]
@@ -316,7 +274,8 @@ def load_llff_data(basedir, factor=8, width=None, height=None,
     # Correct rotation matrix ordering and move variable dim to axis 0
     poses = np.concatenate([poses[:, 1:2, :], -poses[:, 0:1, :], poses[:, 2:, :]], 1)
     poses = np.moveaxis(poses, -1, 0).astype(np.float32)
-    imgs = np.moveaxis(imgs, -1, 0).astype(np.float32)
+    if not lazy_images:
+        imgs = np.moveaxis(imgs, -1, 0).astype(np.float32, copy=False)
     images = imgs
     bds = np.moveaxis(bds, -1, 0).astype(np.float32)
 
@@ -418,8 +377,40 @@ def load_llff_data(basedir, factor=8, width=None, height=None,
     i_test = np.argmin(dists)
     print('HOLDOUT view is', i_test)
 
-    images = images.astype(np.float32)
+    if not lazy_images:
+        images = images.astype(np.float32, copy=False)
     poses = poses.astype(np.float32)
 
     return images, depths, poses, bds, render_poses, i_test
 
+
+def _write_synthetic_scene(basedir, n_views=8, H=24, W=32):
+    '''Write a small llff scene (random images of cameras on an arc looking at the origin) for the checks'''
+    rng = np.random.default_rng(0)
+    os.makedirs(os.path.join(basedir, 'images'), exist_ok=True)
+    poses_bounds = []
+    for i, th in enumerate(np.linspace(-.3, .3, n_views)):
+        # llff columns: [down, right, backwards] of the camera, its center and [H, W, focal]
+        back = np.array([np.sin(th), 0., np.cos(th)])
+        right = np.array([np.cos(th), 0., -np.sin(th)])
+        down = np.cross(right, back)
+        pose = np.stack([down, right, back, 4 * back, [H, W, W]], 1)
+        poses_bounds.append(np.concatenate([pose.ravel(), [2., 6.]]))
+        img = (rng.random([H, W, 3]) * 255).astype(np.uint8)
+        imageio.imwrite(os.path.join(basedir, 'images', f'{i:03d}.png'), img)
+    np.save(os.path.join(basedir, 'poses_bounds.npy'), np.array(poses_bounds))
+
+
+if __name__ == '__main__':
+    # Check that a lazy load gives the same scene as an eager one
+    import tempfile
+    with tempfile.TemporaryDirectory() as basedir:
+        _write_synthetic_scene(basedir)
+        eager = load_llff_data(basedir, factor=None)
+        lazy = load_llff_data(basedir, factor=None, lazy_images=True)
+        assert isinstance(lazy[0], LazyImages) and lazy[0].shape == eager[0].shape
+        assert np.allclose(lazy[0][np.arange(len(lazy[0]))], eager[0])
+        for a, b in zip(eager[1:], lazy[1:]):
+            assert np.allclose(a, b)
+    print('load_llff: the lazy and eager loads match')
+
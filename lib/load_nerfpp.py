@@ -9,6 +9,8 @@ import imageio
 import numpy as np
 import torch
 
+from .image_io import read_images
+
 ########################################################################################################################
 # camera coordinate system: x-->right, y-->down, z-->scene (opencv/colmap convention)
 # poses is camera-to-world
@@ -134,14 +136,9 @@ def load_nerfpp_data(basedir, rerotate=True):
         poses.append(np.loadtxt(path).reshape(4,4))
 
     # Load images
-    imgs = []
-    for path in tr_im_path:
-        imgs.append(imageio.imread(path) / 255.)
-    for path in te_im_path:
-        imgs.append(imageio.imread(path) / 255.)
+    imgs = read_images([*tr_im_path, *te_im_path])
 
     # Bundle all data
-    imgs = np.stack(imgs, 0)
     poses = np.stack(poses, 0)
     i_split.append(i_split[1])
     H, W = imgs.shape[1:3]
@@ -7,6 +7,8 @@ import json
 import torch.nn.functional as F
 import cv2
 
+from .image_io import read_images
+
 
 trans_t = lambda t : torch.Tensor([
     [1,0,0,0],
@@ -41,17 +43,15 @@ def load_nsvf_data(basedir):
     rgb_paths = sorted(glob.glob(os.path.join(basedir, 'rgb', '*png')))
 
     all_poses = []
-    all_imgs = []
     i_split = [[], [], []]
     for i, (pose_path, rgb_path) in enumerate(zip(pose_paths, rgb_paths)):
         i_set = int(os.path.split(rgb_path)[-1][0])
-        all_imgs.append((imageio.imread(rgb_path) / 255.).astype(np.float32))
         all_poses.append(np.loadtxt(pose_path).astype(np.float32))
         i_split[i_set].append(i)
     if i_split[2] == []:
         i_split[2] = i_split[1]
 
-    imgs = np.stack(all_imgs, 0)
+    imgs = read_images(rgb_paths[:len(all_poses)])
     poses = np.stack(all_poses, 0)
 
     H, W = imgs[0].shape[:2]
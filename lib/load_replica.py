@@ -9,6 +9,8 @@ import cv2
 import math
 import glob
 
+from .image_io import read_images
+
 
 
 trans_t = lambda t : torch.Tensor([
@@ -192,11 +194,7 @@ def load_replica_data(basedir='./data/replica/office_0', half_res=False, \
     all_imgs_paths = sorted(os.listdir(os.path.join(basedir, 'rgb')), key=lambda file_name: int(file_name.split("_")[-1][:-4]))
 
 
-    imgs = []
-    for i in range(len(all_imgs_paths)):
-        fname = os.path.join(basedir, 'rgb', all_imgs_paths[i])
-        imgs.append(imageio.imread(fname))
-    imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+    imgs = read_images([os.path.join(basedir, 'rgb', fname) for fname in all_imgs_paths]) # keep all 4 channels (RGBA)
     poses = np.array(poses).astype(np.float32)
 
     H, W = imgs[0].shape[:2]
@@ -210,7 +208,7 @@ def load_replica_data(basedir='./data/replica/office_0', half_res=False, \
         W = W//2
         focal = focal/2.
 
-        imgs_half_res = np.zeros((imgs.shape[0], H, W, 4))
+        imgs_half_res = np.zeros((imgs.shape[0], H, W, 4), dtype=imgs.dtype)
         for i, img in enumerate(imgs):
             imgs_half_res[i] = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
         imgs = imgs_half_res
@@ -7,6 +7,8 @@ import json
 import torch.nn.functional as F
 import cv2
 
+from .image_io import read_images
+
 
 def normalize(x):
     return x / np.linalg.norm(x)
@@ -16,15 +18,13 @@ def load_tankstemple_data(basedir, movie_render_kwargs={}, args=None):
     rgb_paths = sorted(glob.glob(os.path.join(basedir, 'rgb', '*jpg')))
 
     all_poses = []
-    all_imgs = []
     i_split = [[], []]
     for i, (pose_path, rgb_path) in enumerate(zip(pose_paths, rgb_paths)):
         i_set = int(os.path.split(rgb_path)[-1][0])
         all_poses.append(np.loadtxt(pose_path).astype(np.float32))
-        all_imgs.append((imageio.imread(rgb_path) / 255.).astype(np.float32))
         i_split[i_set].append(i)
 
-    imgs = np.stack(all_imgs, 0)
+    imgs = read_images(rgb_paths[:len(all_poses)])
     poses = np.stack(all_poses, 0)
     i_split.append(i_split[-1])
 
@@ -1,4 +1,5 @@
 import os
+import math
 import torch
 from torch.utils.cpp_extension import load
 
@@ -10,13 +11,76 @@ adam_upd_cuda = load(
         verbose=True)
 
 
+def adam_step_size(step, beta1, beta2, lr):
+    return lr * math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+
+
+@torch.no_grad()
+def adam_upd_torch(param, grad, exp_avg, exp_avg_sq, step, beta1, beta2, lr, eps,
+                   perlr=None, skip_zero_grad=False):
+    '''Vectorized pytorch implementation of the adam_upd_cuda kernels (for CPU tensors)'''
+    step_size = adam_step_size(step, beta1, beta2, lr)
+    if skip_zero_grad and perlr is None:
+        mask = (grad != 0)
+        g = grad[mask]
+        m = exp_avg[mask].mul_(beta1).add_(g, alpha=1-beta1)
+        v = exp_avg_sq[mask].mul_(beta2).addcmul_(g, g, value=1-beta2)
+        exp_avg[mask] = m
+        exp_avg_sq[mask] = v
+        param[mask] -= step_size * m / (v.sqrt() + eps)
+        return
+    exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
+    upd = exp_avg / (exp_avg_sq.sqrt() + eps)
+    if perlr is not None:
+        upd.mul_(perlr)
+    param.sub_(step_size * upd)
+
+
+@torch.no_grad()
+def sparse_adam_upd_torch(param, grad, exp_avg, exp_avg_sq, last_step, idx, step, beta1, beta2, lr, eps,
+                          perlr=None, skip_zero_grad=False):
+    '''Adam update of the voxels idx (all channels) of a [1, C, X, Y, Z] grid.
+    The moments of a voxel last updated at last_step[idx] are first decayed for the skipped steps
+    as if zero gradients were seen, so the cost scales with len(idx) instead of the grid size.
+    With skip_zero_grad, it follows masked_adam_upd instead: the elements with zero grad are left untouched
+    (neither their moments nor their values change), so only the voxels with a nonzero grad are visited.
+    '''
+    C = param.shape[1]
+    step_size = adam_step_size(step, beta1, beta2, lr)
+    param, grad = param.view(C, -1), grad.view(C, -1)
+    exp_avg, exp_avg_sq = exp_avg.view(C, -1), exp_avg_sq.view(C, -1)
+    g = grad[:, idx]
+    if skip_zero_grad:
+        nonzero = g != 0
+        keep = nonzero.any(0)
+        idx, g, nonzero = idx[keep], g[:, keep], nonzero[:, keep]
+        m = torch.where(nonzero, exp_avg[:, idx] * beta1 + (1-beta1) * g, exp_avg[:, idx])
+        v = torch.where(nonzero, exp_avg_sq[:, idx] * beta2 + (1-beta2) * g * g, exp_avg_sq[:, idx])
+    else:
+        n_skipped = (step - 1 - last_step[idx]).float()
+        m = exp_avg[:, idx] * beta1 ** (n_skipped + 1) + (1-beta1) * g
+        v = exp_avg_sq[:, idx] * beta2 ** (n_skipped + 1) + (1-beta2) * g * g
+    exp_avg[:, idx] = m
+    exp_avg_sq[:, idx] = v
+    upd = step_size * m / (v.sqrt() + eps)
+    if skip_zero_grad:
+        upd = upd * nonzero
+    if perlr is not None:
+        upd *= perlr.view(C, -1)[:, idx]
+    param[:, idx] -= upd
+    last_step[idx] = step
+
+
 ''' Extend Adam optimizer
 1. support per-voxel learning rate
 2. masked update (ignore zero grad) which speeduping training
+3. update all the small tensors (e.g., the rgbnet) in a single kernel launch
+4. sparse update of the voxels touched by the forward passes (see set_sparse_grid)
 '''
 class MaskedAdam(torch.optim.Optimizer):
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.99), eps=1e-8):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.99), eps=1e-8, fused=True, fused_numel_max=2**20):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -25,9 +89,12 @@ class MaskedAdam(torch.optim.Optimizer):
             raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
-        defaults = dict(lr=lr, betas=betas, eps=eps)
+        defaults = dict(lr=lr, betas=betas, eps=eps, skip_zero_grad=False)
         self.per_lr = None
         self.f_per_lr = None
+        self.fused = fused
+        self.fused_numel_max = fused_numel_max
+        self.sparse_grids = {}
         super(MaskedAdam, self).__init__(params, defaults)
 
     def __setstate__(self, state):
@@ -37,9 +104,26 @@ class MaskedAdam(torch.optim.Optimizer):
         assert self.param_groups[0]['params'][0].shape == count.shape
         self.per_lr = count.float() / count.max()
 
+    def set_sparse_grid(self, param, grid):
+        '''Only update the voxels of param returned by grid.pop_touched() in each step'''
+        assert param.dim() == 5
+        self.sparse_grids[param] = grid
+
+    def scale_lr(self, factor):
+        '''Multiply the learning rate of all the param groups by factor (for the exponential decay)'''
+        for group in self.param_groups:
+            group['lr'] *= factor
+
+    def _get_perlr(self, param):
+        if self.per_lr is not None and param.shape == self.per_lr.shape:
+            return self.per_lr
+        elif self.f_per_lr is not None and param.shape == self.f_per_lr.shape:
+            return self.f_per_lr
+        return None
 
     @torch.no_grad()
     def step(self):
+        fused_args = ([], [], [], [], [], [])
         for group in self.param_groups:
             lr = group['lr']
             beta1, beta2 = group['betas']
@@ -58,13 +142,34 @@ class MaskedAdam(torch.optim.Optimizer):
 
                     state['step'] += 1
 
-                    if self.per_lr is not None and param.shape == self.per_lr.shape:
-                        adam_upd_cuda.adam_upd_with_perlr(
-                                param, param.grad, state['exp_avg'], state['exp_avg_sq'], self.per_lr,
-                                state['step'], beta1, beta2, lr, eps)
-                    elif self.f_per_lr is not None and param.shape == self.f_per_lr.shape:
+                    perlr = self._get_perlr(param)
+                    if param in self.sparse_grids:
+                        idx = self.sparse_grids[param].pop_touched()
+                        if 'last_step' not in state:
+                            state['last_step'] = torch.full(
+                                    [param.shape[2:].numel()], state['step']-1, dtype=torch.int32, device=param.device)
+                        if idx is None:
+                            # gradients may have been added out of the record; fall back to scanning them
+                            idx = (param.grad.view(param.shape[1], -1) != 0).any(0).nonzero()[:,0] if skip_zero_grad \
+                                  else torch.arange(param.shape[2:].numel(), device=param.device)
+                        sparse_adam_upd_torch(
+                                param, param.grad, state['exp_avg'], state['exp_avg_sq'], state['last_step'], idx,
+                                state['step'], beta1, beta2, lr, eps, perlr=perlr, skip_zero_grad=skip_zero_grad)
+                    elif not param.is_cuda:
+                        adam_upd_torch(
+                                param, param.grad, state['exp_avg'], state['exp_avg_sq'],
+                                state['step'], beta1, beta2, lr, eps, perlr=perlr, skip_zero_grad=skip_zero_grad)
+                    elif self.fused and perlr is None and param.numel() <= self.fused_numel_max \
+                            and beta1 == self.defaults['betas'][0] and beta2 == self.defaults['betas'][1] \
+                            and eps == self.defaults['eps']:
+                        # deferred to the single multi-tensor launch below
+                        for lst, v in zip(fused_args, [
+                                param, param.grad.contiguous(), state['exp_avg'], state['exp_avg_sq'],
+                                adam_step_size(state['step'], beta1, beta2, lr), skip_zero_grad]):
+                            lst.append(v)
+                    elif perlr is not None:
                         adam_upd_cuda.adam_upd_with_perlr(
-                                param, param.grad, state['exp_avg'], state['exp_avg_sq'], self.f_per_lr,
+                                param, param.grad, state['exp_avg'], state['exp_avg_sq'], perlr,
                                 state['step'], beta1, beta2, lr, eps)
                     elif skip_zero_grad:
                         adam_upd_cuda.masked_adam_upd(
@@ -75,3 +180,60 @@ class MaskedAdam(torch.optim.Optimizer):
                                 param, param.grad, state['exp_avg'], state['exp_avg_sq'],
                                 state['step'], beta1, beta2, lr, eps)
 
+        if len(fused_args[0]):
+            beta1, beta2 = self.defaults['betas']
+            adam_upd_cuda.multi_adam_upd(*fused_args, beta1, beta2, self.defaults['eps'])
+
+
+if __name__ == '__main__':
+    # Benchmark the optimizer time per step: per-tensor launches v.s. the multi-tensor launch
+    import time
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+    def make_params():
+        torch.manual_seed(0)
+        density = torch.randn([1, 1, 160, 160, 160], device=device)
+        k0 = torch.randn([1, 12, 160, 160, 160], device=device)
+        rgbnet = [torch.randn(s, device=device) for s in [(128, 39), (128,), (128, 128), (128,), (3, 128), (3,)]]
+        return [density, k0] + rgbnet
+    results = {}
+    for fused in [False, True]:
+        params = [torch.nn.Parameter(p) for p in make_params()]
+        optimizer = MaskedAdam([
+            {'params': params[:1], 'lr': 0.1, 'skip_zero_grad': True},
+            {'params': params[1:2], 'lr': 0.1, 'skip_zero_grad': True},
+            {'params': params[2:], 'lr': 1e-3, 'skip_zero_grad': False},
+        ], fused=fused)
+        for it in range(60):
+            if it == 10:
+                sync()
+                t0 = time.perf_counter()
+            for p in params:
+                p.grad = torch.randn_like(p) * (torch.rand_like(p) < 0.1)
+            optimizer.step()
+        sync()
+        results[fused] = [p.detach().clone() for p in params]
+        print(f'masked_adam: fused={fused} {(time.perf_counter()-t0)/50*1000:.3f} ms/step (including the random grads)')
+    err = max((a - b).abs().max().item() for a, b in zip(results[False], results[True]))
+    print(f'masked_adam: max abs difference between the two paths {err:.3e}')
+
+    # Sparse update of the touched voxels v.s. the masked dense update
+    from .grid import DenseGrid
+    for sparse in [False, True]:
+        torch.manual_seed(0)
+        k0 = DenseGrid(12, torch.LongTensor([160, 160, 160]), [-1, -1, -1], [1, 1, 1]).to(device)
+        optimizer = MaskedAdam([{'params': k0.parameters(), 'lr': 0.1, 'skip_zero_grad': True}])
+        if sparse:
+            k0.enable_touched_recording()
+            optimizer.set_sparse_grid(k0.grid, k0)
+        t_opt = 0
+        for it in range(30):
+            k0.zero_grad(set_to_none=True)
+            k0(torch.rand([8192*64, 3], device=device) * 0.5 - 0.25).sum().backward()
+            sync()
+            t0 = time.perf_counter()
+            optimizer.step()
+            sync()
+            if it >= 10:
+                t_opt += time.perf_counter() - t0
+        print(f'masked_adam: sparse={sparse} {t_opt/20*1000:.3f} ms/step (optimizer only)')
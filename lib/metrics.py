@@ -0,0 +1,142 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from . import utils
+
+
+def _gaussian_filter(filter_size, filter_sigma):
+    # The 1D Gaussian blur filter of utils.rgb_ssim
+    hw = filter_size // 2
+    shift = (2 * hw - filter_size + 1) / 2
+    f_i = ((np.arange(filter_size) - hw + shift) / filter_sigma)**2
+    filt = np.exp(-0.5 * f_i)
+    filt /= np.sum(filt)
+    return filt
+
+
+def rgb_ssim_batch(img0, img1, max_val,
+                   filter_size=11,
+                   filter_sigma=1.5,
+                   k1=0.01,
+                   k2=0.03,
+                   return_map=False):
+    '''utils.rgb_ssim of a stack of frames ([B, H, W, C] tensors) on their device.
+    The five moments of all the channels are blurred by one pair of separable grouped convolutions.
+    As in utils.rgb_ssim, the products are taken in the input dtype and blurred in float64
+    (scipy promotes them to the dtype of the float64 filter). Return the [B] ssim (or the [B, H', W', C] maps).
+    '''
+    assert img0.dim() == 4 and img0.shape == img1.shape
+    img0 = img0.permute(0, 3, 1, 2)
+    img1 = img1.permute(0, 3, 1, 2)
+    C = img0.shape[1]
+
+    # Blur in y and x ('valid' mode; the filter is symmetric so correlation is convolution)
+    z = torch.cat([img0, img1, img0**2, img1**2, img0 * img1], 1).double()
+    filt = torch.from_numpy(_gaussian_filter(filter_size, filter_sigma)).to(z)
+    n = z.shape[1]
+    z = F.conv2d(z, filt.view(1, 1, -1, 1).expand(n, 1, -1, 1), groups=n)
+    z = F.conv2d(z, filt.view(1, 1, 1, -1).expand(n, 1, 1, -1), groups=n)
+    mu0, mu1, ex00, ex11, ex01 = z.split(C, 1)
+    mu00 = mu0 * mu0
+    mu11 = mu1 * mu1
+    mu01 = mu0 * mu1
+    sigma00 = ex00 - mu00
+    sigma11 = ex11 - mu11
+    sigma01 = ex01 - mu01
+
+    # Clip the variances and covariances to valid values.
+    # Variance must be non-negative:
+    sigma00 = sigma00.clamp_min(0.)
+    sigma11 = sigma11.clamp_min(0.)
+    sigma01 = torch.sign(sigma01) * torch.minimum(
+        torch.sqrt(sigma00 * sigma11), torch.abs(sigma01))
+    c1 = (k1 * max_val)**2
+    c2 = (k2 * max_val)**2
+    numer = (2 * mu01 + c1) * (2 * sigma01 + c2)
+    denom = (mu00 + mu11 + c1) * (sigma00 + sigma11 + c2)
+    ssim_map = numer / denom
+    return ssim_map.permute(0, 2, 3, 1) if return_map else ssim_map.mean((1, 2, 3))
+
+
+def rgb_lpips_batch(img0, img1, net_name, device):
+    '''utils.rgb_lpips of a stack of frames ([B, H, W, 3] tensors); return the [B] distances'''
+    if net_name not in utils.__LPIPS__:
+        utils.__LPIPS__[net_name] = utils.init_lpips(net_name, device)
+    img0 = img0.permute(0, 3, 1, 2).contiguous().to(device)
+    img1 = img1.permute(0, 3, 1, 2).contiguous().to(device)
+    return utils.__LPIPS__[net_name](img0, img1, normalize=True).flatten()
+
+
+class ImageMetrics:
+    '''SSIM and LPIPS of the rendered frames, fed incrementally from a render loop.
+    add() queues a pair of [H, W, 3] frames in [0, 1] (arrays or tensors); the queued frames are
+    evaluated as a batch when batch_size frames are queued, when the frame size changes and in flush().
+    The evaluation runs on device (the device of the first rendered frame if None; 'cpu' for cpu threads).
+    '''
+    def __init__(self, eval_ssim=False, eval_lpips_alex=False, eval_lpips_vgg=False, device=None, batch_size=4):
+        self.eval_ssim = eval_ssim
+        self.eval_lpips_alex = eval_lpips_alex
+        self.eval_lpips_vgg = eval_lpips_vgg
+        self.device = device
+        self.batch_size = batch_size
+        self.ssims = []
+        self.lpips_alex = []
+        self.lpips_vgg = []
+        self.pending = []
+
+    @torch.no_grad()
+    def add(self, rgb, gt):
+        if not (self.eval_ssim or self.eval_lpips_alex or self.eval_lpips_vgg):
+            return
+        if self.device is None:
+            self.device = rgb.device if torch.is_tensor(rgb) else torch.device('cpu')
+        rgb = torch.as_tensor(rgb).to(self.device, torch.float32)
+        gt = torch.as_tensor(gt).to(self.device, torch.float32)
+        if len(self.pending) and self.pending[0][0].shape != rgb.shape:
+            self.flush()
+        self.pending.append((rgb, gt))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    @torch.no_grad()
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        rgb = torch.stack([p[0] for p in self.pending])
+        gt = torch.stack([p[1] for p in self.pending])
+        self.pending = []
+        if self.eval_ssim:
+            self.ssims.extend(rgb_ssim_batch(rgb, gt, max_val=1).tolist())
+        if self.eval_lpips_alex:
+            self.lpips_alex.extend(rgb_lpips_batch(rgb, gt, net_name='alex', device=self.device).tolist())
+        if self.eval_lpips_vgg:
+            self.lpips_vgg.extend(rgb_lpips_batch(rgb, gt, net_name='vgg', device=self.device).tolist())
+
+
+if __name__ == '__main__':
+    # Check the batched metrics against utils.rgb_ssim / utils.rgb_lpips on random frames
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lpips', action='store_true', help='also check lpips (downloads the networks)')
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rng = np.random.default_rng(0)
+    for H, W in [(64, 80), (123, 97)]:
+        gt = rng.random([3, H, W, 3]).astype(np.float32)
+        rgb = np.clip(gt + rng.normal(scale=0.1, size=gt.shape), 0, 1).astype(np.float32)
+        metrics = ImageMetrics(eval_ssim=True, eval_lpips_alex=args.lpips, eval_lpips_vgg=args.lpips, device=device)
+        for i in range(len(gt)):
+            metrics.add(torch.from_numpy(rgb[i]).to(device), gt[i])
+        metrics.flush()
+        ssims = [utils.rgb_ssim(rgb[i], gt[i], max_val=1) for i in range(len(gt))]
+        err = np.abs(np.array(metrics.ssims) - np.array(ssims)).max()
+        print(f'metrics: {H}x{W} ssim max abs difference {err:.3e}')
+        assert err < 1e-10, err
+        if args.lpips:
+            for net_name, values in [('alex', metrics.lpips_alex), ('vgg', metrics.lpips_vgg)]:
+                ref = [utils.rgb_lpips(rgb[i], gt[i], net_name=net_name, device=device) for i in range(len(gt))]
+                err = np.abs(np.array(values) - np.array(ref)).max()
+                print(f'metrics: {H}x{W} lpips_{net_name} max abs difference {err:.3e}')
+                assert err < 1e-5, err
+    print('metrics: the batched metrics match utils')
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import threading
+
+import numpy as np
+import torch
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = self.prof.tic()
+        return self
+
+    def __exit__(self, *exc):
+        self.prof.toc(self.name, self.t0)
+        return False
+
+
+class PhaseProfiler:
+    '''Opt-in wall-clock profiler of the hot-path phases.
+    When disabled, tic/toc/phase return immediately, so the instrumentation can stay in the code.
+    Usage:
+        t = profiler.tic(); ...; t = profiler.toc('phase_a', t); ...; profiler.toc('phase_b', t)
+        with profiler.phase('phase_c'): ...
+    With sync_cuda, the device is synchronized at every boundary so the GPU time is attributed to its phase.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.sync_cuda = True
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.samples_per_ray = np.zeros([0], dtype=np.int64)
+
+    def enable(self, sync_cuda=True):
+        self.enabled = True
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+
+    def disable(self):
+        self.enabled = False
+
+    def tic(self):
+        if not self.enabled:
+            return None
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def toc(self, name, t0):
+        '''Record the phase started at t0 and return the start time of the next phase'''
+        if t0 is None or not self.enabled:
+            return None
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        t1 = time.perf_counter()
+        self.events.append((name, t0, t1, threading.get_ident()))
+        return t1
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def record_samples_per_ray(self, ray_id, n_rays):
+        '''Accumulate the histogram of the number of points sampled on each ray'''
+        if not self.enabled:
+            return
+        counts = torch.bincount(ray_id.long(), minlength=n_rays).cpu().numpy()
+        hist = np.bincount(counts)
+        if len(hist) > len(self.samples_per_ray):
+            hist[:len(self.samples_per_ray)] += self.samples_per_ray
+            self.samples_per_ray = hist
+        else:
+            self.samples_per_ray[:len(hist)] += hist
+
+    def summary(self):
+        '''Return the per-phase [name, count, total sec, mean ms, percentage] rows sorted by total time'''
+        stats = {}
+        for name, t0, t1, _ in self.events:
+            cnt, tot = stats.get(name, (0, 0.))
+            stats[name] = (cnt + 1, tot + t1 - t0)
+        total = sum(tot for _, tot in stats.values())
+        rows = [
+            [name, cnt, tot, tot / cnt * 1000, tot / max(total, 1e-12) * 100]
+            for name, (cnt, tot) in stats.items()
+        ]
+        return sorted(rows, key=lambda row: -row[2])
+
+    def summary_table(self):
+        lines = [f'{"phase":<24s} {"count":>8s} {"total(s)":>10s} {"mean(ms)":>10s} {"%":>6s}']
+        for name, cnt, tot, mean, pct in self.summary():
+            lines.append(f'{name:<24s} {cnt:8d} {tot:10.3f} {mean:10.3f} {pct:6.1f}')
+        if self.samples_per_ray.sum() > 0:
+            n = np.arange(len(self.samples_per_ray))
+            mean = (n * self.samples_per_ray).sum() / self.samples_per_ray.sum()
+            lines.append(f'samples per ray: mean {mean:.1f} / max {len(self.samples_per_ray)-1}')
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        '''Dump the phases in the Chrome trace event format (open with chrome://tracing or Perfetto)'''
+        if len(self.events) == 0:
+            return
+        tids = {}
+        origin = min(t0 for _, t0, _, _ in self.events)
+        trace = [{
+            'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tids.setdefault(tid, len(tids)),
+            'ts': (t0 - origin) * 1e6, 'dur': (t1 - t0) * 1e6,
+        } for name, t0, t1, tid in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def save(self, savedir, prefix):
+        '''Write {prefix}_trace.json, {prefix}_summary.txt and {prefix}_samples_per_ray.npy to savedir'''
+        if not self.enabled:
+            return
+        os.makedirs(savedir, exist_ok=True)
+        self.export_chrome_trace(os.path.join(savedir, f'{prefix}_trace.json'))
+        table = self.summary_table()
+        with open(os.path.join(savedir, f'{prefix}_summary.txt'), 'w') as f:
+            f.write(table + '\n')
+        np.save(os.path.join(savedir, f'{prefix}_samples_per_ray.npy'), self.samples_per_ray)
+        print(table)
+        print('profiler: results are saved in', savedir)
+
+
+profiler = PhaseProfiler()
@@ -0,0 +1,115 @@
+import functools
+
+import torch
+
+from .profiler import profiler
+
+
+''' Camera-space ray directions (cached per camera model)
+'''
+def _camera_dirs(H, W, fx, fy, cx, cy, inverse_y, flip_x, flip_y, mode, device):
+    i = torch.arange(W, dtype=torch.float32, device=device)[None].expand(H, W)
+    j = torch.arange(H, dtype=torch.float32, device=device)[:, None].expand(H, W)
+    if mode == 'lefttop':
+        pass
+    elif mode == 'center':
+        i, j = i+0.5, j+0.5
+    elif mode == 'random':
+        i = i+torch.rand_like(i)
+        j = j+torch.rand_like(j)
+    else:
+        raise NotImplementedError
+
+    if flip_x:
+        i = i.flip((1,))
+    if flip_y:
+        j = j.flip((0,))
+    if inverse_y:
+        dirs = torch.stack([(i-cx)/fx, (j-cy)/fy, torch.ones_like(i)], -1)
+    else:
+        dirs = torch.stack([(i-cx)/fx, -(j-cy)/fy, -torch.ones_like(i)], -1)
+    return dirs
+
+
+_cached_camera_dirs = functools.lru_cache(maxsize=16)(_camera_dirs)
+
+
+def camera_dirs(H, W, K, inverse_y, flip_x, flip_y, mode='center', device='cpu'):
+    '''[H, W, 3] camera-space directions of the pixel rays.
+    They are cached per (H, W, K, flags, mode, device) except for mode='random'; do not modify them in place.
+    '''
+    key = (int(H), int(W), float(K[0][0]), float(K[1][1]), float(K[0][2]), float(K[1][2]),
+           bool(inverse_y), bool(flip_x), bool(flip_y), mode, torch.device(device))
+    if mode == 'random':
+        return _camera_dirs(*key)
+    return _cached_camera_dirs(*key)
+
+
+''' Ray generation
+'''
+def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
+    dirs = camera_dirs(H, W, K, inverse_y, flip_x, flip_y, mode=mode, device=c2w.device)
+    # Rotate ray directions from camera frame to the world frame
+    rays_d = dirs.to(c2w.dtype) @ c2w[:3,:3].T
+    # Translate camera frame's origin to the world frame. It is the origin of all rays.
+    rays_o = c2w[:3,3].expand(rays_d.shape)
+    return rays_o, rays_d
+
+
+def ndc_rays(H, W, focal, near, rays_o, rays_d):
+    # Shift ray origins to near plane
+    t = -(near + rays_o[...,2]) / rays_d[...,2]
+    rays_o = rays_o + t[...,None] * rays_d
+
+    # Projection
+    o0 = -1./(W/(2.*focal)) * rays_o[...,0] / rays_o[...,2]
+    o1 = -1./(H/(2.*focal)) * rays_o[...,1] / rays_o[...,2]
+    o2 = 1. + 2. * near / rays_o[...,2]
+
+    d0 = -1./(W/(2.*focal)) * (rays_d[...,0]/rays_d[...,2] - rays_o[...,0]/rays_o[...,2])
+    d1 = -1./(H/(2.*focal)) * (rays_d[...,1]/rays_d[...,2] - rays_o[...,1]/rays_o[...,2])
+    d2 = -2. * near / rays_o[...,2]
+
+    rays_o = torch.stack([o0,o1,o2], -1)
+    rays_d = torch.stack([d0,d1,d2], -1)
+
+    return rays_o, rays_d
+
+
+def get_rays_of_a_view(H, W, K, c2w, ndc, inverse_y, flip_x, flip_y, mode='center'):
+    rays_o, rays_d = get_rays(H, W, K, c2w, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y, mode=mode)
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    if ndc:
+        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
+    return rays_o, rays_d, viewdirs
+
+
+def get_rays_of_views(H, W, K, c2ws, ndc, inverse_y, flip_x, flip_y, mode='center'):
+    '''get_rays_of_a_view of many poses ([N, 4, 4] or [N, 3, 4]) sharing the camera model,
+    rotated by a single batched matmul. The outputs are [N, H, W, 3].
+    '''
+    dirs = camera_dirs(H, W, K, inverse_y, flip_x, flip_y, mode=mode, device=c2ws.device)
+    rays_d = torch.matmul(dirs.to(c2ws.dtype).view(1, -1, 3), c2ws[:, :3, :3].transpose(1, 2))
+    rays_d = rays_d.view(len(c2ws), int(H), int(W), 3)
+    rays_o = c2ws[:, None, None, :3, 3].expand(rays_d.shape)
+    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    if ndc:
+        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
+    return rays_o, rays_d, viewdirs
+
+
+def iter_rays_of_a_view(H, W, K, c2w, ndc, inverse_y, flip_x, flip_y, chunk=8192, device=None, mode='center'):
+    '''Yield the flattened rays_o, rays_d, viewdirs of a view by chunks of pixels (in the row-major order)
+    without materializing the rays of the full image.
+    '''
+    c2w = c2w if device is None else c2w.to(device)
+    dirs = camera_dirs(H, W, K, inverse_y, flip_x, flip_y, mode=mode, device=c2w.device).view(-1, 3)
+    rot = c2w[:3,:3].T
+    for top in range(0, len(dirs), chunk):
+        with profiler.phase('ray_generation'):
+            rays_d = dirs[top:top+chunk].to(c2w.dtype) @ rot
+            rays_o = c2w[:3,3].expand(rays_d.shape)
+            viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
+            if ndc:
+                rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
+        yield rays_o, rays_d, viewdirs
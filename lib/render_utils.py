@@ -1,10 +1,12 @@
 import torch
 from tqdm import tqdm, trange
 import numpy as np
-from .dvgo import get_rays_of_a_view
+from .ray_utils import iter_rays_of_a_view
 import os
 import imageio
-from .utils import to8b, rgb_lpips, rgb_ssim, gen_rand_colors
+from .utils import to8b, to_float_image, gen_rand_colors
+from .metrics import ImageMetrics
+from .profiler import profiler
 import matplotlib.pyplot as plt
 
 
@@ -23,23 +25,22 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
         HW = (HW/render_factor).astype(int)
         Ks[:, :2, :3] /= render_factor
 
-    rgbs, segs, depths, bgmaps, psnrs, ssims, lpips_alex, lpips_vgg = [], [], [], [], [], [], [], []
+    rgbs, segs, depths, bgmaps, psnrs = [], [], [], [], []
+    # ssim / lpips are evaluated by batches of frames on the rendering device
+    metrics = ImageMetrics(eval_ssim, eval_lpips_alex, eval_lpips_vgg)
 
     for i, c2w in enumerate(tqdm(render_poses, desc='Render {}...'.format(seg_type))):
         H, W = HW[i]
         K = Ks[i]
         c2w = torch.Tensor(c2w)
-        rays_o, rays_d, viewdirs = get_rays_of_a_view(
-                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
         keys = ['rgb_marched', 'depth', 'alphainv_last']
         if seg_mask: keys.append('seg_mask_marched')
-        rays_o = rays_o.flatten(0,-2)
-        rays_d = rays_d.flatten(0,-2)
-        viewdirs = viewdirs.flatten(0,-2)
+        rays_chunks = iter_rays_of_a_view(
+                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y, chunk=8192)
         render_result_chunks = [
             {k: v for k, v in model(ro, rd, vd, render_fct=render_fct, **render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
+            for ro, rd, vd in rays_chunks
         ]
         render_result = {
             k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
@@ -65,14 +66,21 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
             print('Testing, rgb shape: ', rgb.shape)
 
         if gt_imgs is not None and render_factor==0:
-            p = -10. * np.log10(np.mean(np.square(rgb - gt_imgs[i])))
+            t_prof = profiler.tic()
+            gt_img = to_float_image(gt_imgs[i])
+            p = -10. * np.log10(np.mean(np.square(rgb - gt_img)))
             psnrs.append(p)
-            if eval_ssim:
-                ssims.append(rgb_ssim(rgb, gt_imgs[i], max_val=1))
-            if eval_lpips_alex:
-                lpips_alex.append(rgb_lpips(rgb, gt_imgs[i], net_name='alex', device=c2w.device))
-            if eval_lpips_vgg:
-                lpips_vgg.append(rgb_lpips(rgb, gt_imgs[i], net_name='vgg', device=c2w.device))
+            metrics.add(render_result['rgb_marched'], gt_img)
+            profiler.toc('eval', t_prof)
+
+    t_prof = profiler.tic()
+    metrics.flush()
+    profiler.toc('eval', t_prof)
+    ssims, lpips_alex, lpips_vgg = metrics.ssims, metrics.lpips_alex, metrics.lpips_vgg
+
+    if savedir is not None:
+        profiler.save(savedir, 'render_profile')
+        profiler.reset()
 
     if len(psnrs):
         print('Testing psnr', np.mean(psnrs), '(avg)')
@@ -11,7 +11,9 @@ import torch
 from torch import Tensor
 from tqdm import tqdm
 
-from . import utils
+from . import utils, ckpt_utils
+from .profiler import profiler
+from .ray_utils import iter_rays_of_a_view
 # from .scene_property import INPUT_BOX, INPUT_POINT
 from .self_prompting import mask_to_prompt
 from .prepare_prompts import get_prompt_points
@@ -55,6 +57,16 @@ class Sam3D(ABC):
         self.data_dict = data_dict
         self.stage = stage
         self.coarse_ckpt_path = coarse_ckpt_path
+        # coarse-to-fine segmentation grid: upsample seg_mask_grid at these view counts
+        self.seg_pg_scale = list(cfg_train.get('seg_pg_scale', []))
+        # number of views trained so far (views may be re-trained or skipped in the GUI)
+        self.n_trained_views = 0
+        # per-view (time, IoU) records to compare against the single-resolution path
+        self.seg_curve = []
+        self.step_ious = []
+        self.seg_start_time = None
+        # the segmentation checkpoint is written in background
+        self.ckpt_writer = ckpt_utils.CheckpointWriter(save_optimizer=cfg_train.get('ckpt_save_optimizer', True))
 
 
     def init_model(self):
@@ -111,6 +123,8 @@ class Sam3D(ABC):
                     'render_depth': True,
                 },
             }
+        if len(self.seg_pg_scale):
+            model.scale_seg_mask_grid(self.seg_world_size(model, len(self.seg_pg_scale)))
         self.optimizer = utils.create_segmentation_optimizer(model, self.cfg_train)
 
         with torch.no_grad():
@@ -121,6 +135,31 @@ class Sam3D(ABC):
         return init_image
 
 
+    def seg_world_size(self, model, n_rest_scales):
+        '''The segmentation grid resolution with n_rest_scales upsamplings left'''
+        return (model.world_size // (2**n_rest_scales)).clamp(min=2)
+
+
+    def scale_seg_mask_grid(self, n_views):
+        '''Upsample the segmentation grid if n_views reaches a seg_pg_scale checkpoint'''
+        if n_views not in self.seg_pg_scale:
+            return
+        model = self.render_viewpoints_kwargs['model']
+        n_rest_scales = len(self.seg_pg_scale) - self.seg_pg_scale.index(n_views) - 1
+        model.scale_seg_mask_grid(self.seg_world_size(model, n_rest_scales))
+        # the optimizer holds the replaced parameters
+        self.optimizer = utils.create_segmentation_optimizer(model, self.cfg_train)
+        torch.cuda.empty_cache()
+
+
+    def finish_seg_mask_grid(self):
+        '''Make sure the segmentation grid ends at the full model resolution'''
+        model = self.render_viewpoints_kwargs['model']
+        if list(model.seg_mask_grid.grid.shape[2:]) != model.world_size.tolist():
+            model.scale_seg_mask_grid(model.world_size)
+            self.optimizer = utils.create_segmentation_optimizer(model, self.cfg_train)
+
+
     def render_view(self, idx, cam_params=None, render_fct=0.0):
         # Training seg
         if cam_params is None:
@@ -135,16 +174,15 @@ class Sam3D(ABC):
         c2w = render_poses[idx]
         H, W = HW[idx]; K = Ks[idx]
         ndc = self.cfg.data.ndc
-        rays_o, rays_d, viewdirs = utils.get_rays_of_a_view(
+        rays_chunks = iter_rays_of_a_view(
                 H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=self.cfg.data.flip_x, flip_y=self.cfg.data.flip_y)
+                flip_x=self.cfg.data.flip_x, flip_y=self.cfg.data.flip_y, chunk=8192)
         
         keys = ['rgb_marched', 'depth', 'alphainv_last', 'seg_mask_marched']
         if self.stage == 'fine': keys.append('dual_seg_mask_marched')
-        rays_o, rays_d, viewdirs = [arr.flatten(0, -2) for arr in [rays_o, rays_d, viewdirs]]
         render_result_chunks = [
             {k: v for k, v in model(ro, rd, vd, distill_active=False, render_fct=render_fct, **render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
+            for ro, rd, vd in rays_chunks
         ]
         render_result = {
             k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
@@ -184,10 +222,17 @@ class Sam3D(ABC):
         assert(idx < len(render_poses))
 
         start_time = time.time()
+        if self.seg_start_time is None:
+            self.seg_start_time = start_time
+        self.scale_seg_mask_grid(self.n_trained_views)
+        self.step_ious = []
 
+        t_prof = profiler.tic()
         rgb, depth, bgmap, seg_m, dual_seg_m = self.render_view(idx, [render_poses, HW, Ks])
+        t_prof = profiler.toc('render_view', t_prof)
         if sam_mask is None:
             self.predictor.set_image(utils.to8b(rgb.cpu().numpy()))
+            profiler.toc('sam_encode', t_prof)
             sam_seg_show = self.prompt_and_inverse(idx, HW, seg_m, dual_seg_m, depth)
         else:
             self.inverse(seg_m, sam_mask)
@@ -202,14 +247,34 @@ class Sam3D(ABC):
         end_time = time.time()  # Stop timer
         elapsed_time = end_time - start_time
         print(f"Training step {idx+1}/{len(render_poses)} completed in {elapsed_time:.2f} seconds.")
+        self.n_trained_views += 1
+        self.seg_curve.append({
+            'view': idx,
+            'n_views': self.n_trained_views,
+            'time': end_time - self.seg_start_time,
+            'iou': float(np.mean(self.step_ious)) if len(self.step_ious) else None,
+            'seg_world_size': list(self.render_viewpoints_kwargs['model'].seg_mask_grid.grid.shape[2:]),
+        })
 
         return recolored_img, sam_seg_show, idx >= len(render_poses)-1
 
 
+    def save_seg_curve(self):
+        '''Dump the time-to-IoU curve of this segmentation run'''
+        path = os.path.join(self.base_save_dir, f'{self.stage}_seg_curve'+self.e_flag+'.json')
+        with open(path, 'w') as f:
+            json.dump({'seg_pg_scale': self.seg_pg_scale, 'curve': self.seg_curve}, f, indent=2)
+        print(f'Segmentation time-to-IoU curve saved in {path}')
+
+
     def save_ckpt(self):
+        self.finish_seg_mask_grid()
+        self.save_seg_curve()
+        profiler.save(self.base_save_dir, f'{self.stage}_seg_profile'+self.e_flag)
+        profiler.reset()
         if self.args.save_ckpt:
             model = self.render_viewpoints_kwargs['model']
-            torch.save({
+            self.ckpt_writer.save({
                 'model_kwargs': model.get_kwargs(),
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': self.optimizer.state_dict(),
@@ -363,11 +428,13 @@ class Sam3D(ABC):
 
                 masks, selected = None, -1
                 if len(prompt_points) != 0:
+                    t_prof = profiler.tic()
                     masks, scores, logits = self.predictor.predict(
                         point_coords=prompt_points,
                         point_labels=input_label,
                         multimask_output=False,
                     )
+                    profiler.toc('sam_decode', t_prof)
                     selected = np.argmax(scores)
 
             if num == 0:
@@ -390,6 +457,7 @@ class Sam3D(ABC):
                 tmp_rendered_mask[tmp_rendered_mask != 0] = 1
                 tmp_IoU = utils.cal_IoU(torch.as_tensor(masks[selected]).float(), tmp_rendered_mask)
                 print(f"current IoU is: {tmp_IoU}")
+                self.step_ious.append(tmp_IoU.item())
                 if tmp_IoU < 0.5:
                     print("SKIP, unacceptable sam prediction, IoU is", tmp_IoU)
                     continue
@@ -446,22 +514,26 @@ class Sam3D(ABC):
                     prompt_points = np.concatenate([ori_prompt_points, dual_prompt_points], axis = 0)
                     input_label = np.concatenate([ori_input_label, 1-dual_input_label], axis = 0)
                     # generate mask
+                    t_prof = profiler.tic()
                     masks, scores, logits = self.predictor.predict(
                         point_coords=prompt_points,
                         point_labels=input_label,
                         multimask_output=False,
                     )
+                    profiler.toc('sam_decode', t_prof)
                     
                 # dual self-prompting
                 if num_dual_self_prompts != 0:
                     prompt_points = np.concatenate([ori_prompt_points, dual_prompt_points], axis = 0)
                     input_label = np.concatenate([1-ori_input_label, dual_input_label], axis = 0)
                     # generate dual mask
+                    t_prof = profiler.tic()
                     dual_masks, dual_scores, dual_logits = self.predictor.predict(
                         point_coords=prompt_points,
                         point_labels=input_label,
                         multimask_output=False,
                     )
+                    profiler.toc('sam_decode', t_prof)
 
             r = 8
             if num == 0:
@@ -487,6 +559,7 @@ class Sam3D(ABC):
             if masks is not None:
                 tmp_IoU = utils.cal_IoU(torch.as_tensor(masks[0]).float(), tmp_rendered_mask)
                 print("tmp_IoU:", tmp_IoU)
+                self.step_ious.append(tmp_IoU.item())
                 if tmp_IoU < 0.5:
                     print("SKIP, unacceptable sam prediction for original seg, IoU is", tmp_IoU)
                 else:
@@ -556,7 +629,9 @@ def optim(optimizer, loss, clip=None, model=None):
     """
     if isinstance(loss, torch.Tensor):
         optimizer.zero_grad()
+        t_prof = profiler.tic()
         loss.backward()
+        t_prof = profiler.toc('backward', t_prof)
         if clip is not None:
             torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
         if model is not None:
@@ -569,6 +644,7 @@ def optim(optimizer, loss, clip=None, model=None):
             with torch.no_grad():
                 model.mask_view_counts += (model.seg_mask_grid.grid != prev_mask_grid)
                 model.seg_mask_grid.grid /= (model.mask_view_counts + 1e-9)
+        profiler.toc('optimizer_step', t_prof)
     else:
         pass
 
@@ -10,6 +10,8 @@ import torch.nn.functional as F
 from torch_scatter import segment_coo
 
 from . import grid
+from .profiler import profiler
+from .ray_utils import get_rays, ndc_rays, get_rays_of_a_view, get_rays_of_views
 from torch.utils.cpp_extension import load
 parent_dir = os.path.dirname(os.path.abspath(__file__))
 render_utils_cuda = load(
@@ -134,12 +136,7 @@ class DirectVoxGO(torch.nn.Module):
             mask_cache = grid.MaskGrid(
                     path=mask_cache_path,
                     mask_cache_thres=mask_cache_thres).to(self.xyz_min.device)
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], mask_cache_world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], mask_cache_world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], mask_cache_world_size[2]),
-            ), -1)
-            mask = mask_cache(self_grid_xyz)
+            mask = grid.sample_on_lattice(mask_cache, self.xyz_min, self.xyz_max, mask_cache_world_size)
         else:
             mask = torch.ones(list(mask_cache_world_size), dtype=torch.bool)
         self.mask_cache = grid.MaskGrid(
@@ -181,12 +178,13 @@ class DirectVoxGO(torch.nn.Module):
     def change_num_objects(self, num_obj):
         self.num_objects = num_obj
         device = self.seg_mask_grid.grid.device
+        seg_world_size = torch.LongTensor(list(self.seg_mask_grid.grid.shape[2:]))
         self.seg_mask_grid = grid.create_grid(
-                'DenseGrid', channels=self.num_objects, world_size=self.world_size,
+                'DenseGrid', channels=self.num_objects, world_size=seg_world_size,
                 xyz_min=self.xyz_min, xyz_max=self.xyz_max,
                 config=self.density_config)
         self.dual_seg_mask_grid = grid.create_grid(
-                'DenseGrid', channels=self.num_objects, world_size=self.world_size,
+                'DenseGrid', channels=self.num_objects, world_size=seg_world_size,
                 xyz_min=self.xyz_min, xyz_max=self.xyz_max,
                 config=self.density_config)
         self.seg_mask_grid.to(device)
@@ -211,20 +209,29 @@ class DirectVoxGO(torch.nn.Module):
     @torch.no_grad()
     def change_to_fine_mode(self):
         self.mode = 'fine'
+
+    @torch.no_grad()
+    def scale_seg_mask_grid(self, seg_world_size):
+        '''Resample the segmentation grids to seg_world_size while the density,
+        k0 and mask cache stay at the model resolution (coarse-to-fine segmentation).
+        '''
+        seg_world_size = torch.LongTensor([int(s) for s in seg_world_size])
+        ori_world_size = list(self.seg_mask_grid.grid.shape[2:])
+        print('dvgo: scale_seg_mask_grid scale world_size from', ori_world_size, 'to', seg_world_size.tolist())
+        self.seg_mask_grid.scale_volume_grid(seg_world_size)
+        self.dual_seg_mask_grid.scale_volume_grid(seg_world_size)
+        self.seg_mask_grid.world_size = seg_world_size
+        self.dual_seg_mask_grid.world_size = seg_world_size
+        self.mask_view_counts = F.interpolate(
+                self.mask_view_counts, size=tuple(seg_world_size.tolist()), mode='trilinear', align_corners=True)
     
     @torch.no_grad()
     def maskout_near_cam_vox(self, cam_o, near_clip):
         # maskout grid points that between cameras and their near planes
-        self_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-        ), -1)
-        nearest_dist = torch.stack([
-            (self_grid_xyz.unsqueeze(-2) - co).pow(2).sum(-1).sqrt().amin(-1)
-            for co in cam_o.split(100)  # for memory saving
-        ]).amin(0)
-        self.density.grid[nearest_dist[None,None] <= near_clip] = -100
+        # only the voxels within near_clip of some camera are visited
+        near_ind = grid.lattice_within_radius(
+                cam_o.to(self.xyz_min), near_clip, self.xyz_min, self.xyz_max, self.world_size)
+        self.density.grid.view(-1)[near_ind] = -100
 
     @torch.no_grad()
     def scale_volume_grid(self, num_voxels):
@@ -239,31 +246,28 @@ class DirectVoxGO(torch.nn.Module):
         self.k0.scale_volume_grid(self.world_size)
 
         if np.prod(self.world_size.tolist()) <= 256**3:
-            self_grid_xyz = torch.stack(torch.meshgrid(
-                torch.linspace(self.xyz_min[0], self.xyz_max[0], self.world_size[0]),
-                torch.linspace(self.xyz_min[1], self.xyz_max[1], self.world_size[1]),
-                torch.linspace(self.xyz_min[2], self.xyz_max[2], self.world_size[2]),
-            ), -1)
+            self_mask = grid.sample_on_lattice(self.mask_cache, self.xyz_min, self.xyz_max, self.world_size)
             self_alpha = F.max_pool3d(self.activate_density(self.density.get_dense_grid()), kernel_size=3, padding=1, stride=1)[0,0]
             self.mask_cache = grid.MaskGrid(
-                    path=None, mask=self.mask_cache(self_grid_xyz) & (self_alpha>self.fast_color_thres),
+                    path=None, mask=self_mask & (self_alpha>self.fast_color_thres),
                     xyz_min=self.xyz_min, xyz_max=self.xyz_max)
 
         print('dvgo: scale_volume_grid finish')
 
     @torch.no_grad()
     def update_occupancy_cache(self):
-        cache_grid_xyz = torch.stack(torch.meshgrid(
-            torch.linspace(self.xyz_min[0], self.xyz_max[0], self.mask_cache.mask.shape[0]),
-            torch.linspace(self.xyz_min[1], self.xyz_max[1], self.mask_cache.mask.shape[1]),
-            torch.linspace(self.xyz_min[2], self.xyz_max[2], self.mask_cache.mask.shape[2]),
-        ), -1)
-        cache_grid_density = self.density(cache_grid_xyz)[None,None]
+        cache_grid_density = grid.sample_on_lattice(
+                self.density, self.xyz_min, self.xyz_max, self.mask_cache.mask.shape)[None,None]
         cache_grid_alpha = self.activate_density(cache_grid_density)
         cache_grid_alpha = F.max_pool3d(cache_grid_alpha, kernel_size=3, padding=1, stride=1)[0,0]
         self.mask_cache.mask &= (cache_grid_alpha > self.fast_color_thres)
 
-    def voxel_count_views(self, rays_o_tr, rays_d_tr, imsz, near, far, stepsize, downrate=1, irregular_shape=False):
+    @torch.no_grad()
+    def voxel_count_views(self, rays_o_tr, rays_d_tr, imsz, near, far, stepsize, downrate=1, irregular_shape=False, count_device=None):
+        '''Count the number of views seeing each voxel.
+        The trilinear weights of the samples are scatter-added per image (see grid.trilinear_splat),
+        which runs on any device (e.g. count_device='cpu').
+        '''
         print('dvgo: voxel_count_views start')
         far = 1e9  # the given far can be too small while rays stop when hitting scene bbox
         eps_time = time.time()
@@ -271,40 +275,50 @@ class DirectVoxGO(torch.nn.Module):
         rng = torch.arange(N_samples)[None].float()
         count = torch.zeros_like(self.density.get_dense_grid())
 
-        device = rng.device
+        device = rng.device if count_device is None else torch.device(count_device)
+        rng = rng.to(device)
+        xyz_min = self.xyz_min.to(device)
+        xyz_max = self.xyz_max.to(device)
+        voxel_size = self.voxel_size.item()
         for rays_o_, rays_d_ in zip(rays_o_tr.split(imsz), rays_d_tr.split(imsz)):
-            ones = grid.DenseGrid(1, self.world_size, self.xyz_min, self.xyz_max)
+            hits = torch.zeros([count.numel()], device=device)
             if irregular_shape:
                 rays_o_ = rays_o_.split(10000)
                 rays_d_ = rays_d_.split(10000)
+            elif rays_o_.dim() == 2:
+                # the rays kept of a view (e.g., in_maskcache): subsample them at the same rate
+                rays_o_ = rays_o_[::downrate**2].split(10000)
+                rays_d_ = rays_d_[::downrate**2].split(10000)
             else:
                 rays_o_ = rays_o_[::downrate, ::downrate].to(device).flatten(0,-2).split(10000)
                 rays_d_ = rays_d_[::downrate, ::downrate].to(device).flatten(0,-2).split(10000)
 
             for rays_o, rays_d in zip(rays_o_, rays_d_):
+                rays_o = rays_o.to(device)
+                rays_d = rays_d.to(device)
                 vec = torch.where(rays_d==0, torch.full_like(rays_d, 1e-6), rays_d)
-                rate_a = (self.xyz_max - rays_o) / vec
-                rate_b = (self.xyz_min - rays_o) / vec
+                rate_a = (xyz_max - rays_o) / vec
+                rate_b = (xyz_min - rays_o) / vec
                 t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(min=near, max=far)
-                t_max = torch.maximum(rate_a, rate_b).amin(-1).clamp(min=near, max=far)
-                step = stepsize * self.voxel_size * rng
-                interpx = (t_min[...,None] + step/rays_d.norm(dim=-1,keepdim=True))
-                rays_pts = rays_o[...,None,:] + rays_d[...,None,:] * interpx[...,None]
-                ones(rays_pts).sum().backward()
-            with torch.no_grad():
-                count += (ones.grid.grad > 1)
+                # only a chunk of the samples on the rays is materialized at a time
+                for rng_ in rng.split(128, dim=-1):
+                    step = stepsize * voxel_size * rng_
+                    interpx = (t_min[...,None] + step/rays_d.norm(dim=-1,keepdim=True))
+                    rays_pts = rays_o[...,None,:] + rays_d[...,None,:] * interpx[...,None]
+                    grid.trilinear_splat(rays_pts.reshape(-1,3), xyz_min, xyz_max, self.world_size, hits)
+            count += (hits > 1).view(count.shape).to(count.device)
         eps_time = time.time() - eps_time
         print('dvgo: voxel_count_views finish (eps time:', eps_time, 'sec)')
 
         return count
 
-    def density_total_variation_add_grad(self, weight, dense_mode):
+    def density_total_variation_add_grad(self, weight, dense_mode, mask=None):
         w = weight * self.world_size.max() / 128
-        self.density.total_variation_add_grad(w, w, w, dense_mode)
+        self.density.total_variation_add_grad(w, w, w, dense_mode, mask)
 
-    def k0_total_variation_add_grad(self, weight, dense_mode):
+    def k0_total_variation_add_grad(self, weight, dense_mode, mask=None):
         w = weight * self.world_size.max() / 128
-        self.k0.total_variation_add_grad(w, w, w, dense_mode)
+        self.k0.total_variation_add_grad(w, w, w, dense_mode, mask)
 
 
     def activate_density(self, density, interval=None):
@@ -362,11 +376,14 @@ class DirectVoxGO(torch.nn.Module):
         ret_dict = {}
         N = len(rays_o)
 
+        t_prof = profiler.tic()
         # sample points on rays
         ray_pts, ray_id, step_id = self.sample_ray(
                 rays_o=rays_o, rays_d=rays_d, **render_kwargs)
         interval = render_kwargs['stepsize'] * self.voxel_size_ratio
 
+        t_prof = profiler.toc('sample_ray', t_prof)
+
         # skip known free space
         if self.mask_cache is not None:
             mask = self.mask_cache(ray_pts)
@@ -378,6 +395,8 @@ class DirectVoxGO(torch.nn.Module):
 #         print(self.fast_color_thres, "self.fast_color_thres")
         render_fct = max(render_fct, self.fast_color_thres)
 
+        t_prof = profiler.toc('mask_cache', t_prof)
+
         # query for alpha w/ post-activation
         density = self.density(ray_pts)
         alpha = self.activate_density(density, interval) 
@@ -391,6 +410,8 @@ class DirectVoxGO(torch.nn.Module):
             alpha = alpha[mask]
 
 
+        t_prof = profiler.toc('density_alpha', t_prof)
+
         # compute accumulated transmittance
         weights, alphainv_last = Alphas2Weights.apply(alpha, ray_id, N)
         
@@ -404,6 +425,8 @@ class DirectVoxGO(torch.nn.Module):
             ray_id = ray_id[mask]
             step_id = step_id[mask]
 
+        t_prof = profiler.toc('alphas2weights', t_prof)
+
         # query for segmentation mask
         # only optimize the mask volume
         if self.seg_mask_grid.grid.requires_grad:
@@ -417,6 +440,8 @@ class DirectVoxGO(torch.nn.Module):
                 dual_mask_pred = self.dual_seg_mask_grid(ray_pts)
                 
 
+        t_prof = profiler.toc('seg_mask', t_prof)
+
         # query for color
         if self.rgbnet_full_implicit:
             pass
@@ -444,6 +469,8 @@ class DirectVoxGO(torch.nn.Module):
             else:
                 rgb = torch.sigmoid(rgb_logit + k0_diffuse)
 
+        t_prof = profiler.toc('k0_rgbnet', t_prof)
+
         # Ray marching
 #         print("weight, rgb shape", weights.shape, rgb.shape)
         rgb_marched = segment_coo(
@@ -527,6 +554,8 @@ class DirectVoxGO(torch.nn.Module):
                         reduce='sum')
             ret_dict.update({'depth': depth})
 
+        profiler.toc('composite', t_prof)
+        profiler.record_samples_per_ray(ray_id, N)
         return ret_dict
 
     @torch.no_grad()
@@ -671,37 +700,6 @@ class Alphas2Weights(torch.autograd.Function):
 
 ''' Ray and batch
 '''
-def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
-    i, j = torch.meshgrid(
-        torch.linspace(0, W-1, W, device=c2w.device),
-        torch.linspace(0, H-1, H, device=c2w.device))  # pytorch's meshgrid has indexing='ij'
-    i = i.t().float()
-    j = j.t().float()
-    if mode == 'lefttop':
-        pass
-    elif mode == 'center':
-        i, j = i+0.5, j+0.5
-    elif mode == 'random':
-        i = i+torch.rand_like(i)
-        j = j+torch.rand_like(j)
-    else:
-        raise NotImplementedError
-
-    if flip_x:
-        i = i.flip((1,))
-    if flip_y:
-        j = j.flip((0,))
-    if inverse_y:
-        dirs = torch.stack([(i-K[0][2])/K[0][0], (j-K[1][2])/K[1][1], torch.ones_like(i)], -1)
-    else:
-        dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
-    # Rotate ray directions from camera frame to the world frame
-    rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
-    # Translate camera frame's origin to the world frame. It is the origin of all rays.
-    rays_o = c2w[:3,3].expand(rays_d.shape)
-    return rays_o, rays_d
-
-
 def get_rays_np(H, W, K, c2w):
     i, j = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32), indexing='xy')
     dirs = np.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -np.ones_like(i)], -1)
@@ -712,34 +710,6 @@ def get_rays_np(H, W, K, c2w):
     return rays_o, rays_d
 
 
-def ndc_rays(H, W, focal, near, rays_o, rays_d):
-    # Shift ray origins to near plane
-    t = -(near + rays_o[...,2]) / rays_d[...,2]
-    rays_o = rays_o + t[...,None] * rays_d
-
-    # Projection
-    o0 = -1./(W/(2.*focal)) * rays_o[...,0] / rays_o[...,2]
-    o1 = -1./(H/(2.*focal)) * rays_o[...,1] / rays_o[...,2]
-    o2 = 1. + 2. * near / rays_o[...,2]
-
-    d0 = -1./(W/(2.*focal)) * (rays_d[...,0]/rays_d[...,2] - rays_o[...,0]/rays_o[...,2])
-    d1 = -1./(H/(2.*focal)) * (rays_d[...,1]/rays_d[...,2] - rays_o[...,1]/rays_o[...,2])
-    d2 = -2. * near / rays_o[...,2]
-
-    rays_o = torch.stack([o0,o1,o2], -1)
-    rays_d = torch.stack([d0,d1,d2], -1)
-
-    return rays_o, rays_d
-
-
-def get_rays_of_a_view(H, W, K, c2w, ndc, inverse_y, flip_x, flip_y, mode='center'):
-    rays_o, rays_d = get_rays(H, W, K, c2w, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y, mode=mode)
-    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
-    if ndc:
-        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
-    return rays_o, rays_d, viewdirs
-
-
 @torch.no_grad()
 def get_training_rays(rgb_tr, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y):
     print('get_training_rays: start')
@@ -753,12 +723,14 @@ def get_training_rays(rgb_tr, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_
     rays_d_tr = torch.zeros([len(rgb_tr), H, W, 3], device=rgb_tr.device)
     viewdirs_tr = torch.zeros([len(rgb_tr), H, W, 3], device=rgb_tr.device)
     imsz = [1] * len(rgb_tr)
-    for i, c2w in enumerate(train_poses):
-        rays_o, rays_d, viewdirs = get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w, ndc=ndc, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
-        rays_o_tr[i].copy_(rays_o.to(rgb_tr.device))
-        rays_d_tr[i].copy_(rays_d.to(rgb_tr.device))
-        viewdirs_tr[i].copy_(viewdirs.to(rgb_tr.device))
+    # the views share the camera model: rotate the cached directions of a group of views at once
+    CHUNK = 16
+    for i in range(0, len(train_poses), CHUNK):
+        rays_o, rays_d, viewdirs = get_rays_of_views(
+                H=H, W=W, K=K, c2ws=train_poses[i:i+CHUNK], ndc=ndc, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y)
+        rays_o_tr[i:i+CHUNK].copy_(rays_o)
+        rays_d_tr[i:i+CHUNK].copy_(rays_d)
+        viewdirs_tr[i:i+CHUNK].copy_(viewdirs)
         del rays_o, rays_d, viewdirs
     eps_time = time.time() - eps_time
     print('get_training_rays: finish (eps time:', eps_time, 'sec)')
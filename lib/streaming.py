@@ -0,0 +1,155 @@
+import time
+import queue
+import threading
+
+import numpy as np
+import torch
+
+from .dvgo import CompactTrainingRays
+from .image_io import LazyImages
+
+
+class StreamingTrainingRays:
+    '''Training rays of long captures in bounded memory.
+    Only a working set of n_views decoded views is resident, in a ring buffer of uint8 slots.
+    A background thread decodes the views (a new random permutation of the training views per epoch)
+    and every refresh_every sampled batches the oldest slot is replaced by the next decoded view
+    (without waiting if it is not decoded yet).
+    The rays are regenerated from the per-view pose and intrinsics as in CompactTrainingRays.
+    The view order and the sampled rays are drawn from generators of their own seeded by seed
+    (drawn from the global numpy RNG if None), so the background thread does not consume the global RNGs.
+    '''
+    def __init__(self, images, i_train, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y,
+                 n_views, refresh_every=100, n_prefetch=2, device='cpu', seed=None):
+        if isinstance(images, LazyImages):
+            images = images.uncached()
+        self.images = images
+        self.i_train = np.asarray(i_train)
+        self.n_views = min(int(n_views), len(self.i_train))
+        self.refresh_every = max(1, int(refresh_every))
+        HW = np.asarray(HW)
+        if seed is None:
+            seed = int(np.random.randint(2**31))
+        self.rng = np.random.default_rng(seed)
+        self.generator = torch.Generator(device=device).manual_seed(seed)
+        self.slots = torch.zeros([self.n_views, int(HW.prod(-1).max()), 3], dtype=torch.uint8, device=device)
+        self.slot_view = torch.zeros([self.n_views], dtype=torch.long, device=device)
+        self.slot_npix = torch.ones([self.n_views], dtype=torch.long, device=device)
+        # only the ray generation is used (pix_id=None: the pixel indices run over all the training views)
+        self.rays = CompactTrainingRays(self.slots, None, train_poses, HW, Ks, ndc, inverse_y, flip_x, flip_y)
+        self.imsz = self.rays.imsz
+        self.n_batches = 0
+        self.n_loaded = 0
+        self.wait_sec = 0.
+        self._next_slot = 0
+        self.queue = queue.Queue(maxsize=n_prefetch)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        print(f'StreamingTrainingRays: {self.n_views} / {len(self.i_train)} views resident '
+              f'({self.slots.numel() / 2**20:.1f} MB)')
+        for _ in range(self.n_views):
+            self._swap_in(block=True)
+
+    def _worker(self):
+        try:
+            while not self.stopped.is_set():
+                for v in self.rng.permutation(len(self.i_train)):
+                    img = torch.as_tensor(self.images[int(self.i_train[v])])
+                    if img.dtype != torch.uint8:
+                        img = (img * 255).round().clamp(0, 255).to(torch.uint8)
+                    self._put((int(v), img[..., :3].reshape(-1, 3)))
+                    if self.stopped.is_set():
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _swap_in(self, block):
+        '''Replace the oldest slot by the next decoded view'''
+        eps_time = time.time()
+        try:
+            item = self.queue.get(block=block)
+        except queue.Empty:
+            return False
+        self.wait_sec += time.time() - eps_time
+        if isinstance(item, Exception):
+            raise item
+        v, img = item
+        s = self._next_slot
+        self.slots[s, :len(img)].copy_(img)
+        self.slot_view[s] = v
+        self.slot_npix[s] = len(img)
+        self._next_slot = (s + 1) % self.n_views
+        self.n_loaded += 1
+        return True
+
+    def sample(self, N):
+        '''Return the normalized rgb, rays_o, rays_d, viewdirs of N rays drawn from the working set'''
+        if self.n_batches > 0 and self.n_batches % self.refresh_every == 0:
+            self._swap_in(block=False)
+        self.n_batches += 1
+        device = self.slots.device
+        slot = torch.randint(self.n_views, [N], device=device, generator=self.generator)
+        pix = (torch.rand([N], device=device, generator=self.generator) * self.slot_npix[slot]).long()
+        target = self.slots[slot, pix].float() / 255
+        sel_i = self.rays.pix_offsets[self.slot_view[slot]] + pix
+        rays_o, rays_d, viewdirs = self.rays.get_rays(sel_i)
+        return target, rays_o, rays_d, viewdirs
+
+    def view_rays(self, key):
+        '''The per-view rays of all the training views (see CompactTrainingRays.view_rays)'''
+        return self.rays.view_rays(key)
+
+    def stats(self):
+        return {
+            'streaming_views': self.n_views,
+            'train_views': len(self.i_train),
+            'views_loaded': self.n_loaded,
+            'epochs': self.n_loaded / len(self.i_train),
+            'resident_mb': self.slots.numel() / 2**20,
+            'wait_sec': self.wait_sec,
+        }
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    # Smoke test: stream the training rays of a synthetic llff scene loaded lazily as run.py does
+    import os
+    import tempfile
+    from .config_loader import Config
+    from .load_llff import _write_synthetic_scene
+    from .utils import load_everything
+    cfg = Config.fromfile(os.path.join(os.path.dirname(__file__), '..', 'configs', 'default.py'))
+    with tempfile.TemporaryDirectory() as basedir:
+        _write_synthetic_scene(basedir, n_views=8, H=24, W=32)
+        cfg.data.update(datadir=basedir, dataset_type='llff', factor=None, llffhold=4, streaming_views=3)
+        data_dict = load_everything(args=None, cfg=cfg, lazy_images=True)
+        i_train = data_dict['i_train']
+        rays = StreamingTrainingRays(
+                images=data_dict['images'], i_train=i_train,
+                train_poses=data_dict['poses'][i_train],
+                HW=data_dict['HW'][i_train], Ks=data_dict['Ks'][i_train],
+                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
+                n_views=cfg.data.streaming_views, refresh_every=2, seed=0)
+        try:
+            for _ in range(50):
+                target, rays_o, rays_d, viewdirs = rays.sample(64)
+                assert target.shape == rays_o.shape == rays_d.shape == viewdirs.shape == (64, 3)
+                assert 0 <= target.min() and target.max() <= 1 and torch.isfinite(rays_d).all()
+            stats = rays.stats()
+        finally:
+            rays.close()
+        assert stats['views_loaded'] >= stats['streaming_views'], stats
+    print('StreamingTrainingRays: smoke test passed', stats)
@@ -1,5 +1,7 @@
 import copy
+import queue
 import random
+import threading
 
 import numpy as np
 import scipy.signal
@@ -11,7 +13,11 @@ from lib import seg_dvgo as dvgo
 from lib import seg_dcvgo as dcvgo
 
 from .load_data import load_data
+from .data_cache import load_data_cached
+from .image_io import LazyImages
 from .masked_adam import MaskedAdam
+from .grid import DenseGrid
+from .ray_utils import get_rays, ndc_rays, get_rays_of_a_view
 from torch import Tensor
 
 ''' Misc
@@ -45,10 +51,11 @@ def cal_IoU(a: Tensor, b: Tensor) -> Tensor:
     return intersection / union
 
 
-def load_everything(args, cfg):
+def load_everything(args, cfg, lazy_images=False):
     '''Load images / poses / camera settings / data split.
+    If lazy_images, the images are decoded only when accessed (when supported by the dataset).
     '''
-    data_dict = load_data(cfg.data)
+    data_dict = load_data_cached(cfg.data, lazy_images=lazy_images)
 
     # remove useless field
     kept_keys = {
@@ -59,11 +66,17 @@ def load_everything(args, cfg):
         if k not in kept_keys:
             data_dict.pop(k)
 
-    # construct data tensor
-    if data_dict['irregular_shape']:
-        data_dict['images'] = [torch.FloatTensor(im, device='cpu') for im in data_dict['images']]
+    # construct data tensor (8-bit images are kept in uint8 and normalized when used)
+    if cfg.data.get('uint8_images', True):
+        to_image = lambda im: torch.from_numpy(np.ascontiguousarray(to_uint8_image_if_exact(im)))
     else:
-        data_dict['images'] = torch.FloatTensor(data_dict['images'], device='cpu')
+        to_image = lambda im: torch.FloatTensor(im, device='cpu')
+    if isinstance(data_dict['images'], LazyImages):
+        data_dict['images'] = data_dict['images'].with_transform(to_image, stack=stack_images)
+    elif data_dict['irregular_shape']:
+        data_dict['images'] = [to_image(im) for im in data_dict['images']]
+    else:
+        data_dict['images'] = to_image(data_dict['images'])
     data_dict['poses'] = torch.Tensor(data_dict['poses'])
     data_dict['render_poses'] = torch.Tensor(data_dict['render_poses'])
 
@@ -116,6 +129,95 @@ def to_tensor(array, device=torch.device('cuda')):
     return array.float()
 
 
+def to_uint8_image(img):
+    '''Quantize an image in [0, 1] into uint8; uint8 images are returned as is
+    '''
+    if img.dtype == np.uint8:
+        return img
+    return (np.clip(img, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+def to_uint8_image_if_exact(img, atol=1e-6):
+    '''to_uint8_image only if it is lossless (the loader decoded 8-bit data);
+    other images (e.g., composited over a background or resampled) are returned in float32
+    '''
+    if img.dtype == np.uint8:
+        return img
+    img = np.asarray(img, dtype=np.float32)
+    img8 = to_uint8_image(img)
+    if np.abs(img8 / np.float32(255) - img).max(initial=0) <= atol:
+        return img8
+    return img
+
+
+def stack_images(frames):
+    '''torch.stack of uint8 / float32 frames (promoted to float32 in [0, 1] if the dtypes are mixed)'''
+    if len(set(f.dtype for f in frames)) > 1:
+        frames = [to_float_image(f) for f in frames]
+    return torch.stack(frames)
+
+
+def to_float_image(img):
+    '''Normalize a uint8 image (numpy array or tensor) into float32 in [0, 1]
+    '''
+    if isinstance(img, torch.Tensor):
+        return img.float() / 255 if img.dtype == torch.uint8 else img.float()
+    return img.astype(np.float32) / 255 if img.dtype == np.uint8 else img.astype(np.float32)
+
+
+class BatchPrefetcher:
+    '''Gather the training batches in a background thread and copy them to the device ahead of time.
+    @fetch_fn: callable returning a tuple of CPU tensors (a training batch).
+               It runs in the background thread, so it should draw from generators of its own instead of the global RNGs.
+    Up to n_prefetch batches are staged in pinned memory and copied on a side CUDA stream.
+    '''
+    def __init__(self, fetch_fn, device, n_prefetch=2):
+        self.fetch_fn = fetch_fn
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+        self.queue = queue.Queue(maxsize=n_prefetch)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        try:
+            with torch.cuda.stream(self.stream):
+                while not self.stopped.is_set():
+                    batch = [t.pin_memory().to(self.device, non_blocking=True) for t in self.fetch_fn()]
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+                    self._put((batch, event))
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        batch, event = item
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        for t in batch:
+            t.record_stream(stream)  # the memory is allocated on the side stream
+        return batch
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
 ''' optimizer
 '''
 def create_optimizer_or_freeze_model(model, cfg_train, global_step):
@@ -123,6 +225,7 @@ def create_optimizer_or_freeze_model(model, cfg_train, global_step):
     decay_factor = 0.1 ** (global_step/decay_steps)
 
     param_group = []
+    sparse_grids = []
     for k in cfg_train.keys():
         if not k.startswith('lrate_'):
             continue
@@ -139,13 +242,22 @@ def create_optimizer_or_freeze_model(model, cfg_train, global_step):
         lr = getattr(cfg_train, f'lrate_{k}') * decay_factor
         if lr > 0:
             print(f'create_optimizer_or_freeze_model: param {k} lr {lr}')
+            if k in cfg_train.get('sparse_adam_fields', []):
+                if isinstance(param, DenseGrid):
+                    param.enable_touched_recording()
+                    sparse_grids.append(param)
+                else:
+                    print(f'create_optimizer_or_freeze_model: param {k} is not a DenseGrid, sparse update is ignored')
             if isinstance(param, nn.Module):
                 param = param.parameters()
             param_group.append({'params': param, 'lr': lr, 'skip_zero_grad': (k in cfg_train.skip_zero_grad_fields)})
         else:
             print(f'create_optimizer_or_freeze_model: param {k} freeze')
             param.requires_grad = False
-    return MaskedAdam(param_group)
+    optimizer = MaskedAdam(param_group, fused=cfg_train.get('fused_adam', True))
+    for grid in sparse_grids:
+        optimizer.set_sparse_grid(grid.grid, grid)
+    return optimizer
 
 
 def create_segmentation_optimizer(model, cfg_train):
@@ -186,7 +298,7 @@ def load_checkpoint(model, optimizer, ckpt_path, no_reload_optimizer):
         start = 0
     msg = model.load_state_dict(ckpt['model_state_dict'], strict = False)
     print("NeRF loaded with msg: ", msg)
-    if not no_reload_optimizer:
+    if not no_reload_optimizer and 'optimizer_state_dict' in ckpt:
         optimizer.load_state_dict(ckpt['optimizer_state_dict'])
     return model, optimizer, start
 
@@ -318,67 +430,6 @@ def rgb_lpips(np_gt, np_im, net_name, device):
     return __LPIPS__[net_name](gt, im, normalize=True).item()
 
 
-''' generate rays
-'''
-def get_rays(H, W, K, c2w, inverse_y, flip_x, flip_y, mode='center'):
-    i, j = torch.meshgrid(
-        torch.linspace(0, W-1, W, device=c2w.device),
-        torch.linspace(0, H-1, H, device=c2w.device))  # pytorch's meshgrid has indexing='ij'
-    i = i.t().float()
-    j = j.t().float()
-    if mode == 'lefttop':
-        pass
-    elif mode == 'center':
-        i, j = i+0.5, j+0.5
-    elif mode == 'random':
-        i = i+torch.rand_like(i)
-        j = j+torch.rand_like(j)
-    else:
-        raise NotImplementedError
-
-    if flip_x:
-        i = i.flip((1,))
-    if flip_y:
-        j = j.flip((0,))
-    if inverse_y:
-        dirs = torch.stack([(i-K[0][2])/K[0][0], (j-K[1][2])/K[1][1], torch.ones_like(i)], -1)
-    else:
-        dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
-    # Rotate ray directions from camera frame to the world frame
-    rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
-    # Translate camera frame's origin to the world frame. It is the origin of all rays.
-    rays_o = c2w[:3,3].expand(rays_d.shape)
-    return rays_o, rays_d
-
-
-def ndc_rays(H, W, focal, near, rays_o, rays_d):
-    # Shift ray origins to near plane
-    t = -(near + rays_o[...,2]) / rays_d[...,2]
-    rays_o = rays_o + t[...,None] * rays_d
-
-    # Projection
-    o0 = -1./(W/(2.*focal)) * rays_o[...,0] / rays_o[...,2]
-    o1 = -1./(H/(2.*focal)) * rays_o[...,1] / rays_o[...,2]
-    o2 = 1. + 2. * near / rays_o[...,2]
-
-    d0 = -1./(W/(2.*focal)) * (rays_d[...,0]/rays_d[...,2] - rays_o[...,0]/rays_o[...,2])
-    d1 = -1./(H/(2.*focal)) * (rays_d[...,1]/rays_d[...,2] - rays_o[...,1]/rays_o[...,2])
-    d2 = -2. * near / rays_o[...,2]
-
-    rays_o = torch.stack([o0,o1,o2], -1)
-    rays_d = torch.stack([d0,d1,d2], -1)
-
-    return rays_o, rays_d
-
-
-def get_rays_of_a_view(H, W, K, c2w, ndc, inverse_y, flip_x, flip_y, mode='center'):
-    rays_o, rays_d = get_rays(H, W, K, c2w, inverse_y=inverse_y, flip_x=flip_x, flip_y=flip_y, mode=mode)
-    viewdirs = rays_d / rays_d.norm(dim=-1, keepdim=True)
-    if ndc:
-        rays_o, rays_d = ndc_rays(H, W, K[0][0], 1., rays_o, rays_d)
-    return rays_o, rays_d, viewdirs
-
-
 ''' interactive mode TODO'''
 def fetch_user_define_points():
     pass
@@ -15,10 +15,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch_efficient_distloss import flatten_eff_distloss
 
-from lib import utils, dmpigo
+from lib import utils, dmpigo, ckpt_utils
 from lib import dvgo
 from lib import dcvgo
+from lib import grid
+from lib import ray_utils
+from lib import streaming
+from lib.profiler import profiler
 from lib.load_data import load_data
+from lib.data_cache import load_data_cached
+from lib.image_io import LazyImages
+from lib.metrics import ImageMetrics
+from lib.bbox_utils import get_corner_rays, _compute_bbox_by_cam_frustrm_bounded, _compute_bbox_by_cam_frustrm_unbounded
 
 
 
@@ -53,6 +61,8 @@ def config_parser():
     parser.add_argument("--render_video_factor", type=float, default=0,
                         help='downsampling factor to speed up rendering, set 4 or 8 for fast preview')
     parser.add_argument("--dump_images", action='store_true')
+    parser.add_argument("--profile", action='store_true',
+                        help='time the hot-path phases and export chrome traces and summaries')
     parser.add_argument("--eval_ssim", action='store_true')
     parser.add_argument("--eval_lpips_alex", action='store_true')
     parser.add_argument("--eval_lpips_vgg", action='store_true')
@@ -91,25 +101,21 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
     depths = []
     bgmaps = []
     psnrs = []
-    ssims = []
-    lpips_alex = []
-    lpips_vgg = []
+    # ssim / lpips are evaluated by batches of frames on the rendering device
+    metrics = ImageMetrics(eval_ssim, eval_lpips_alex, eval_lpips_vgg)
 
     for i, c2w in enumerate(tqdm(render_poses)):
 
         H, W = HW[i]
         K = Ks[i]
         c2w = torch.Tensor(c2w)
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
         keys = ['rgb_marched', 'depth', 'alphainv_last']
-        rays_o = rays_o.flatten(0,-2).to(device)
-        rays_d = rays_d.flatten(0,-2).to(device)
-        viewdirs = viewdirs.flatten(0,-2).to(device)
+        rays_chunks = ray_utils.iter_rays_of_a_view(
+                H, W, K, c2w, ndc, inverse_y=render_kwargs['inverse_y'],
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y, chunk=8192, device=device)
         render_result_chunks = [
             {k: v for k, v in model(ro, rd, vd, render_fct=render_fct, **render_kwargs).items() if k in keys}
-            for ro, rd, vd in zip(rays_o.split(8192, 0), rays_d.split(8192, 0), viewdirs.split(8192, 0))
+            for ro, rd, vd in rays_chunks
         ]
         render_result = {
             k: torch.cat([ret[k] for ret in render_result_chunks]).reshape(H,W,-1)
@@ -126,14 +132,21 @@ def render_viewpoints(model, render_poses, HW, Ks, ndc, render_kwargs,
             print('Testing', rgb.shape)
 
         if gt_imgs is not None and render_factor==0:
-            p = -10. * np.log10(np.mean(np.square(rgb - gt_imgs[i])))
+            t_prof = profiler.tic()
+            gt_img = utils.to_float_image(gt_imgs[i])
+            p = -10. * np.log10(np.mean(np.square(rgb - gt_img)))
             psnrs.append(p)
-            if eval_ssim:
-                ssims.append(utils.rgb_ssim(rgb, gt_imgs[i], max_val=1))
-            if eval_lpips_alex:
-                lpips_alex.append(utils.rgb_lpips(rgb, gt_imgs[i], net_name='alex', device=c2w.device))
-            if eval_lpips_vgg:
-                lpips_vgg.append(utils.rgb_lpips(rgb, gt_imgs[i], net_name='vgg', device=c2w.device))
+            metrics.add(render_result['rgb_marched'], gt_img)
+            profiler.toc('eval', t_prof)
+
+    t_prof = profiler.tic()
+    metrics.flush()
+    profiler.toc('eval', t_prof)
+    ssims, lpips_alex, lpips_vgg = metrics.ssims, metrics.lpips_alex, metrics.lpips_vgg
+
+    if savedir is not None:
+        profiler.save(savedir, 'render_profile')
+        profiler.reset()
 
     if len(psnrs):
         print('Testing psnr', np.mean(psnrs), '(avg)')
@@ -175,10 +188,11 @@ def seed_everything(args):
     random.seed(args.seed)
 
 
-def load_everything(args, cfg):
+def load_everything(args, cfg, lazy_images=False):
     '''Load images / poses / camera settings / data split.
+    If lazy_images, the images are decoded only when accessed (when supported by the dataset).
     '''
-    data_dict = load_data(cfg.data)
+    data_dict = load_data_cached(cfg.data, lazy_images=lazy_images)
 
     # remove useless field
     kept_keys = {
@@ -189,50 +203,22 @@ def load_everything(args, cfg):
         if k not in kept_keys:
             data_dict.pop(k)
 
-    # construct data tensor
-    if data_dict['irregular_shape']:
-        data_dict['images'] = [torch.FloatTensor(im, device='cpu') for im in data_dict['images']]
+    # construct data tensor (8-bit images are kept in uint8 and normalized when used)
+    if cfg.data.get('uint8_images', True):
+        to_image = lambda im: torch.from_numpy(np.ascontiguousarray(utils.to_uint8_image_if_exact(im)))
+    else:
+        to_image = lambda im: torch.FloatTensor(im, device='cpu')
+    if isinstance(data_dict['images'], LazyImages):
+        data_dict['images'] = data_dict['images'].with_transform(to_image, stack=utils.stack_images)
+    elif data_dict['irregular_shape']:
+        data_dict['images'] = [to_image(im) for im in data_dict['images']]
     else:
-        data_dict['images'] = torch.FloatTensor(data_dict['images'], device='cpu')
+        data_dict['images'] = to_image(data_dict['images'])
     data_dict['poses'] = torch.Tensor(data_dict['poses'])
 
     return data_dict
 
 
-def _compute_bbox_by_cam_frustrm_bounded(cfg, HW, Ks, poses, i_train, near, far):
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        if cfg.data.ndc:
-            pts_nf = torch.stack([rays_o+rays_d*near, rays_o+rays_d*far])
-        else:
-            pts_nf = torch.stack([rays_o+viewdirs*near, rays_o+viewdirs*far])
-        xyz_min = torch.minimum(xyz_min, pts_nf.amin((0,1,2)))
-        xyz_max = torch.maximum(xyz_max, pts_nf.amax((0,1,2)))
-    return xyz_min, xyz_max
-
-def _compute_bbox_by_cam_frustrm_unbounded(cfg, HW, Ks, poses, i_train, near_clip):
-    # Find a tightest cube that cover all camera centers
-    xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
-    xyz_max = -xyz_min
-    for (H, W), K, c2w in zip(HW[i_train], Ks[i_train], poses[i_train]):
-        rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                H=H, W=W, K=K, c2w=c2w,
-                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
-        pts = rays_o + rays_d * near_clip
-        xyz_min = torch.minimum(xyz_min, pts.amin((0,1)))
-        xyz_max = torch.maximum(xyz_max, pts.amax((0,1)))
-    center = (xyz_min + xyz_max) * 0.5
-    radius = (center - xyz_min).max() * cfg.data.unbounded_inner_r
-    xyz_min = center - radius
-    xyz_max = center + radius
-    return xyz_min, xyz_max
-
 def compute_bbox_by_cam_frustrm(args, cfg, HW, Ks, poses, i_train, near, far, **kwargs):
     print('compute_bbox_by_cam_frustrm: start')
     if cfg.data.unbounded_inward:
@@ -252,18 +238,10 @@ def compute_bbox_by_coarse_geo(model_class, model_path, thres):
     print('compute_bbox_by_coarse_geo: start')
     eps_time = time.time()
     model = utils.load_model(model_class, model_path)
-    interp = torch.stack(torch.meshgrid(
-        torch.linspace(0, 1, model.world_size[0]),
-        torch.linspace(0, 1, model.world_size[1]),
-        torch.linspace(0, 1, model.world_size[2]),
-    ), -1)
-    dense_xyz = model.xyz_min * (1-interp) + model.xyz_max * interp
-    density = model.density(dense_xyz)
+    density = grid.sample_on_lattice(model.density, model.xyz_min, model.xyz_max, model.world_size)
     alpha = model.activate_density(density)
     mask = (alpha > thres)
-    active_xyz = dense_xyz[mask]
-    xyz_min = active_xyz.amin(0)
-    xyz_max = active_xyz.amax(0)
+    xyz_min, xyz_max = grid.lattice_bbox(mask, model.xyz_min, model.xyz_max)
     print('compute_bbox_by_coarse_geo: xyz_min', xyz_min)
     print('compute_bbox_by_coarse_geo: xyz_max', xyz_max)
     eps_time = time.time() - eps_time
@@ -375,7 +353,8 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
         'inverse_y': cfg.data.inverse_y,
         'flip_x': cfg.data.flip_x,
         'flip_y': cfg.data.flip_y,
-        'render_depth': True
+        'render_depth': True,
+        'mixed_precision': cfg_train.get('mixed_precision', False),
     }
 
     def get_training_rgb_f():
@@ -388,11 +367,37 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             rgb_tr_ori = images[i_train].to('cpu' if cfg.data.load2gpu_on_the_fly else device)
         return rgb_tr_ori
     
+    # the batches are drawn from generators of their own, so drawing them in the prefetching thread
+    # (see utils.BatchPrefetcher) does not consume the global RNGs of the main thread;
+    # the generator is on cpu, so the indices are drawn on cpu (not the cuda default tensor type) and moved
+    sample_seed = int(np.random.randint(2**31))
+    sample_generator = torch.Generator().manual_seed(sample_seed)
+
     # init batch rays sampler
     def gather_training_rays(img):
         print("gathering ... ")
         rgb_tr_ori = img
-        if cfg_train.ray_sampler == 'in_maskcache':
+        if cfg_train.get('compact_rays', False):
+            rgb_tr = dvgo.get_training_rays_compact(
+                    rgb_tr_ori=rgb_tr_ori,
+                    train_poses=poses[i_train],
+                    HW=HW[i_train], Ks=Ks[i_train],
+                    ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                    flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
+                    model=model if cfg_train.ray_sampler == 'in_maskcache' else None,
+                    render_kwargs=render_kwargs)
+            rays_o_tr, rays_d_tr, viewdirs_tr = rgb_tr.view_rays('rays_o'), rgb_tr.view_rays('rays_d'), None
+            imsz = rgb_tr.imsz
+            if cfg_train.ray_sampler == 'random':
+                batch_index_sampler = lambda: torch.randint(
+                        len(rgb_tr), [cfg_train.N_rand], generator=sample_generator, device='cpu')
+            else:
+                index_generator = dvgo.batch_indices_generator(
+                        len(rgb_tr), cfg_train.N_rand, imsz if cfg_train.get('stratified_sampling', False) else None,
+                        rng=np.random.RandomState(sample_seed))
+                batch_index_sampler = lambda: next(index_generator)
+            return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler
+        elif cfg_train.ray_sampler == 'in_maskcache':
             rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz = dvgo.get_training_rays_in_maskcache_sampling(
                     rgb_tr_ori=rgb_tr_ori,
                     train_poses=poses[i_train],
@@ -413,15 +418,31 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
                 HW=HW[i_train], Ks=Ks[i_train], ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
                 flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
 
-        index_generator = dvgo.batch_indices_generator(len(rgb_tr), cfg_train.N_rand)
+        index_generator = dvgo.batch_indices_generator(
+                len(rgb_tr), cfg_train.N_rand, imsz if cfg_train.get('stratified_sampling', False) else None,
+                rng=np.random.RandomState(sample_seed))
         batch_index_sampler = lambda: next(index_generator)
 
         return rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler
 
-    i = get_training_rgb_f()
-    import gc
-    gc.collect()
-    rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler = gather_training_rays(i)
+    if cfg.data.get('streaming_views', 0) > 0:
+        # only a rotating working set of the views is resident
+        rgb_tr = streaming.StreamingTrainingRays(
+                images=images, i_train=i_train,
+                train_poses=poses[i_train],
+                HW=HW[i_train], Ks=Ks[i_train],
+                ndc=cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,
+                n_views=cfg.data.streaming_views,
+                refresh_every=cfg.data.get('streaming_refresh_every', 100), seed=sample_seed,
+                device='cpu' if cfg.data.load2gpu_on_the_fly else device)
+        rays_o_tr, rays_d_tr, viewdirs_tr = rgb_tr.view_rays('rays_o'), rgb_tr.view_rays('rays_d'), None
+        imsz = rgb_tr.imsz
+    else:
+        i = get_training_rgb_f()
+        import gc
+        gc.collect()
+        rgb_tr, rays_o_tr, rays_d_tr, viewdirs_tr, imsz, batch_index_sampler = gather_training_rays(i)
 
     # view-count-based learning rate
     if cfg_train.pervoxel_lr:
@@ -429,25 +450,70 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             cnt = model.voxel_count_views(
                     rays_o_tr=rays_o_tr, rays_d_tr=rays_d_tr, imsz=imsz, near=near, far=far,
                     stepsize=cfg_model.stepsize, downrate=cfg_train.pervoxel_lr_downrate,
-                    irregular_shape=data_dict['irregular_shape'])
+                    irregular_shape=data_dict['irregular_shape'],
+                    count_device=cfg_train.get('count_views_device'))
             optimizer.set_pervoxel_lr(cnt)
             model.mask_cache.mask[cnt.squeeze() <= 2] = False
         per_voxel_init()
 
     if cfg_train.maskout_lt_nviews > 0:
         model.update_occupancy_cache_lt_nviews(
-                rays_o_tr, rays_d_tr, imsz, render_kwargs, cfg_train.maskout_lt_nviews)
+                rays_o_tr, rays_d_tr, imsz, render_kwargs, cfg_train.maskout_lt_nviews,
+                count_device=cfg_train.get('count_views_device'))
+
+    # random sample rays
+    def sample_batch():
+        if isinstance(rgb_tr, streaming.StreamingTrainingRays):
+            target, rays_o, rays_d, viewdirs = rgb_tr.sample(cfg_train.N_rand)
+        elif isinstance(rgb_tr, dvgo.CompactTrainingRays):
+            sel_i = batch_index_sampler()
+            target, rays_o, rays_d, viewdirs = rgb_tr.gather(sel_i)
+        elif cfg_train.ray_sampler in ['flatten', 'in_maskcache']:
+            sel_i = batch_index_sampler().to(rgb_tr.device)
+            target = utils.to_float_image(rgb_tr[sel_i])
+            rays_o = rays_o_tr[sel_i]
+            rays_d = rays_d_tr[sel_i]
+            viewdirs = viewdirs_tr[sel_i]
+        elif cfg_train.ray_sampler == 'random':
+            sel_b, sel_r, sel_c = [
+                torch.randint(n, [cfg_train.N_rand], generator=sample_generator, device='cpu').to(rgb_tr.device)
+                for n in rgb_tr.shape[:3]]
+            target = utils.to_float_image(rgb_tr[sel_b, sel_r, sel_c])
+            rays_o = rays_o_tr[sel_b, sel_r, sel_c]
+            rays_d = rays_d_tr[sel_b, sel_r, sel_c]
+            viewdirs = viewdirs_tr[sel_b, sel_r, sel_c]
+        else:
+            raise NotImplementedError
+        return target, rays_o, rays_d, viewdirs
+
+    # gather the next batches in background (only when the images are kept on cpu)
+    batch_prefetcher = None
+    if cfg.data.load2gpu_on_the_fly and cfg_train.get('prefetch_batches', 0) > 0 and device.type == 'cuda':
+        batch_prefetcher = utils.BatchPrefetcher(sample_batch, device, cfg_train.prefetch_batches)
+
+    # checkpoints are written in background
+    ckpt_writer = ckpt_utils.CheckpointWriter(
+            keep_last_n=cfg_train.get('ckpt_keep_last_n', 0),
+            save_optimizer=cfg_train.get('ckpt_save_optimizer', True))
+
+    # loss scaling for the mixed precision mode (master weights stay in float32)
+    scaler = torch.cuda.amp.GradScaler(enabled=render_kwargs['mixed_precision'])
+    lr_decay_factor = 0.1 ** (1/(cfg_train.lrate_decay * 1000))
 
     # GOGO
     torch.cuda.empty_cache()
     psnr_lst = []
+    psnr_hist = []
     time0 = time.time()
+    time_print = time.time()
     global_step = -1
+    tv_mask = None  # mask_cache sampled on the grid for tv_in_mask_cache; rebuilt when either changes
     for global_step in trange(1+start, 1+args.stop_at):
 
         # renew occupancy grid
         if model.mask_cache is not None and (global_step + 500) % 1000 == 0:
             model.update_occupancy_cache()
+            tv_mask = None
 
         # progress scaling checkpoint
         if global_step in cfg_train.pg_scale:
@@ -462,31 +528,21 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             optimizer = utils.create_optimizer_or_freeze_model(model, cfg_train, global_step=0)
             #optimizer = torch.optim.Adam(model.parameters())
             model.act_shift -= cfg_train.decay_after_scale
+            tv_mask = None
             torch.cuda.empty_cache()
 
         # random sample rays
-        if cfg_train.ray_sampler in ['flatten', 'in_maskcache']:
-            sel_i = batch_index_sampler()
-            target = rgb_tr[sel_i]
-            rays_o = rays_o_tr[sel_i]
-            rays_d = rays_d_tr[sel_i]
-            viewdirs = viewdirs_tr[sel_i]
-        elif cfg_train.ray_sampler == 'random':
-            sel_b = torch.randint(rgb_tr.shape[0], [cfg_train.N_rand])
-            sel_r = torch.randint(rgb_tr.shape[1], [cfg_train.N_rand])
-            sel_c = torch.randint(rgb_tr.shape[2], [cfg_train.N_rand])
-            target = rgb_tr[sel_b, sel_r, sel_c]
-            rays_o = rays_o_tr[sel_b, sel_r, sel_c]
-            rays_d = rays_d_tr[sel_b, sel_r, sel_c]
-            viewdirs = viewdirs_tr[sel_b, sel_r, sel_c]
+        t_prof = profiler.tic()
+        if batch_prefetcher is not None:
+            target, rays_o, rays_d, viewdirs = next(batch_prefetcher)
         else:
-            raise NotImplementedError
-
-        if cfg.data.load2gpu_on_the_fly:
-            target = target.to(device)
-            rays_o = rays_o.to(device)
-            rays_d = rays_d.to(device)
-            viewdirs = viewdirs.to(device)
+            target, rays_o, rays_d, viewdirs = sample_batch()
+            if cfg.data.load2gpu_on_the_fly:
+                target = target.to(device)
+                rays_o = rays_o.to(device)
+                rays_d = rays_d.to(device)
+                viewdirs = viewdirs.to(device)
+        profiler.toc('ray_generation', t_prof)
 
         # volume rendering
         render_result = model(
@@ -524,26 +580,32 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             rgbper_loss = (rgbper * render_result['weights'].detach()).sum() / len(rays_o)
             loss += cfg_train.weight_rgbper * rgbper_loss
 
-        loss.backward()
+        t_prof = profiler.tic()
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)  # the total variation below adds unscaled gradients
+        t_prof = profiler.toc('backward', t_prof)
 
         if global_step<cfg_train.tv_before and global_step>cfg_train.tv_after and global_step%cfg_train.tv_every==0:
+            if cfg_train.get('tv_in_mask_cache', False) and tv_mask is None:
+                tv_mask = grid.sample_on_lattice(model.mask_cache, model.xyz_min, model.xyz_max, model.world_size)
             if not args.freeze_density:
                 if cfg_train.weight_tv_density>0:
                     model.density_total_variation_add_grad(
-                        cfg_train.weight_tv_density/len(rays_o), global_step<cfg_train.tv_dense_before)
+                        cfg_train.weight_tv_density/len(rays_o), global_step<cfg_train.tv_dense_before, tv_mask)
             if not args.freeze_rgb:
                 if cfg_train.weight_tv_k0>0:
                     model.k0_total_variation_add_grad(
-                        cfg_train.weight_tv_k0/len(rays_o), global_step<cfg_train.tv_dense_before)
+                        cfg_train.weight_tv_k0/len(rays_o), global_step<cfg_train.tv_dense_before, tv_mask)
+        t_prof = profiler.toc('total_variation', t_prof)
 
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
+        profiler.toc('optimizer_step', t_prof)
         psnr_lst.append(psnr.item())
+        psnr_hist.append(psnr_lst[-1])
 
         # update lr
-        decay_steps = cfg_train.lrate_decay * 1000
-        decay_factor = 0.1 ** (1/decay_steps)
-        for i_opt_g, param_group in enumerate(optimizer.param_groups):
-            param_group['lr'] = param_group['lr'] * decay_factor
+        optimizer.scale_lr(lr_decay_factor)
 
         # check log & save
         if global_step%args.i_print==0:
@@ -551,34 +613,56 @@ def scene_rep_reconstruction(args, cfg, cfg_model, cfg_train, xyz_min, xyz_max,
             eps_time_str = f'{eps_time//3600:02.0f}:{eps_time//60%60:02.0f}:{eps_time%60:02.0f}'
             tqdm.write(f'scene_rep_reconstruction ({stage}): iter {global_step:6d} / '
                        f'Loss: {loss.item():.9f} / PSNR: {np.mean(psnr_lst):5.2f} / '
-                       f'Eps: {eps_time_str}')
+                       f'Eps: {eps_time_str} / Steps/s: {len(psnr_lst) / (time.time() - time_print):.2f}')
             psnr_lst = []
+            time_print = time.time()
 
         if global_step%args.i_weights==0:
             path = os.path.join(cfg.basedir, cfg.expname, f'{stage}_{global_step:06d}.tar')
-            torch.save({
+            ckpt_writer.save({
                 'global_step': global_step,
                 'model_kwargs': model.get_kwargs(),
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
-            }, path)
-            torch.save({
-                'global_step': global_step,
-                'model_kwargs': model.get_kwargs(),
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-            }, last_ckpt_path)
+            }, path, last_path=last_ckpt_path)
             print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', path)
             print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', last_ckpt_path)
 
+    if batch_prefetcher is not None:
+        batch_prefetcher.close()
+    if isinstance(rgb_tr, streaming.StreamingTrainingRays):
+        rgb_tr.close()
+    profiler.save(os.path.join(cfg.basedir, cfg.expname), f'{stage}_profile')
+    profiler.reset()
+
+    # report psnr and iteration time to compare the precision modes across configs
+    if global_step > start:
+        train_stats = {
+            'stage': stage,
+            'mixed_precision': render_kwargs['mixed_precision'],
+            'iters': global_step - start,
+            'sec_per_iter': (time.time() - time0) / (global_step - start),
+            'psnr': float(np.mean(psnr_hist[-args.i_print:])),
+            # mean psnr of each i_print window to compare the convergence (e.g., streaming v.s. in-memory rays)
+            'psnr_curve': [
+                [start + i + len(psnr_hist[i:i+args.i_print]), float(np.mean(psnr_hist[i:i+args.i_print]))]
+                for i in range(0, len(psnr_hist), args.i_print)],
+        }
+        if isinstance(rgb_tr, streaming.StreamingTrainingRays):
+            train_stats['streaming'] = rgb_tr.stats()
+        print(f'scene_rep_reconstruction ({stage}): train stats', train_stats)
+        with open(os.path.join(cfg.basedir, cfg.expname, f'{stage}_train_stats.json'), 'w') as f:
+            json.dump(train_stats, f, indent=2)
+
     if global_step != -1:
-        torch.save({
+        ckpt_writer.save({
             'global_step': global_step,
             'model_kwargs': model.get_kwargs(),
             'model_state_dict': model.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
         }, last_ckpt_path)
         print(f'scene_rep_reconstruction ({stage}): saved checkpoints at', last_ckpt_path)
+    ckpt_writer.close()
 
 
 def train(args, cfg, data_dict):
@@ -639,6 +723,8 @@ if __name__=='__main__':
     parser = config_parser()
     args = parser.parse_args()
     cfg = Config.fromfile(args.config)
+    if args.profile:
+        profiler.enable()
 
     # init enviroment
     if torch.cuda.is_available():
@@ -649,7 +735,8 @@ if __name__=='__main__':
     seed_everything(args)
 
     # load images / poses / camera settings / data split
-    data_dict = load_everything(args=args, cfg=cfg)
+    data_dict = load_everything(
+            args=args, cfg=cfg, lazy_images=args.render_only or cfg.data.get('streaming_views', 0) > 0)
 
     # export scene bbox and camera poses in 3d for debugging and visualization
     if args.export_bbox_and_cams_only:
@@ -659,17 +746,14 @@ if __name__=='__main__':
         near, far = data_dict['near'], data_dict['far']
         if data_dict['near_clip'] is not None:
             near = data_dict['near_clip']
-        cam_lst = []
-        for c2w, (H, W), K in zip(poses[i_train], HW[i_train], Ks[i_train]):
-            rays_o, rays_d, viewdirs = dvgo.get_rays_of_a_view(
-                    H, W, K, c2w, cfg.data.ndc, inverse_y=cfg.data.inverse_y,
-                    flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y,)
-            cam_o = rays_o[0,0].cpu().numpy()
-            cam_d = rays_d[[0,0,-1,-1],[0,-1,0,-1]].cpu().numpy()
-            cam_lst.append(np.array([cam_o, *(cam_o+cam_d*max(near, far*0.05))]))
+        rays_o, rays_d, viewdirs = get_corner_rays(
+                HW[i_train], Ks[i_train], poses[i_train], cfg.data.ndc, inverse_y=cfg.data.inverse_y,
+                flip_x=cfg.data.flip_x, flip_y=cfg.data.flip_y)
+        cam_o = rays_o[:, :1]
+        cam_lst = torch.cat([cam_o, cam_o+rays_d*max(near, far*0.05)], 1)
         np.savez_compressed(args.export_bbox_and_cams_only,
             xyz_min=xyz_min.cpu().numpy(), xyz_max=xyz_max.cpu().numpy(),
-            cam_lst=np.array(cam_lst))
+            cam_lst=cam_lst.cpu().numpy())
         print('done')
         sys.exit()
 
@@ -0,0 +1,227 @@
+import os
+import re
+import ast
+import sys
+import glob
+import json
+import time
+import queue
+import argparse
+import threading
+import subprocess
+
+# remove the dependency on mmcv
+# import mmcv
+from lib.config_loader import Config
+
+
+def config_parser():
+    '''Define command line arguments
+    '''
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Train many scenes with run.py over a pool of workers. '
+                    'The arguments after "--" are passed to every run.py job, '
+                    'e.g. python run_batch.py --configs "configs/llff/*.py" --devices 0 1 -- --stop_at 20000 --render_test')
+    parser.add_argument('--configs', nargs='+', required=True,
+                        help='config file paths or glob patterns (*_default.py and the segmentation configs are skipped)')
+    parser.add_argument('--devices', nargs='+', default=['0'],
+                        help='CUDA device ids to run on, "cpu" for cpu-only workers')
+    parser.add_argument('--jobs_per_device', type=int, default=1,
+                        help='number of concurrent jobs on each device')
+    parser.add_argument('--threads_per_job', type=int, default=0,
+                        help='limit the cpu threads (OMP/MKL) of each job; 0 for #cpus / #workers')
+    parser.add_argument('--script', default='run.py',
+                        help='entry point of each job')
+    parser.add_argument('--report', default='logs/batch_report',
+                        help='path prefix of the consolidated report (.json and .txt)')
+    parser.add_argument('--rerun_done', action='store_true',
+                        help='run again the jobs which are marked as done')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='only print the jobs')
+    return parser
+
+
+def is_seg_config(path):
+    '''Whether the config inherits from seg_default.py (an SA3D segmentation config, not a run.py one)'''
+    while True:
+        if os.path.basename(path) == 'seg_default.py':
+            return True
+        if not os.path.isfile(path):
+            return False  # reported when the config is loaded
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        bases = [ast.literal_eval(node.value) for node in tree.body
+                 if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == '_base_' for t in node.targets)]
+        if len(bases) == 0:
+            return False
+        bases = bases[-1] if isinstance(bases[-1], list) else [bases[-1]]
+        parents = [os.path.join(os.path.dirname(path), base) for base in bases]
+        if any(is_seg_config(parent) for parent in parents[1:]):
+            return True
+        path = parents[0]
+
+
+def expand_configs(patterns):
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if len(matched) == 0:
+            print(f'run_batch: no config matches {pattern}')
+        for path in matched:
+            if glob.has_magic(pattern) and (path.endswith('_default.py') or is_seg_config(path)):
+                continue
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+class Job:
+    '''A scene to train (coarse + fine scene_rep_reconstruction in a run.py process)'''
+    def __init__(self, config_path):
+        cfg = Config.fromfile(config_path)
+        self.config_path = config_path
+        self.expname = cfg.expname
+        self.expdir = os.path.join(cfg.basedir, cfg.expname)
+        self.log_path = os.path.join(self.expdir, 'batch_log.txt')
+        self.done_path = os.path.join(self.expdir, 'batch_done.json')
+        self.result = None
+
+    def is_done(self):
+        return os.path.isfile(self.done_path)
+
+    def is_resumable(self):
+        return any(os.path.isfile(os.path.join(self.expdir, f'{stage}_last.tar')) for stage in ['coarse', 'fine'])
+
+    def run(self, script, extra_args, device, n_threads):
+        env = dict(os.environ)
+        env['CUDA_VISIBLE_DEVICES'] = '' if device == 'cpu' else str(device)
+        for key in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            env[key] = str(n_threads)
+        cmd = [sys.executable, script, '--config', self.config_path, *extra_args]
+        os.makedirs(self.expdir, exist_ok=True)
+        resumed = self.is_resumable()
+        eps_time = time.time()
+        with open(self.log_path, 'a') as log:
+            log.write(f'\n# {time.strftime("%Y-%m-%d %H:%M:%S")} device={device} {" ".join(cmd)}\n')
+            log.flush()
+            returncode = subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        eps_time = time.time() - eps_time
+
+        self.result = {
+            'config': self.config_path,
+            'expname': self.expname,
+            'device': device,
+            'resumed': resumed,
+            'returncode': returncode,
+            'wall_sec': eps_time,
+        }
+        for stage in ['coarse', 'fine']:
+            stats_path = os.path.join(self.expdir, f'{stage}_train_stats.json')
+            if os.path.isfile(stats_path):
+                with open(stats_path) as f:
+                    self.result[stage] = json.load(f)
+        self.result.update(parse_test_metrics(self.log_path))
+        if returncode == 0:
+            with open(self.done_path, 'w') as f:
+                json.dump(self.result, f, indent=2)
+        return self.result
+
+
+def parse_test_metrics(log_path):
+    '''Grep the last "Testing <metric> <value> (avg)" lines printed by render_viewpoints'''
+    metrics = {}
+    with open(log_path) as f:
+        for line in f:
+            m = re.match(r'Testing (psnr|ssim|lpips \(vgg\)|lpips \(alex\)) ([-+.\deE]+) \(avg\)', line.strip())
+            if m:
+                metrics['test_' + re.sub(r'\W+', '_', m.group(1)).strip('_')] = float(m.group(2))
+    return metrics
+
+
+def run_workers(jobs, args, extra_args):
+    '''Each worker owns a device slot and keeps pulling jobs until the queue is empty'''
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    slots = [device for device in args.devices for _ in range(args.jobs_per_device)]
+    n_threads = args.threads_per_job or max(1, (os.cpu_count() or 1) // len(slots))
+    print_lock = threading.Lock()
+
+    def worker(device):
+        while True:
+            try:
+                job = job_queue.get_nowait()
+            except queue.Empty:
+                return
+            with print_lock:
+                print(f'run_batch: [device {device}] start {job.expname} (log: {job.log_path})')
+            result = job.run(args.script, extra_args, device, n_threads)
+            with print_lock:
+                print(f'run_batch: [device {device}] {job.expname} finished with code {result["returncode"]} '
+                      f'in {result["wall_sec"]/60:.1f} min')
+
+    threads = [threading.Thread(target=worker, args=(device,)) for device in slots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def write_report(jobs, report_prefix):
+    results = []
+    for job in jobs:
+        if job.result is not None:
+            results.append(job.result)
+        elif job.is_done():
+            with open(job.done_path) as f:
+                results.append(dict(json.load(f), skipped=True))
+    if len(results) == 0:
+        return
+
+    lines = [f'{"expname":<32s} {"code":>5s} {"wall(min)":>10s} {"coarse s/it":>12s} {"fine s/it":>10s} '
+             f'{"fine psnr":>10s} {"test psnr":>10s}']
+    fmt = lambda v, spec: format(v, spec) if v is not None else '-'
+    for r in results:
+        lines.append(
+            f'{r["expname"]:<32s} {r["returncode"]:5d} {r["wall_sec"]/60:10.1f} '
+            f'{fmt(r.get("coarse", {}).get("sec_per_iter"), "12.4f"):>12s} '
+            f'{fmt(r.get("fine", {}).get("sec_per_iter"), "10.4f"):>10s} '
+            f'{fmt(r.get("fine", {}).get("psnr"), "10.2f"):>10s} '
+            f'{fmt(r.get("test_psnr"), "10.2f"):>10s}'
+            + (' (done before)' if r.get('skipped') else ''))
+    table = '\n'.join(lines)
+
+    os.makedirs(os.path.dirname(report_prefix) or '.', exist_ok=True)
+    with open(report_prefix + '.json', 'w') as f:
+        json.dump(results, f, indent=2)
+    with open(report_prefix + '.txt', 'w') as f:
+        f.write(table + '\n')
+    print(table)
+    print('run_batch: report is saved in', report_prefix + '.{json,txt}')
+
+
+if __name__=='__main__':
+
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        argv, extra_args = argv[:argv.index('--')], argv[argv.index('--')+1:]
+    args = config_parser().parse_args(argv)
+
+    jobs = [Job(path) for path in expand_configs(args.configs)]
+    todo = [job for job in jobs if args.rerun_done or not job.is_done()]
+    for job in jobs:
+        state = 'todo' if job in todo else 'done'
+        if job in todo and job.is_resumable():
+            state = 'resume'
+        print(f'run_batch: {state:>6s} {job.config_path} -> {job.expdir}')
+    if args.dry_run:
+        sys.exit()
+
+    eps_time = time.time()
+    run_workers(todo, args, extra_args)
+    write_report(jobs, args.report)
+    eps_time = time.time() - eps_time
+    eps_time_str = f'{eps_time//3600:02.0f}:{eps_time//60%60:02.0f}:{eps_time%60:02.0f}'
+    print('run_batch: finish (eps time', eps_time_str, ')')
@@ -19,6 +19,7 @@ from lib import utils
 from lib.bbox_utils import *
 from lib.configs import config_parser
 from lib import sam3d
+from lib.profiler import profiler
 from lib.gui import Sam3dGUI
 from lib.render_utils import render_fn
 
@@ -50,6 +51,7 @@ def train_seg(args, cfg, data_dict):
                 data_dict=data_dict, stage='coarse')
         gui = Sam3dGUI(Seg3d)
         gui.run()
+        Seg3d.ckpt_writer.wait()
         eps_coarse = time.time() - eps_coarse
         eps_time_str = f'{eps_coarse//3600:02.0f}:{eps_coarse//60%60:02.0f}:{eps_coarse%60:02.0f}'
         print('train: coarse segmentation in', eps_time_str)
@@ -72,6 +74,7 @@ def train_seg(args, cfg, data_dict):
                 coarse_ckpt_path=coarse_seg_ckpt_path)
         gui = Sam3dGUI(Seg3d)
         gui.run()
+        Seg3d.ckpt_writer.wait()
         eps_fine = time.time() - eps_fine
         eps_time_str = f'{eps_fine//3600:02.0f}:{eps_fine//60%60:02.0f}:{eps_fine%60:02.0f}'
         print('train: fine detail segmentation in', eps_time_str)
@@ -86,6 +89,8 @@ if __name__=='__main__':
     parser = config_parser()
     args = parser.parse_args()
     cfg = Config.fromfile(args.config)
+    if args.profile:
+        profiler.enable()
 
     # init enviroment
     if torch.cuda.is_available():
@@ -96,7 +101,8 @@ if __name__=='__main__':
     utils.seed_everything(args)
 
     # load images / poses / camera settings / data split
-    data_dict = utils.load_everything(args=args, cfg=cfg)
+    # the images are only used for the metrics of the train / test renderings
+    data_dict = utils.load_everything(args=args, cfg=cfg, lazy_images=True)
 
     # train
     if not args.render_only:
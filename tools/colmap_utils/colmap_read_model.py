@@ -45,6 +45,14 @@ BaseImage = collections.namedtuple(
     "Image", ["id", "qvec", "tvec", "camera_id", "name", "xys", "point3D_ids"])
 Point3D = collections.namedtuple(
     "Point3D", ["id", "xyz", "rgb", "error", "image_ids", "point2D_idxs"])
+# Columnar (flat arrays) counterparts; the variable-length fields of record i are
+# field[offsets[i]:offsets[i+1]]
+ImagesColumnar = collections.namedtuple(
+    "ImagesColumnar", ["ids", "qvecs", "tvecs", "camera_ids", "names",
+                       "xys", "point3D_ids", "point2D_offsets"])
+Points3DColumnar = collections.namedtuple(
+    "Points3DColumnar", ["ids", "xyz", "rgb", "error",
+                         "image_ids", "point2D_idxs", "track_offsets"])
 
 class Image(BaseImage):
     def qvec2rotmat(self):
@@ -258,6 +266,75 @@ def read_points3d_binary(path_to_model_file):
     return points3D
 
 
+def _gather_records(buf, starts, dtype):
+    """Gather the fixed-size records of dtype starting at the byte offsets starts of buf"""
+    data = np.frombuffer(buf, dtype=np.uint8)
+    idx = np.asarray(starts, dtype=np.int64)[:, None] + np.arange(dtype.itemsize)
+    return data[idx].reshape(-1).view(dtype)
+
+
+def _gather_variable(buf, starts, lengths, dtype):
+    """Gather lengths[i] consecutive records of dtype from each byte offset starts[i] of buf"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    elem = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    elem_starts = np.repeat(np.asarray(starts, dtype=np.int64), lengths) + elem * dtype.itemsize
+    return _gather_records(buf, elem_starts, dtype), offsets
+
+
+def read_images_binary_columnar(path_to_model_file):
+    """
+    Same as read_images_binary but return an ImagesColumnar of flat arrays (in the file order).
+    """
+    header_dtype = np.dtype([("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")])
+    point2D_dtype = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+    with open(path_to_model_file, "rb") as fid:
+        buf = fid.read()
+    num_reg_images = struct.unpack_from("<Q", buf, 0)[0]
+    starts, names, points_starts, num_points2D = [], [], [], []
+    pos = 8
+    for _ in range(num_reg_images):
+        starts.append(pos)
+        name_end = buf.index(b"\x00", pos + header_dtype.itemsize)
+        names.append(buf[pos + header_dtype.itemsize:name_end].decode("utf-8"))
+        num = struct.unpack_from("<Q", buf, name_end + 1)[0]
+        points_starts.append(name_end + 9)
+        num_points2D.append(num)
+        pos = name_end + 9 + num * point2D_dtype.itemsize
+    headers = _gather_records(buf, starts, header_dtype)
+    points2D, offsets = _gather_variable(buf, points_starts, num_points2D, point2D_dtype)
+    return ImagesColumnar(
+        ids=headers["id"], qvecs=headers["qvec"], tvecs=headers["tvec"],
+        camera_ids=headers["camera_id"], names=names,
+        xys=points2D["xy"], point3D_ids=points2D["point3D_id"], point2D_offsets=offsets)
+
+
+def read_points3d_binary_columnar(path_to_model_file):
+    """
+    Same as read_points3d_binary but return a Points3DColumnar of flat arrays (in the file order).
+    Only the record offsets are walked in python; the fields are gathered with numpy.
+    """
+    header_dtype = np.dtype([("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3),
+                             ("error", "<f8"), ("track_length", "<u8")])
+    track_dtype = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+    with open(path_to_model_file, "rb") as fid:
+        buf = fid.read()
+    num_points = struct.unpack_from("<Q", buf, 0)[0]
+    starts = np.empty([num_points], dtype=np.int64)
+    unpack_track_length = struct.Struct("<Q").unpack_from
+    track_length_offset = header_dtype.fields["track_length"][1]
+    pos = 8
+    for i in range(num_points):
+        starts[i] = pos
+        pos += header_dtype.itemsize + unpack_track_length(buf, pos + track_length_offset)[0] * track_dtype.itemsize
+    headers = _gather_records(buf, starts, header_dtype)
+    tracks, offsets = _gather_variable(
+        buf, starts + header_dtype.itemsize, headers["track_length"].astype(np.int64), track_dtype)
+    return Points3DColumnar(
+        ids=headers["id"], xyz=headers["xyz"], rgb=headers["rgb"], error=headers["error"],
+        image_ids=tracks["image_id"], point2D_idxs=tracks["point2D_idx"], track_offsets=offsets)
+
+
 def read_model(path, ext):
     if ext == ".txt":
         cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
@@ -283,6 +360,15 @@ def qvec2rotmat(qvec):
          1 - 2 * qvec[1]**2 - 2 * qvec[2]**2]])
 
 
+def qvec2rotmat_batch(qvecs):
+    """[N, 4] quaternions to [N, 3, 3] rotation matrices"""
+    w, x, y, z = np.moveaxis(np.asarray(qvecs), -1, 0)
+    return np.stack([
+        np.stack([1 - 2 * y**2 - 2 * z**2, 2 * x * y - 2 * w * z, 2 * z * x + 2 * w * y], -1),
+        np.stack([2 * x * y + 2 * w * z, 1 - 2 * x**2 - 2 * z**2, 2 * y * z - 2 * w * x], -1),
+        np.stack([2 * z * x - 2 * w * y, 2 * y * z + 2 * w * x, 1 - 2 * x**2 - 2 * y**2], -1)], -2)
+
+
 def rotmat2qvec(R):
     Rxx, Ryx, Rzx, Rxy, Ryy, Rzy, Rxz, Ryz, Rzz = R.flat
     K = np.array([
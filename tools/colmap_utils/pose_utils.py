@@ -8,6 +8,9 @@ import skimage.transform
 from .colmap_wrapper import run_colmap
 from . import colmap_read_model as read_model
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lib.image_io import minify_images
+
 
 def load_colmap_data(realdir):
     
@@ -26,29 +29,21 @@ def load_colmap_data(realdir):
     
     #imagesfile = os.path.join(realdir, 'sparse/0/images.bin')
     imagesfile = os.path.join(realdir, 'dense/sparse/images.bin')
-    imdata = read_model.read_images_binary(imagesfile)
-    
-    w2c_mats = []
-    bottom = np.array([0,0,0,1.]).reshape([1,4])
+    imdata = read_model.read_images_binary_columnar(imagesfile)
     
-    names = [imdata[k].name for k in imdata]
+    names = imdata.names
     print( 'Images #', len(names))
     perm = np.argsort(names)
-    for k in imdata:
-        im = imdata[k]
-        R = im.qvec2rotmat()
-        t = im.tvec.reshape([3,1])
-        m = np.concatenate([np.concatenate([R, t], 1), bottom], 0)
-        w2c_mats.append(m)
-    
-    w2c_mats = np.stack(w2c_mats, 0)
+    w2c_mats = np.tile(np.eye(4), [len(names), 1, 1])
+    w2c_mats[:, :3, :3] = read_model.qvec2rotmat_batch(imdata.qvecs)
+    w2c_mats[:, :3, 3] = imdata.tvecs
     c2w_mats = np.linalg.inv(w2c_mats)
     
     poses = c2w_mats[:, :3, :4].transpose([1,2,0])
     poses = np.concatenate([poses, np.tile(hwf[..., np.newaxis], [1,1,poses.shape[-1]])], 1)
     
     points3dfile = os.path.join(realdir, 'dense/sparse/points3D.bin')
-    pts3d = read_model.read_points3d_binary(points3dfile)
+    pts3d = read_model.read_points3d_binary_columnar(points3dfile)
     
     # must switch to [-u, r, -t] from [r, -u, t], NOT [r, u, -t]
     poses = np.concatenate([poses[:, 1:2, :], poses[:, 0:1, :], -poses[:, 2:3, :], poses[:, 3:4, :], poses[:, 4:5, :]], 1)
@@ -56,92 +51,53 @@ def load_colmap_data(realdir):
     return poses, pts3d, perm, names
 
 
+def _sorted_percentile(vals, starts, counts, q):
+    """np.percentile (linear interpolation) of the sorted groups vals[starts[i]:starts[i]+counts[i]]"""
+    pos = q / 100. * (counts - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, counts - 1)
+    v_lo, v_hi = vals[starts + lo], vals[starts + hi]
+    return v_lo + (v_hi - v_lo) * (pos - lo)
+
+
 def save_poses(basedir, poses, pts3d, perm, names):
-    pts_arr = []
-    vis_arr = []
-    for k in pts3d:
-        pts_arr.append(pts3d[k].xyz)
-        cams = [0] * poses.shape[-1]
-        for ind in pts3d[k].image_ids:
-            if len(cams) < ind - 1:
-                print('ERROR: the correct camera poses for current points cannot be accessed')
-                return
-            cams[ind-1] = 1
-        vis_arr.append(cams)
-
-    pts_arr = np.array(pts_arr)
-    vis_arr = np.array(vis_arr)
-    print( 'Points', pts_arr.shape, 'Visibility', vis_arr.shape )
+    # pts3d is a read_model.Points3DColumnar; the visibility is kept as (point, camera) pairs of the tracks
+    n_cams = poses.shape[-1]
+    pts_arr = pts3d.xyz
+    track_lengths = np.diff(pts3d.track_offsets)
+    vis_pts = np.repeat(np.arange(len(pts_arr)), track_lengths)
+    vis_cams = pts3d.image_ids.astype(np.int64) - 1
+    if len(vis_cams) and (vis_cams.min() < 0 or vis_cams.max() >= n_cams):
+        print('ERROR: the correct camera poses for current points cannot be accessed')
+        return
+    # a point observed several times in an image counts once
+    vis_keys = np.unique(vis_cams * len(pts_arr) + vis_pts)
+    vis_cams, vis_pts = vis_keys // len(pts_arr), vis_keys % len(pts_arr)
+    print( 'Points', pts_arr.shape, 'Visibility', (len(pts_arr), n_cams), len(vis_keys), 'pairs' )
+    
+    zvals = np.sum(-(pts_arr[vis_pts] - poses[:3, 3, vis_cams].T) * poses[:3, 2, vis_cams].T, -1)
+    print( 'Depth stats', zvals.min(), zvals.max(), zvals.mean() )
     
-    zvals = np.sum(-(pts_arr[:, np.newaxis, :].transpose([2,0,1]) - poses[:3, 3:4, :]) * poses[:3, 2:3, :], 0)
-    valid_z = zvals[vis_arr==1]
-    print( 'Depth stats', valid_z.min(), valid_z.max(), valid_z.mean() )
+    # per-camera depth percentiles over the pairs sorted by (camera, depth)
+    order = np.lexsort([zvals, vis_cams])
+    zvals = zvals[order]
+    counts = np.bincount(vis_cams, minlength=n_cams)
+    if (counts == 0).any():
+        raise ValueError(f'save_poses: no point is visible in the images {np.array(names)[counts == 0].tolist()}')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    close_depth = _sorted_percentile(zvals, starts, counts, .1)
+    inf_depth = _sorted_percentile(zvals, starts, counts, 99.9)
     
-    save_arr = []
-    for i in perm:
-        vis = vis_arr[:, i]
-        zs = zvals[:, i]
-        zs = zs[vis==1]
-        close_depth, inf_depth = np.percentile(zs, .1), np.percentile(zs, 99.9)
-        # print( i, close_depth, inf_depth )
-        
-        save_arr.append(np.concatenate([poses[..., i].ravel(), np.array([close_depth, inf_depth])], 0))
-    save_arr = np.array(save_arr)
+    save_arr = np.concatenate([
+        poses[..., perm].transpose([2,0,1]).reshape(len(perm), -1),
+        close_depth[perm, None], inf_depth[perm, None]], 1)
     
     np.save(os.path.join(basedir, 'poses_bounds.npy'), save_arr)
     np.save(os.path.join(basedir, 'poses_names.npy'), sorted(names))
 
 
 def minify(basedir, factors=[], resolutions=[]):
-    needtoload = False
-    for r in factors:
-        imgdir = os.path.join(basedir, 'images_{}'.format(r))
-        if not os.path.exists(imgdir):
-            needtoload = True
-    for r in resolutions:
-        imgdir = os.path.join(basedir, 'images_{}x{}'.format(r[1], r[0]))
-        if not os.path.exists(imgdir):
-            needtoload = True
-    if not needtoload:
-        return
-
-    from shutil import copy
-    from subprocess import check_output
-
-    imgdir = os.path.join(basedir, 'images')
-    imgs = [os.path.join(imgdir, f) for f in sorted(os.listdir(imgdir))]
-    imgs = [f for f in imgs if any([f.endswith(ex) for ex in ['JPG', 'jpg', 'png', 'jpeg', 'PNG']])]
-    imgdir_orig = imgdir
-
-    wd = os.getcwd()
-
-    for r in factors + resolutions:
-        if isinstance(r, int):
-            name = 'images_{}'.format(r)
-            resizearg = '{}%'.format(int(100./r))
-        else:
-            name = 'images_{}x{}'.format(r[1], r[0])
-            resizearg = '{}x{}'.format(r[1], r[0])
-        imgdir = os.path.join(basedir, name)
-        if os.path.exists(imgdir):
-            continue
-
-        print('Minifying', r, basedir)
-
-        os.makedirs(imgdir)
-        check_output('cp {}/* {}'.format(imgdir_orig, imgdir), shell=True)
-
-        ext = imgs[0].split('.')[-1]
-        args = ' '.join(['mogrify', '-resize', resizearg, '-format', 'png', '*.{}'.format(ext)])
-        print(args)
-        os.chdir(imgdir)
-        check_output(args, shell=True)
-        os.chdir(wd)
-
-        if ext != 'png':
-            check_output('rm {}/*.{}'.format(imgdir, ext), shell=True)
-            print('Removed duplicates')
-        print('Done')
+    minify_images(basedir, factors=factors, resolutions=resolutions)
 
 
 
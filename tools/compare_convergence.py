@@ -0,0 +1,38 @@
+'''Compare the training convergence of experiments from their {stage}_train_stats.json
+(e.g., streaming_views v.s. the full in-memory training rays of the same scene).
+usage: python tools/compare_convergence.py logs/llff/room logs/llff/room_stream8 --stage fine
+'''
+import os
+import json
+import argparse
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('expdirs', nargs='+', help='experiment folders (basedir/expname); the first one is the reference')
+parser.add_argument('--stage', default='fine', choices=['coarse', 'fine'])
+parser.add_argument('--every', type=int, default=1, help='print every given number of psnr_curve entries')
+args = parser.parse_args()
+
+stats = []
+for expdir in args.expdirs:
+    with open(os.path.join(expdir, f'{args.stage}_train_stats.json')) as f:
+        stats.append(json.load(f))
+names = [os.path.basename(os.path.normpath(expdir))[-16:] for expdir in args.expdirs]
+
+# psnr of the same iterations side by side
+curves = [dict(s.get('psnr_curve', [])) for s in stats]
+iters = sorted(set().union(*curves))[::args.every]
+print(f'{"iter":>8s} ' + ' '.join(f'{name:>16s}' for name in names))
+for it in iters:
+    print(f'{it:8d} ' + ' '.join(f'{c[it]:16.2f}' if it in c else f'{"-":>16s}' for c in curves))
+
+# summary (the psnr gap is w.r.t. the first experiment)
+print()
+for name, s in zip(names, stats):
+    streaming = s.get('streaming')
+    line = (f'{name:>16s}: iters {s["iters"]} / sec/iter {s["sec_per_iter"]:.4f} / '
+            f'final psnr {s["psnr"]:5.2f} ({s["psnr"] - stats[0]["psnr"]:+.2f})')
+    if streaming is not None:
+        line += (f' / streaming {streaming["streaming_views"]}/{streaming["train_views"]} views '
+                 f'{streaming["resident_mb"]:.0f} MB, {streaming["epochs"]:.2f} epochs, '
+                 f'waited {streaming["wait_sec"]:.1f} sec')
+    print(line)